@@ -1,19 +1,105 @@
 from airflow import DAG
-from airflow.operators.python import PythonOperator
-from airflow.providers.postgres.operators.postgres import PostgresOperator
+from airflow.decorators import task
 from datetime import datetime
-import pandas as pd
+import os
+import sys
+
+# Shared ETL modules live in python_etl/ at the repository root
+ETL_MODULES_PATH = os.environ.get(
+    'USER_BEHAVIOR_ETL_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'python_etl')
+)
+sys.path.append(ETL_MODULES_PATH)
+from bulk_load import DEFAULT_CHUNK_BYTES, plan_chunks
+from chunked_ingest import (
+    chunk_work_dir, clean_chunk, drop_staging, load_chunk,
+    merge_staging, prepare_tables, update_staged_rollups, update_staged_summaries,
+)
+from etl3 import db_params
+from metrics import push_to_xcom
+from summaries import SUMMARY_TABLES
+
+#source file; another one can be given in the run config as {"csv_file_path": ...}
+CSV_FILE_PATH = '/home/hfrnssc/airflow/sample_files/dataset_user_behavior_for_test.csv'
+
+#cleaned chunks are handed from task to task as Parquet files under this directory,
+#so it must be on storage every worker can read
+CHUNK_DIR = '/home/hfrnssc/airflow/chunks'
+
+#main table and the staging table the chunks are copied into before the merge
+MAIN_TABLE = 'usb1'
+STAGING_TABLE = 'user_behavior_dag_staging'
 
 #define default arguments
 default_args = {
     'owner': 'airflow',
-    'start_date': datetime(2024,11,9)
+    'start_date': datetime(2024,11,9),
+    'retries': 1,
 }
 
-#function to read csv and producing insert queries
-def producing_insert_queries():
-    CSV_FILE_PATH = '/home/hfrnssc/airflow/sample_files/dataset_user_behavior_for_test.csv'
-    #read csv file
-    df = pd.read_csv(CSV_FILE_PATH)
+with DAG(
+    dag_id='pipeline_csv_to_postgre',
+    description='Load the user-behavior CSV into PostgreSQL as parallel chunks',
+    default_args=default_args,
+    schedule_interval=None,
+    catchup=False,
+    #runs share the staging table
+    max_active_runs=1,
+    params={'csv_file_path': CSV_FILE_PATH, 'chunk_bytes': DEFAULT_CHUNK_BYTES},
+    tags=['user_behavior', 'etl'],
+) as dag:
+
+    @task
+    def create_tables():
+        prepare_tables(db_params, MAIN_TABLE, STAGING_TABLE)
+        push_to_xcom()
+
+    #only the byte offsets of every chunk go through XCom, never the rows
+    @task
+    def plan(params=None):
+        return plan_chunks(params['csv_file_path'], int(params['chunk_bytes']))
+
+    @task
+    def clean(chunk, run_id=None):
+        parquet_path = clean_chunk(chunk, chunk_work_dir(CHUNK_DIR, run_id))
+        push_to_xcom()
+        return parquet_path
+
+    @task
+    def load(parquet_path):
+        row_count = load_chunk(parquet_path, db_params, STAGING_TABLE)
+        push_to_xcom()
+        return row_count
+
+    #a single task resolves duplicates across chunks and merges into the main table;
+    #it hands on the days the batch changed
+    @task
+    def merge(row_counts):
+        print(f"Staged {sum(row_counts)} rows")
+        _, days = merge_staging(db_params, MAIN_TABLE, STAGING_TABLE)
+        push_to_xcom()
+        return [day.isoformat() for day in sorted(days)]
+
+    @task
+    def summarize(summary_table):
+        update_staged_summaries(db_params, MAIN_TABLE, STAGING_TABLE, summary_table)
+        push_to_xcom()
+
+    #the daily engagement rollups of the changed days are rebuilt from the main table
+    @task
+    def rollups(days):
+        update_staged_rollups(db_params, MAIN_TABLE, days)
+        push_to_xcom()
+
+    @task
+    def cleanup(run_id=None):
+        drop_staging(db_params, STAGING_TABLE, chunk_work_dir(CHUNK_DIR, run_id))
 
-    
\ No newline at end of file
+    tables = create_tables()
+    cleaned = clean.expand(chunk=plan())
+    loaded = load.expand(parquet_path=cleaned)
+    tables >> loaded
+    merged = merge(loaded)
+    summarized = summarize.expand(summary_table=list(SUMMARY_TABLES))
+    merged >> summarized
+    [summarized, rollups(merged)] >> cleanup()
@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+from bulk_load import DEFAULT_CHUNK_SIZE, read_csv_chunks
+from chunked_ingest import merge_staging, prepare_tables
+from db import pool_stats, pooled_connection, transaction
+from dedup import dedup_frame
+from etl3 import column_mapping, db_params, prepare_data
+from metrics import stage
+from parallel_ingest import replace_staged_rollups, stage_frame
+from schema import csv_read_options
+from summaries import batch_rows_sql, update_summaries
+
+# Define the path to the source CSV file
+csv_file_path = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/dataset_user_behavior_for_test.csv'
+
+# Number of concurrent COPY writers; each borrows its own pooled connection, and writers beyond
+# the 8 connections of the pool wait for one to be given back
+writers = 4
+
+# Cleaned chunks waiting for a writer. When the queue is full the parser waits,
+# so at most queue_size + writers chunks are held in memory
+queue_size = 8
+
+# Number of CSV rows per chunk
+chunk_size = DEFAULT_CHUNK_SIZE
+
+# Staging table the writers COPY into before the merge
+staging_table = 'user_behavior_async_staging'
+
+
+def clean_chunk(chunk):
+    """
+    Clean one raw chunk and keep its latest row per dedup key.
+    """
+    return dedup_frame(prepare_data(chunk, column_mapping), 'start_watching', keep='latest')
+
+
+async def produce(chunks, queue, writer_count):
+    """
+    Parse and clean the chunks in a worker thread and put them on the queue.
+    queue.put waits while the queue is full, which holds the parser back when the
+    writers fall behind. One None per writer marks the end of the file.
+
+    Returns:
+    - Seconds spent parsing and cleaning.
+    """
+    busy = 0.0
+    while True:
+        start = time.perf_counter()
+        chunk = await asyncio.to_thread(next, chunks, None)
+        busy += time.perf_counter() - start
+        if chunk is None:
+            break
+        await queue.put(chunk)
+    for _ in range(writer_count):
+        await queue.put(None)
+    return busy
+
+
+async def write(queue, db_params, staging_table):
+    """
+    Take cleaned chunks off the queue and COPY them into the staging table in a
+    worker thread, until the end marker.
+
+    Returns:
+    - (number of rows loaded, seconds spent loading)
+    """
+    row_count = 0
+    busy = 0.0
+    while True:
+        chunk = await queue.get()
+        if chunk is None:
+            return row_count, busy
+        start = time.perf_counter()
+        row_count += await asyncio.to_thread(stage_frame, chunk, db_params, staging_table)
+        busy += time.perf_counter() - start
+
+
+async def stage_file(csv_file_path, db_params, staging_table, writers=writers, queue_size=queue_size, chunk_size=chunk_size):
+    """
+    Parse and clean a CSV file while concurrent writers COPY the cleaned chunks
+    into the staging table, so parsing and loading overlap.
+
+    Returns:
+    - Number of rows staged.
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    chunks = read_csv_chunks(csv_file_path, clean_chunk, chunk_size, **csv_read_options())
+    tasks = [asyncio.create_task(produce(chunks, queue, writers))]
+    tasks += [asyncio.create_task(write(queue, db_params, staging_table)) for _ in range(writers)]
+
+    start = time.perf_counter()
+    try:
+        parse_seconds, *written = await asyncio.gather(*tasks)
+    except Exception:
+        # A failed writer would leave the parser waiting on a full queue
+        for task in tasks:
+            task.cancel()
+        raise
+    elapsed = time.perf_counter() - start
+
+    staged_rows = sum(row_count for row_count, _ in written)
+    load_seconds = sum(busy for _, busy in written)
+    print(
+        f"Staged {staged_rows} rows in {elapsed:.2f}s: parsing and cleaning took {parse_seconds:.2f}s, "
+        f"{writers} writers spent {load_seconds:.2f}s loading"
+    )
+    return staged_rows
+
+
+def ingest_file(csv_file_path, db_params, main_table='usb1', writers=writers, queue_size=queue_size, chunk_size=chunk_size):
+    """
+    Load one CSV file through the async pipeline, then merge the staged rows into
+    the main table on the dedup key and update the summary tables and the daily
+    engagement rollups. The main table
+    is kept, as with parallel_ingest.
+
+    Parameters:
+    - csv_file_path: Path to the source CSV file.
+    - db_params: Connection parameters.
+    - main_table: Main event table.
+    - writers: Number of concurrent COPY writers.
+    - queue_size: Number of cleaned chunks that may wait for a writer.
+    - chunk_size: Number of CSV rows per chunk.
+
+    Returns:
+    - Number of rows in the main table after the merge.
+    """
+    prepare_tables(db_params, main_table, staging_table)
+
+    with stage('async.staging') as record:
+        record['rows_out'] = asyncio.run(stage_file(csv_file_path, db_params, staging_table, writers, queue_size, chunk_size))
+
+    # Deduplicate across chunks and merge into the main table, then update the summaries
+    # and the engagement rollups of the days the batch changed
+    _, days = merge_staging(db_params, main_table, staging_table)
+    with pooled_connection(db_params) as conn:
+        with stage('async.summaries'), transaction(conn) as cur:
+            update_summaries(cur, batch_rows_sql(main_table, staging_table))
+            cur.execute(f"DROP TABLE {staging_table};")
+        with stage('async.engagement'):
+            replace_staged_rollups(conn, main_table, days)
+
+        with transaction(conn) as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {main_table}")
+            row_count = cur.fetchone()[0]
+    print(f"Number of unique records in {main_table}: {row_count}")
+    return row_count
+
+if __name__ == '__main__':
+    ingest_file(csv_file_path, db_params)
+    print(f"Connection pool usage: {pool_stats(db_params)}")
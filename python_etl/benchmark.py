@@ -0,0 +1,376 @@
+import argparse
+import importlib
+import json
+import os
+import subprocess
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from dedup import dedup_frame
+from metrics import stage
+from schema import TIMESTAMP_FORMAT, csv_read_options
+from sinks import open_sink
+from summaries import SUMMARY_TABLES
+from timestamps import clear_cache, parse_timestamps
+
+# Dataset sizes by name; any other row count can be passed with --rows
+SIZES = {'10k': 10_000, '1m': 1_000_000, '50m': 50_000_000}
+
+# Generated datasets are kept here and reused while the generator settings are the same
+DEFAULT_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_data')
+DEFAULT_RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_results.json')
+
+# Pipelines whose prepare_data can be benchmarked, with the read options each one uses.
+# Only etl_with_null_data_source reads Iduser as text and repairs malformed rows
+PIPELINES = {
+    'etl3': lambda: csv_read_options(),
+    'etl_with_null_data_source': lambda: csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\'),
+}
+
+# Row each pipeline keeps per dedup key on a full reload; etl_with_null_data_source keeps every row
+PIPELINE_KEEP = {
+    'etl3': 'latest',
+    'etl_with_null_data_source': None,
+}
+
+# Tables written by the database stages: the main table is dropped and rebuilt, and the
+# summaries go to tables of this prefix, so the pipelines' own tables are never touched
+bench_table = 'usb_benchmark'
+bench_summary_prefix = 'benchmark_'
+
+# Value pools of the synthetic data, shaped like the sample files
+CSV_HEADER = 'Iduser,start watching,Device Id,Province,City,Content Name,Playing Time Millisecond,Device Type,Content Type'
+PROVINCES = {
+    'east java': ['surabaya', 'malang', 'jember', 'sidoarjo'],
+    'west java': ['bandung', 'bekasi', 'bogor', 'depok'],
+    'central java': ['semarang', 'banyumas', 'surakarta'],
+    'yogyakarta': ['yogyakarta', 'sleman'],
+    'east kalimantan': ['samarinda', 'balikpapan'],
+    'aceh': ['banda aceh', 'lhokseumawe'],
+    'bali': ['denpasar', 'badung'],
+    'north sumatra': ['medan'],
+    'dki jakarta': ['jakarta selatan', 'jakarta barat', 'jakarta timur'],
+}
+DEVICE_TYPES = (['Android', 'iOS'], [0.98, 0.02])
+CONTENT_TYPES = (['Series', 'Channel Live', 'Movie', 'Catchup'], [0.58, 0.32, 0.09, 0.01])
+CONTENT_NAMES = 700
+FIRST_EVENT = pd.Timestamp('2023-04-25')
+EVENT_MINUTES = 60 * 24 * 60
+
+
+def _event_time_text(times):
+    # Same layout as the source files, without zero padding: 5/15/2023 9:47
+    return (times.dt.month.astype(str) + '/' + times.dt.day.astype(str) + '/' + times.dt.year.astype(str)
+            + ' ' + times.dt.hour.astype(str) + ':' + times.dt.minute.astype(str).str.zfill(2))
+
+
+def _random_text(rng, count, min_length, max_length):
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    return [''.join(rng.choice(letters, rng.integers(min_length, max_length + 1))) for _ in range(count)]
+
+
+def generate_chunk(rng, rows, content_names, duplicate_ratio=0.0, null_ratio=0.0, malformed_ratio=0.0):
+    """
+    Generate rows of synthetic user-behavior data as CSV lines.
+
+    Parameters:
+    - rng: numpy Generator.
+    - rows: Number of rows.
+    - content_names: Pool of content names to draw from.
+    - duplicate_ratio: Share of rows repeating the dedup key (user, device, content) of another row at another time.
+    - null_ratio: Share of empty values in every column.
+    - malformed_ratio: Share of rows written whole inside one quoted field, with a comma in the content name.
+
+    Returns:
+    - Series of CSV lines, without the header.
+    """
+    unique_rows = rows - int(rows * duplicate_ratio)
+    locations = [(province, city) for province, cities in PROVINCES.items() for city in cities]
+    location_index = rng.integers(0, len(locations), unique_rows)
+
+    data = pd.DataFrame({
+        'Iduser': rng.integers(10_000_000, 1_000_000_000, unique_rows).astype(str),
+        'Device Id': pd.Series(rng.integers(10_000_000, 4_300_000_000, unique_rows).astype(str))
+        + ':' + rng.integers(10_000_000, 4_300_000_000, unique_rows).astype(str)
+        + ':' + rng.integers(10_000_000, 4_300_000_000, unique_rows).astype(str)
+        + ':' + rng.integers(10 ** 13, 10 ** 16, unique_rows).astype(str),
+        'Province': [locations[i][0] for i in location_index],
+        'City': [locations[i][1] for i in location_index],
+        'Content Name': np.asarray(content_names, dtype=object)[rng.integers(0, len(content_names), unique_rows)],
+        'Playing Time Millisecond': rng.integers(200, 2_000_000, unique_rows).astype(str),
+        'Device Type': rng.choice(DEVICE_TYPES[0], unique_rows, p=DEVICE_TYPES[1]),
+        'Content Type': rng.choice(CONTENT_TYPES[0], unique_rows, p=CONTENT_TYPES[1]),
+    })
+
+    # Duplicates repeat an existing row with another start time, then all rows are shuffled
+    duplicates = data.iloc[rng.integers(0, unique_rows, rows - unique_rows)] if unique_rows else data.iloc[:0]
+    data = pd.concat([data, duplicates], ignore_index=True)
+    data = data.iloc[rng.permutation(rows)].reset_index(drop=True)
+    start_watching = FIRST_EVENT + pd.to_timedelta(rng.integers(0, EVENT_MINUTES, rows), unit='min')
+    data.insert(1, 'start watching', _event_time_text(pd.Series(start_watching)))
+
+    # Malformed rows hold a quoted content name with a comma, like ""LHEGANGSTER,THECOP,THEDEVI""
+    malformed = rng.random(rows) < malformed_ratio
+    data.loc[malformed, 'Content Name'] = '""' + data.loc[malformed, 'Content Name'] + ',' + data.loc[malformed, 'Content Name'] + '""'
+
+    # Blank out values; malformed rows are kept complete so they can still be repaired
+    for column in data.columns:
+        missing = (rng.random(rows) < null_ratio) & ~malformed
+        data.loc[missing, column] = ''
+
+    lines = data[data.columns[0]].str.cat([data[column] for column in data.columns[1:]], sep=',')
+    lines[malformed] = '"' + lines[malformed] + '"'
+    return lines
+
+
+def generate_dataset(csv_file_path, rows, duplicate_ratio=0.0, null_ratio=0.0, malformed_ratio=0.0, seed=0, chunk_rows=1_000_000):
+    """
+    Write a synthetic CSV with the schema of the sample files, chunk by chunk so
+    even 50M rows are generated in bounded memory.
+    Duplicates are drawn within each chunk.
+    """
+    rng = np.random.default_rng(seed)
+    content_names = _random_text(rng, CONTENT_NAMES, 6, 18)
+
+    start = time.perf_counter()
+    with open(csv_file_path + '.tmp', 'w', newline='') as f:
+        f.write(CSV_HEADER + '\n')
+        for offset in range(0, rows, chunk_rows):
+            lines = generate_chunk(rng, min(chunk_rows, rows - offset), content_names, duplicate_ratio, null_ratio, malformed_ratio)
+            f.write('\n'.join(lines) + '\n')
+    os.replace(csv_file_path + '.tmp', csv_file_path)
+    print(f"Generated {rows} rows into {csv_file_path} in {time.perf_counter() - start:.2f}s")
+
+
+def dataset_path(rows, duplicate_ratio, null_ratio, malformed_ratio, seed, data_dir=DEFAULT_DATA_DIR):
+    """
+    Path of the generated dataset for a set of generator settings.
+    """
+    name = f"user_behavior_{rows}_dup{duplicate_ratio}_null{null_ratio}_malformed{malformed_ratio}_seed{seed}.csv"
+    return os.path.join(data_dir, name)
+
+
+@contextmanager
+def measure_stage(results, name, rows_in=None):
+    """
+    Measure one benchmark stage with metrics.stage and keep its record in results.
+    The block sets record['rows_out']; it defaults to rows_in.
+    """
+    with stage(f'benchmark.{name}', rows_in) as record:
+        yield record
+    results.append(dict(record, stage=name))
+    peak = f"{record['peak_rss_bytes'] / 2 ** 20:,.0f} MiB" if record['peak_rss_bytes'] else 'n/a'
+    rows_text = f"{record['rows_out']}" if record['rows_in'] is None else f"{record['rows_in']} -> {record['rows_out']}"
+    print(f"{name}: {record['seconds']:.2f}s, {rows_text} rows, peak RSS {peak}, DB {record['db_seconds']:.2f}s")
+
+
+def run_benchmark(csv_file_path, pipeline='etl3', db_params=None, dedup='memory'):
+    """
+    Run every stage of a pipeline on one file and measure each one.
+
+    Parameters:
+    - csv_file_path: Source CSV file.
+    - pipeline: Name of the ETL module whose prepare_data is used (see PIPELINES).
+    - db_params: Parameters of the sink to load into (see sinks.open_sink), or None to skip
+      the load and summary stages.
+    - dedup: 'memory' deduplicates in-process before a direct load, as a full reload does;
+      'sql' loads a staging table and merges it with the ROW_NUMBER dedup, as streamed loads do.
+      Either follows the pipeline's own dedup (see PIPELINE_KEEP); a pipeline keeping every
+      row has no in-process dedup stage.
+
+    Returns:
+    - List of stage records from metrics.stage: seconds, rows in and out, rows dropped per rule,
+      rows_per_second, peak_rss_bytes and db_seconds.
+    """
+    module = importlib.import_module(pipeline)
+    results = []
+
+    with measure_stage(results, 'read') as record:
+        data = pd.read_csv(csv_file_path, **PIPELINES[pipeline]())
+        record['rows_out'] = len(data)
+
+    with measure_stage(results, 'prepare_data', len(data)) as record:
+        data = module.prepare_data(data, module.column_mapping)
+        record['rows_out'] = len(data)
+
+    keep = PIPELINE_KEEP[pipeline]
+    if dedup == 'memory' and keep is not None:
+        with measure_stage(results, 'dedup', len(data)) as record:
+            data = dedup_frame(data, 'start_watching', keep=keep)
+            record['rows_out'] = len(data)
+
+    if db_params is None:
+        return results
+
+    with open_sink(db_params) as sink:
+        sink.drop(bench_table)
+        sink.prepare(bench_table, module.table_columns)
+
+        with measure_stage(results, 'encode', len(data)) as record:
+            data = sink.encode(data)
+
+        with measure_stage(results, 'load', len(data)) as record:
+            record['rows_out'] = loaded_rows = sink.load(data, bench_table, module.frame_columns, module.table_columns, direct=dedup == 'memory')
+
+        if dedup == 'sql':
+            with measure_stage(results, 'dedup', loaded_rows) as record:
+                record['rows_out'] = loaded_rows = sink.merge(bench_table, module.table_columns, keep=keep)
+
+        with measure_stage(results, 'summaries', loaded_rows) as record:
+            sink.update_summaries(bench_table, prefix=bench_summary_prefix)
+            record['rows_out'] = sum(len(sink.summary_rows(summary_table, prefix=bench_summary_prefix)) for summary_table in SUMMARY_TABLES)
+
+    return results
+
+
+def benchmark_timestamps(csv_file_path):
+    """
+    Time the ways 'start watching' has been parsed against timestamps.parse_timestamps,
+    on the column of one file. The read_csv entries include reading the column.
+
+    Returns:
+    - List of {'parser', 'seconds', 'rows_per_second', 'invalid', 'matches'} records; invalid counts
+      values present but not parsed, matches is True when the timestamps equal those of
+      pd.to_datetime with the known format.
+    """
+    raw = pd.read_csv(csv_file_path, dtype=str)
+    text = raw['start watching']
+    categorical = text.astype('category')
+    reference = pd.to_datetime(text, format=TIMESTAMP_FORMAT, errors='coerce')
+
+    def read_column(**read_csv_kwargs):
+        return pd.read_csv(csv_file_path, usecols=['start watching'], **read_csv_kwargs)['start watching']
+
+    parsers = [
+        ('read_csv parse_dates', True, lambda: read_column(parse_dates=['start watching'], date_format=TIMESTAMP_FORMAT)),
+        ('read_csv category + parse_timestamps', True, lambda: parse_timestamps(read_column(dtype='category'))[0]),
+        ('to_datetime inferred', True, lambda: pd.to_datetime(text, errors='coerce')),
+        ('to_datetime format', True, lambda: pd.to_datetime(text, format=TIMESTAMP_FORMAT, errors='coerce')),
+        ('apply over every column', True, lambda: raw.apply(
+            lambda col: pd.to_datetime(col, format=TIMESTAMP_FORMAT, errors='coerce') if col.name == 'start watching' else col
+        )['start watching']),
+        ('parse_timestamps object', True, lambda: parse_timestamps(text)[0]),
+        ('parse_timestamps categorical', True, lambda: parse_timestamps(categorical)[0]),
+        # A later streamed chunk finds most of its minutes already parsed
+        ('parse_timestamps cached', False, lambda: parse_timestamps(text)[0]),
+    ]
+
+    results = []
+    for name, cold, parse in parsers:
+        if cold:
+            clear_cache()
+        start = time.perf_counter()
+        parsed = parse()
+        seconds = time.perf_counter() - start
+
+        parsed = pd.to_datetime(parsed, errors='coerce').reset_index(drop=True)
+        result = {
+            'parser': name,
+            'seconds': seconds,
+            'rows_per_second': len(text) / seconds if seconds > 0 else None,
+            'invalid': int((parsed.isna() & text.notna()).sum()),
+            'matches': bool(parsed.equals(reference)),
+        }
+        results.append(result)
+        print(f"{name}: {seconds:.3f}s, {result['invalid']} invalid, {'same' if result['matches'] else 'different'} timestamps")
+    return results
+
+
+def current_commit():
+    """
+    Commit hash of the working tree, or None outside a git checkout.
+    """
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results_file, run):
+    """
+    Append one run to the JSON results file, a list of runs that can be compared across commits.
+    """
+    runs = []
+    if os.path.exists(results_file):
+        with open(results_file) as f:
+            runs = json.load(f)
+    runs.append(run)
+    with open(results_file + '.tmp', 'w') as f:
+        json.dump(runs, f, indent=2)
+    os.replace(results_file + '.tmp', results_file)
+    print(f"Saved results to {results_file}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the user-behavior ETL stages on synthetic data.')
+    parser.add_argument('--size', choices=SIZES, default='10k', help='Named dataset size.')
+    parser.add_argument('--rows', type=int, help='Row count, overriding --size.')
+    parser.add_argument('--duplicate-ratio', type=float, default=0.1)
+    parser.add_argument('--null-ratio', type=float, default=0.01)
+    parser.add_argument('--malformed-ratio', type=float, default=0.0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--csv', help='Benchmark an existing CSV instead of generating one.')
+    parser.add_argument('--pipeline', choices=PIPELINES, default='etl3')
+    parser.add_argument('--dedup', choices=['memory', 'sql'], default='memory')
+    parser.add_argument('--dsn', help='libpq connection string of the PostgreSQL database to load into.')
+    parser.add_argument('--local-sink', choices=['duckdb', 'sqlite'], help='Load into an embedded database file instead of PostgreSQL.')
+    parser.add_argument('--local-database', default=':memory:', help='File of the embedded database.')
+    parser.add_argument('--timestamps', action='store_true', help="Benchmark the parsers of the 'start watching' column instead of the ETL stages.")
+    parser.add_argument('--data-dir', default=DEFAULT_DATA_DIR)
+    parser.add_argument('--results', default=DEFAULT_RESULTS_FILE)
+    args = parser.parse_args(argv)
+    if args.malformed_ratio and args.pipeline != 'etl_with_null_data_source' and not args.timestamps:
+        parser.error(f"--malformed-ratio needs --pipeline etl_with_null_data_source; {args.pipeline} does not read malformed rows")
+
+    rows = args.rows or SIZES[args.size]
+    csv_file_path = args.csv
+    if csv_file_path is None:
+        csv_file_path = dataset_path(rows, args.duplicate_ratio, args.null_ratio, args.malformed_ratio, args.seed, args.data_dir)
+        if not os.path.exists(csv_file_path):
+            os.makedirs(args.data_dir, exist_ok=True)
+            generate_dataset(csv_file_path, rows, args.duplicate_ratio, args.null_ratio, args.malformed_ratio, args.seed)
+
+    start = time.perf_counter()
+    if args.timestamps:
+        parsers = benchmark_timestamps(csv_file_path)
+    else:
+        # Without --dsn or --local-sink only the in-process stages run
+        if args.dsn:
+            db_params = {'dsn': args.dsn}
+        elif args.local_sink:
+            db_params = {'engine': args.local_sink, 'database': args.local_database}
+        else:
+            db_params = None
+        stages = run_benchmark(csv_file_path, args.pipeline, db_params, args.dedup)
+    run = {
+        'commit': current_commit(),
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'benchmark': 'timestamps' if args.timestamps else 'stages',
+        'pipeline': None if args.timestamps else args.pipeline,
+        'dedup': None if args.timestamps else args.dedup,
+        'sink': None if args.timestamps else ('postgres' if args.dsn else args.local_sink),
+        'source': csv_file_path,
+        'rows': None if args.csv else rows,
+        'duplicate_ratio': None if args.csv else args.duplicate_ratio,
+        'null_ratio': None if args.csv else args.null_ratio,
+        'malformed_ratio': None if args.csv else args.malformed_ratio,
+        'seed': None if args.csv else args.seed,
+        'total_seconds': time.perf_counter() - start,
+    }
+    if args.timestamps:
+        run['parsers'] = parsers
+    else:
+        run['stages'] = stages
+    save_results(args.results, run)
+    return run
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import io
+import os
+import time
+
+import pandas as pd
+
+# Number of DataFrame rows serialized into each in-memory COPY buffer
+DEFAULT_CHUNK_SIZE = 50000
+
+# Target size of one chunk of the source file; every chunk ends on a line break
+DEFAULT_CHUNK_BYTES = 64 * 1024 * 1024
+
+
+def _prepare_chunk(chunk):
+    """
+    Make a chunk safe for COPY ... FORMAT csv.
+    Float columns holding only whole numbers (e.g. user_id after fillna(0))
+    are written as integers so they load into INT columns.
+    """
+    for name in chunk.columns:
+        col = chunk[name]
+        if pd.api.types.is_float_dtype(col.dtype):
+            values = col.dropna()
+            if (values % 1 == 0).all():
+                chunk[name] = col.astype('Int64')
+    return chunk
+
+
+def copy_dataframe(cur, data, table, columns, table_columns=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Bulk load a DataFrame into PostgreSQL with COPY FROM STDIN.
+
+    Parameters:
+    - cur: Open psycopg2 cursor. The caller owns the transaction.
+    - data: DataFrame with the cleaned rows.
+    - table: Target table name.
+    - columns: DataFrame columns to load, in order.
+    - table_columns: Matching target table columns (defaults to columns).
+    - chunk_size: Number of rows serialized per in-memory CSV buffer.
+
+    Returns:
+    - Number of rows loaded.
+    """
+    table_columns = table_columns or columns
+    copy_sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv)".format(table, ", ".join(table_columns))
+
+    start = time.perf_counter()
+    row_count = 0
+    for offset in range(0, len(data), chunk_size):
+        chunk = _prepare_chunk(data.iloc[offset:offset + chunk_size][columns].copy())
+
+        # Serialize the chunk to CSV in memory; NaN/None become empty fields, which COPY reads as NULL
+        buffer = io.StringIO()
+        chunk.to_csv(buffer, header=False, index=False, date_format='%Y-%m-%d %H:%M:%S')
+        buffer.seek(0)
+
+        cur.copy_expert(copy_sql, buffer)
+        row_count += len(chunk)
+
+    elapsed = time.perf_counter() - start
+    rate = row_count / elapsed if elapsed > 0 else float('inf')
+    print(f"Loaded {row_count} rows into {table} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+    return row_count
+
+
+def read_csv_chunks(csv_file_path, prepare, chunk_size=DEFAULT_CHUNK_SIZE, **read_csv_kwargs):
+    """
+    Stream a CSV file in fixed-size chunks, cleaning each chunk as it is read.
+
+    Parameters:
+    - csv_file_path: Path to the source CSV file.
+    - prepare: Function that takes a raw chunk and returns the cleaned chunk.
+    - chunk_size: Number of CSV rows per chunk.
+    - read_csv_kwargs: Extra arguments passed to pd.read_csv.
+
+    Yields:
+    - Cleaned DataFrame chunks, so only one chunk is held in memory at a time.
+    """
+    for chunk in pd.read_csv(csv_file_path, chunksize=chunk_size, **read_csv_kwargs):
+        yield prepare(chunk)
+
+
+def plan_chunks(csv_file_path, chunk_bytes=DEFAULT_CHUNK_BYTES, start=None):
+    """
+    Split a CSV file into byte ranges of about chunk_bytes without parsing it.
+    Only the line at each boundary is read, so planning costs the same for any file size.
+    Rows must not hold quoted line breaks (the user-behavior extracts do not).
+
+    Parameters:
+    - csv_file_path: Path to the source CSV file.
+    - chunk_bytes: Target size of a chunk.
+    - start: Byte offset of a line start to plan from, e.g. to resume a load; None
+      starts after the header line.
+
+    Returns:
+    - List of chunk references {'path', 'index', 'start', 'end'}; the header line belongs to no chunk.
+    """
+    size = os.path.getsize(csv_file_path)
+    chunks = []
+    with open(csv_file_path, 'rb') as f:
+        f.readline()
+        start = f.tell() if start is None else start
+        while start < size:
+            # Move the boundary to the end of the line it falls in
+            f.seek(min(start + chunk_bytes, size))
+            f.readline()
+            end = f.tell()
+            chunks.append({'path': csv_file_path, 'index': len(chunks), 'start': start, 'end': end})
+            start = end
+    return chunks
+
+
+def read_chunk(chunk, **read_csv_kwargs):
+    """
+    Parse the rows of one chunk reference, with the header line of its file.
+    """
+    with open(chunk['path'], 'rb') as f:
+        header = f.readline()
+        f.seek(chunk['start'])
+        body = f.read(chunk['end'] - chunk['start'])
+    return pd.read_csv(io.BytesIO(header + body), **read_csv_kwargs)
+
+
+def copy_chunks(conn, cur, chunks, table, columns, table_columns=None, checkpoint=None):
+    """
+    Load a DataFrame, or an iterable of DataFrame chunks, with COPY.
+    Each chunk is committed as soon as it is loaded, so the first rows land
+    in PostgreSQL while the rest of the file is still being read. With a
+    checkpoint (see checkpoints.ChunkCheckpoint) every chunk is committed
+    together with the checkpoint row of the source read so far.
+
+    Returns:
+    - Total number of rows loaded.
+    """
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+
+    start = time.perf_counter()
+    row_count = 0
+    for chunk in chunks:
+        loaded = copy_dataframe(cur, chunk, table, columns, table_columns)
+        if checkpoint is not None:
+            checkpoint.record(cur, loaded)
+        conn.commit()
+        row_count += loaded
+
+    elapsed = time.perf_counter() - start
+    rate = row_count / elapsed if elapsed > 0 else float('inf')
+    print(f"Loaded {row_count} rows into {table} in total in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+    return row_count
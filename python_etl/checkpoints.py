@@ -0,0 +1,152 @@
+import hashlib
+
+import pandas as pd
+
+from bulk_load import DEFAULT_CHUNK_BYTES, plan_chunks, read_chunk
+from incremental import file_fingerprint
+from quarantine import record_counts
+
+# Table recording, per source file and target table, every chunk a resumable load committed
+# and the staging table holding it
+CHECKPOINT_TABLE = 'load_checkpoints'
+
+
+def ensure_checkpoint_table(cur):
+    """
+    Create the checkpoint table if it does not exist yet. A chunk can be recorded only
+    once per source and table, so two attempts never both commit the same chunk.
+    """
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE} (
+        source VARCHAR(1024),
+        target_table VARCHAR(255),
+        file_fingerprint VARCHAR(64),
+        staging_table VARCHAR(255),
+        chunk_index INT,
+        byte_offset BIGINT,
+        source_rows BIGINT,
+        row_count BIGINT,
+        committed_at TIMESTAMP,
+        PRIMARY KEY (source, target_table, chunk_index)
+    );
+    """)
+
+
+class ChunkCheckpoint:
+    """
+    Source of a resumable load: iterating reads a CSV file in byte ranges (see
+    bulk_load.plan_chunks) and cleans each as it is read. The sink commits every chunk
+    together with a checkpoint row holding the chunk index, the byte offset the file is
+    read to and the rows read so far, so a load that fails can start again at the first
+    chunk it did not commit. Each chunk must reach the sink before the next one is read,
+    as the lazy steps between them (dedup_rows, SeenIndex.filter_rows) do.
+    With a quarantine (see quarantine.Quarantine) receiving the rows prepare rejects, their
+    counts are recorded with the checkpoint of their chunk, so the counts of the chunks a
+    failed run committed are kept too.
+    """
+
+    def __init__(self, csv_file_path, prepare, chunk_bytes=DEFAULT_CHUNK_BYTES, quarantine=None, **read_csv_kwargs):
+        self.source = csv_file_path
+        self.prepare = prepare
+        self.chunk_bytes = chunk_bytes
+        self.quarantine = quarantine
+        self.read_csv_kwargs = read_csv_kwargs
+        self.table = None
+        self.fingerprint = None
+        # Last chunk read, the byte offset it ends at and the CSV rows read up to it
+        self.chunk_index = -1
+        self.offset = None
+        self.rows_read = 0
+        # Byte offset the committed chunks reach, None before the first
+        self.committed = None
+
+    def __iter__(self):
+        for chunk in plan_chunks(self.source, self.chunk_bytes, start=self.offset):
+            raw = read_chunk(chunk, **self.read_csv_kwargs)
+            # Rows are numbered from the start of the file, as when the file is read in one go
+            raw.index = pd.RangeIndex(self.rows_read, self.rows_read + len(raw))
+            self.chunk_index += 1
+            self.offset = chunk['end']
+            self.rows_read += len(raw)
+            yield self.prepare(raw)
+
+    def staging_table(self, table):
+        """
+        Name of the staging table of this file's load into a table. It is named after the
+        source file, so loads of other files into the same table never touch its chunks, and
+        it outlives the connection, so the chunks committed before a failure are still staged
+        when the load resumes.
+        """
+        return f"{table}_staging_{hashlib.sha1(self.source.encode()).hexdigest()[:12]}"
+
+    def resume(self, cur, table, staged=True, placeholder='%s'):
+        """
+        Continue after the last chunk committed into a table from this file, if any.
+        Checkpoints of another version of the file, or of chunks no longer staged in the
+        staging table of this file, are removed.
+
+        Parameters:
+        - cur: Open cursor; the caller commits.
+        - table: Main table the load goes to.
+        - staged: Whether the staging table of this file (see staging_table) still exists.
+        - placeholder: Parameter marker of the driver ('%s' for psycopg2, '?' for sqlite3 and DuckDB).
+
+        Returns:
+        - True when the load resumes, False when it starts at the beginning of the file.
+        """
+        self.table = table
+        if self.fingerprint is None:
+            self.fingerprint = file_fingerprint(self.source)
+        ensure_checkpoint_table(cur)
+        if not staged:
+            self.clear(cur, placeholder)
+            return False
+        cur.execute(
+            f"DELETE FROM {CHECKPOINT_TABLE} WHERE source = {placeholder} AND target_table = {placeholder} AND file_fingerprint <> {placeholder}",
+            (self.source, table, self.fingerprint)
+        )
+        cur.execute(
+            f"SELECT chunk_index, byte_offset, source_rows, staging_table FROM {CHECKPOINT_TABLE} "
+            f"WHERE source = {placeholder} AND target_table = {placeholder} ORDER BY chunk_index DESC LIMIT 1",
+            (self.source, table)
+        )
+        row = cur.fetchone()
+        if row is None:
+            return False
+        if row[3] != self.staging_table(table):
+            # The chunks were staged under another name; that table is not ours to reuse or drop
+            self.clear(cur, placeholder)
+            return False
+        self.chunk_index, self.offset, self.rows_read = (int(value) for value in row[:3])
+        self.committed = self.offset
+        print(f"Resuming the load of {self.source} into {table} after chunk {self.chunk_index} "
+              f"(byte {self.offset}, {self.rows_read} rows read).")
+        return True
+
+    def clear(self, cur, placeholder='%s'):
+        """
+        Remove the checkpoints of the load, once its staged rows are merged or discarded.
+        """
+        ensure_checkpoint_table(cur)
+        cur.execute(
+            f"DELETE FROM {CHECKPOINT_TABLE} WHERE source = {placeholder} AND target_table = {placeholder}",
+            (self.source, self.table)
+        )
+
+    def record(self, cur, row_count, placeholder='%s'):
+        """
+        Record the chunk read last as committed, with the quarantine counts of its rejected
+        rows. Call it in the transaction that loads the chunk.
+
+        Parameters:
+        - cur: Open cursor of the chunk's transaction.
+        - row_count: Number of rows of the chunk loaded.
+        """
+        cur.execute(
+            f"INSERT INTO {CHECKPOINT_TABLE} VALUES ({', '.join([placeholder] * 9)})",
+            (self.source, self.table, self.fingerprint, self.staging_table(self.table), self.chunk_index, self.offset, self.rows_read, row_count,
+             pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+        )
+        if self.quarantine is not None:
+            record_counts(cur, self.quarantine.count_rows(self.source, self.table), placeholder)
+        self.committed = self.offset
@@ -0,0 +1,118 @@
+import os
+import re
+import shutil
+
+import pandas as pd
+
+from bulk_load import read_chunk
+from db import pooled_connection, transaction
+from dedup import dedup_frame
+from etl3 import column_mapping, prepare_data
+from incremental import merge_sql
+from metrics import stage
+from parallel_ingest import prepare_staging, replace_staged_rollups, stage_frame, table_columns
+from partitions import prepare_partitions, staged_periods
+from schema import csv_read_options
+from sinks import PostgresSink
+from summaries import batch_rows_sql, ensure_summary_tables, update_summaries
+
+
+def chunk_work_dir(base_dir, run_id):
+    """
+    Directory holding the cleaned chunks of one run, named after the run id.
+    """
+    return os.path.join(base_dir, re.sub(r'[^A-Za-z0-9_.-]', '_', run_id))
+
+
+def clean_chunk(chunk, work_dir):
+    """
+    Parse, clean and deduplicate one chunk and write it to a Parquet file, so the
+    loading step receives a file path instead of the rows.
+
+    Returns:
+    - Path of the Parquet file.
+    """
+    with stage('chunk.clean') as record:
+        data = prepare_data(read_chunk(chunk, **csv_read_options()), column_mapping)
+        data = dedup_frame(data, 'start_watching', keep='latest')
+
+        # Written under a temporary name, so a retried task never reads a truncated file
+        os.makedirs(work_dir, exist_ok=True)
+        parquet_path = os.path.join(work_dir, f"chunk_{chunk['index']:05d}.parquet")
+        data.to_parquet(parquet_path + '.tmp', index=False)
+        os.replace(parquet_path + '.tmp', parquet_path)
+        record['rows_out'] = len(data)
+    return parquet_path
+
+
+def load_chunk(parquet_path, db_params, staging_table):
+    """
+    COPY one cleaned chunk into the staging table.
+
+    Returns:
+    - Number of rows loaded.
+    """
+    with stage('chunk.load') as record:
+        row_count = stage_frame(pd.read_parquet(parquet_path), db_params, staging_table)
+        record['rows_out'] = row_count
+    return row_count
+
+
+def prepare_tables(db_params, main_table, staging_table):
+    """
+    Create the main, dimension and summary tables if needed and a fresh staging table.
+    """
+    with pooled_connection(db_params) as conn, transaction(conn) as cur:
+        prepare_staging(cur, main_table, staging_table)
+        ensure_summary_tables(cur)
+
+
+def merge_staging(db_params, main_table, staging_table):
+    """
+    Deduplicate the staged rows across chunks and merge them into the main table
+    on the dedup key, keeping the latest event of every key. Partitions for new
+    periods are created first.
+
+    Returns:
+    - (number of rows inserted or updated, days whose engagement rollups the batch changed)
+    """
+    with stage('chunk.merge') as record, pooled_connection(db_params) as conn:
+        # Taken before the merge, which replaces the rows of the batch's keys
+        days = PostgresSink(conn, staging_table).batch_days(main_table)
+        with transaction(conn) as cur:
+            prepare_partitions(cur, main_table, staged_periods(cur, staging_table))
+            cur.execute(merge_sql(main_table, staging_table, table_columns, keep='latest'))
+            record['rows_out'] = cur.rowcount
+    print(f"Merged {record['rows_out']} rows from {staging_table} into {main_table}")
+    return record['rows_out'], days
+
+
+def update_staged_summaries(db_params, main_table, staging_table, summary_table):
+    """
+    Add the users of the merged batch to one summary table. Memberships already
+    counted are skipped, so the step can be retried.
+    """
+    with stage(f'chunk.summaries.{summary_table}'), pooled_connection(db_params) as conn, transaction(conn) as cur:
+        update_summaries(cur, batch_rows_sql(main_table, staging_table), [summary_table])
+
+
+def update_staged_rollups(db_params, main_table, days):
+    """
+    Replace the daily engagement rollups of the days returned by merge_staging. The
+    rollups of those days are rebuilt from the main table, so the step can be retried.
+
+    Parameters:
+    - days: Days as Timestamps or ISO strings (as they come through XCom).
+    """
+    days = {pd.Timestamp(day) for day in days}
+    with stage('chunk.engagement'), pooled_connection(db_params) as conn:
+        replace_staged_rollups(conn, main_table, days)
+
+
+def drop_staging(db_params, staging_table, work_dir):
+    """
+    Drop the staging table and remove the cleaned chunk files of a run.
+    """
+    with pooled_connection(db_params) as conn, transaction(conn) as cur:
+        cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    shutil.rmtree(work_dir, ignore_errors=True)
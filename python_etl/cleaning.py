@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+
+from schema import fill_missing
+from timestamps import parse_timestamps
+
+# Fill values by column kind, as the former apply passes used them
+TEXT_FILL = 'unknown'
+NUMBER_FILL = 0
+TIMESTAMP_FILL = pd.Timestamp('1970-01-01')
+
+
+def fill_plan(dtypes):
+    """
+    Work out once, from the dtypes, which fill value every column gets.
+
+    Parameters:
+    - dtypes: Series of column dtypes (DataFrame.dtypes).
+
+    Returns:
+    - Dictionary of column name to fill value; columns of other kinds are left out.
+    """
+    plan = {}
+    for name, dtype in dtypes.items():
+        if dtype == 'object' or isinstance(dtype, pd.CategoricalDtype):
+            plan[name] = TEXT_FILL
+        elif pd.api.types.is_numeric_dtype(dtype):
+            plan[name] = NUMBER_FILL
+        elif pd.api.types.is_datetime64_any_dtype(dtype):
+            plan[name] = TIMESTAMP_FILL
+    return plan
+
+
+def _title(col):
+    # Title-case the categories rather than every row; categories equal after title-casing are merged
+    if isinstance(col.dtype, pd.CategoricalDtype) and len(col.cat.categories):
+        codes_map, titled = pd.factorize(col.cat.categories.str.title())
+        codes = col.cat.codes.to_numpy()
+        codes = np.where(codes < 0, -1, codes_map[codes])
+        return pd.Series(pd.Categorical.from_codes(codes, categories=titled), index=col.index, name=col.name)
+    return col.str.title()
+
+
+def _join(left, right, separator):
+    # Join two categoricals through their pairs of codes, so each distinct pair is built once
+    categorical = all(isinstance(col.dtype, pd.CategoricalDtype) and len(col.cat.categories) for col in (left, right))
+    if categorical:
+        left_codes = left.cat.codes.to_numpy().astype(np.int64)
+        right_codes = right.cat.codes.to_numpy().astype(np.int64)
+        width = len(right.cat.categories)
+        missing = (left_codes < 0) | (right_codes < 0)
+        pair_codes, pairs = pd.factorize(np.where(missing, 0, left_codes * width + right_codes))
+
+        labels = (np.asarray(left.cat.categories, dtype=object)[pairs // width] + separator
+                  + np.asarray(right.cat.categories, dtype=object)[pairs % width])
+        codes_map, categories = pd.factorize(labels)
+        codes = np.where(missing, -1, codes_map[pair_codes])
+        return pd.Series(pd.Categorical.from_codes(codes, categories=categories), index=left.index)
+    return left.astype(object) + separator + right.astype(object)
+
+
+def clean_frame(data, column_mapping, datetime_columns=(), title_columns=(), location=None, clip_columns=()):
+    """
+    Clean a DataFrame in one pass over its columns: rename, fill missing
+    values by dtype, parse timestamps, title-case, build 'location' and clip
+    negatives. Only columns that need a change are replaced, so the frame is
+    never copied as a whole.
+
+    Parameters:
+    - data: DataFrame as read from the CSV file. It is not modified.
+    - column_mapping: Mapping of original to cleaned column names.
+    - datetime_columns: Cleaned text columns parsed as timestamps (see timestamps.parse_timestamps);
+      missing and unparsable values get TIMESTAMP_FILL.
+    - title_columns: Cleaned text columns to title-case in place.
+    - location: Optional (left, right) pair of cleaned columns joined as 'Left, Right' into 'location'.
+    - clip_columns: Cleaned numeric columns whose negative values are raised to 0.
+
+    Returns:
+    - Cleaned DataFrame; values still missing after the fills are None.
+    """
+    # A shallow rename: the new frame shares the column arrays of the raw data
+    data = data.rename(columns=column_mapping, copy=False)
+
+    # Scanning object columns for missing values is the costly part, so each column is
+    # scanned once and the columns known to be complete are remembered
+    complete = set()
+    for name, value in fill_plan(data.dtypes).items():
+        if name in datetime_columns:
+            continue
+        col = data[name]
+        missing = col.isna()
+        if missing.any():
+            data[name] = fill_missing(col, value) if isinstance(col.dtype, pd.CategoricalDtype) else col.mask(missing, value)
+        complete.add(name)
+
+    for name in datetime_columns:
+        if name in data.columns:
+            data[name], invalid = parse_timestamps(data[name], fill=TIMESTAMP_FILL)
+            complete.add(name)
+            if invalid:
+                print(f"Warning: {invalid} invalid date formats detected in '{name}' column. Replaced with {TIMESTAMP_FILL}.")
+
+    if location and all(name in data.columns for name in location):
+        left, right = location
+        data['location'] = _join(_title(data[left]), _title(data[right]), ', ')
+
+    for name in title_columns:
+        if name in data.columns:
+            data[name] = _title(data[name])
+
+    for name in clip_columns:
+        if name in data.columns and (data[name] < 0).any():
+            data[name] = data[name].clip(lower=0)
+
+    # Replace remaining NaN values with None for database compatibility, only in the columns that have them
+    for name in data.columns:
+        col = data[name]
+        if name not in complete and col.hasnans:
+            data[name] = col.where(col.notna(), None)
+    return data
@@ -0,0 +1,203 @@
+import numpy as np
+import pandas as pd
+
+from sinks import open_sink
+
+# Dimensions of the cube; a cell holds the events of one combination of their values
+CUBE_DIMENSIONS = ['province', 'city', 'content_type', 'device_type', 'day']
+
+# Columns of the cube table. user_sketch is a HyperLogLog sketch of the cell's users,
+# which merges with the sketches of other cells into the distinct users of a slice
+CUBE_COLUMNS = {
+    'province': 'VARCHAR(255)',
+    'city': 'VARCHAR(255)',
+    'content_type': 'VARCHAR(255)',
+    'device_type': 'VARCHAR(255)',
+    'day': 'DATE',
+    'events': 'BIGINT',
+    'play_time_ms': 'BIGINT',
+    'user_sketch': 'BYTEA',
+}
+
+# The first SKETCH_PRECISION bits of a user's hash pick one of 2^SKETCH_PRECISION registers;
+# the other 53 bits are exact in a float64, which gives their bit length without a loop.
+# Distinct-user estimates are within about 2.3% (1.04 / sqrt(2048))
+SKETCH_PRECISION = 11
+SKETCH_REGISTERS = 1 << SKETCH_PRECISION
+
+
+def user_hashes(user_ids):
+    """
+    Hash user ids to 64 bits. Ids are hashed as float64, so int and float columns of the same ids agree.
+    """
+    return pd.util.hash_array(pd.to_numeric(user_ids).to_numpy('float64'))
+
+
+def sketch_entries(hashes):
+    """
+    Return the register and rank of every hash: the register is the first SKETCH_PRECISION
+    bits, the rank the position of the first 1 bit in the rest.
+    """
+    registers = (hashes >> np.uint64(64 - SKETCH_PRECISION)).astype(np.int64)
+    rest = hashes & np.uint64((1 << (64 - SKETCH_PRECISION)) - 1)
+    _, bit_length = np.frexp(rest.astype(np.float64))
+    ranks = (64 - SKETCH_PRECISION) - bit_length + 1
+    return registers, ranks.astype(np.uint8)
+
+
+def encode_sketch(registers, ranks):
+    """
+    Serialize the non-empty registers of one sketch: their positions and ranks while
+    few are set, otherwise every register.
+    """
+    if len(registers) * 3 < SKETCH_REGISTERS:
+        return b'S' + registers.astype('<u2').tobytes() + ranks.astype(np.uint8).tobytes()
+    dense = np.zeros(SKETCH_REGISTERS, dtype=np.uint8)
+    dense[registers] = ranks
+    return b'D' + dense.tobytes()
+
+
+def decode_sketch(sketch):
+    """
+    Return the (registers, ranks) of the non-empty registers of a serialized sketch.
+    """
+    sketch = bytes(sketch)
+    if sketch[:1] == b'D':
+        dense = np.frombuffer(sketch, dtype=np.uint8, offset=1)
+        registers = np.flatnonzero(dense)
+        return registers, dense[registers]
+    count = (len(sketch) - 1) // 3
+    registers = np.frombuffer(sketch, dtype='<u2', count=count, offset=1).astype(np.int64)
+    return registers, np.frombuffer(sketch, dtype=np.uint8, offset=1 + 2 * count)
+
+
+def _max_ranks(groups, registers, ranks):
+    # Highest rank per (group, register), the merge of HyperLogLog sketches; sorted by group
+    keys = groups.astype(np.int64) * SKETCH_REGISTERS + registers
+    merged = pd.Series(ranks).groupby(keys).max()
+    keys = merged.index.to_numpy()
+    return keys // SKETCH_REGISTERS, keys % SKETCH_REGISTERS, merged.to_numpy(np.uint8)
+
+
+def estimate_counts(groups, ranks, group_count):
+    """
+    HyperLogLog estimate of the distinct users of every group from its merged registers,
+    with linear counting while many registers are empty.
+
+    Parameters:
+    - groups: Group of every non-empty register.
+    - ranks: Rank of every non-empty register.
+    - group_count: Number of groups.
+
+    Returns:
+    - numpy float64 array of estimates.
+    """
+    m = SKETCH_REGISTERS
+    filled = np.bincount(groups, minlength=group_count)
+    empty = m - filled
+    harmonic = np.bincount(groups, weights=np.ldexp(1.0, -ranks.astype(np.int64)), minlength=group_count) + empty
+    raw = 0.7213 / (1 + 1.079 / m) * m * m / harmonic
+    with np.errstate(divide='ignore'):
+        linear = m * np.log(m / np.maximum(empty, 1))
+    return np.where((raw <= 2.5 * m) & (empty > 0), linear, raw)
+
+
+def build_cube(events, time_column='start_watching'):
+    """
+    Aggregate events into cube cells, one per combination of CUBE_DIMENSIONS values with
+    events: their count, total play time and a sketch of their users. Missing dimension
+    values form cells of their own.
+
+    Returns:
+    - DataFrame with the columns of CUBE_COLUMNS.
+    """
+    frame = pd.DataFrame({name: events[name] for name in CUBE_DIMENSIONS if name != 'day'})
+    frame['day'] = pd.to_datetime(events[time_column]).dt.date
+    frame['play_time_ms'] = events['play_time_ms'].astype('float64')
+
+    # One pass over the codes of the dimension columns gives the cell of every event
+    grouped = frame.groupby(CUBE_DIMENSIONS, dropna=False, observed=True)
+    cells = grouped.agg(events=('play_time_ms', 'size'), play_time_ms=('play_time_ms', 'sum')).reset_index()
+    cells['play_time_ms'] = cells['play_time_ms'].astype('int64')
+    cell = grouped.ngroup().to_numpy()
+
+    known = events['user_id'].notna().to_numpy()
+    registers, ranks = sketch_entries(user_hashes(events['user_id'][known]))
+    cell, registers, ranks = _max_ranks(cell[known], registers, ranks)
+    bounds = np.searchsorted(cell, np.arange(len(cells) + 1))
+    cells['user_sketch'] = [
+        encode_sketch(registers[start:end], ranks[start:end]) for start, end in zip(bounds[:-1], bounds[1:])
+    ]
+    return cells[list(CUBE_COLUMNS)]
+
+
+class EventCube:
+    """
+    Cube cells held in memory for slice and dice queries. The sketch registers of every
+    cell are decoded once, so a query only filters cells, sums their measures and merges
+    their registers, without reading the fact table.
+    """
+
+    def __init__(self, cells):
+        self.cells = cells.reset_index(drop=True)
+        self.cells['day'] = pd.to_datetime(self.cells['day'])
+        decoded = [decode_sketch(sketch) for sketch in self.cells['user_sketch']]
+        self.entry_cells = np.repeat(np.arange(len(decoded)), [len(registers) for registers, _ in decoded])
+        self.registers = np.concatenate([np.empty(0, dtype=np.int64)] + [registers for registers, _ in decoded])
+        self.ranks = np.concatenate([np.empty(0, dtype=np.uint8)] + [ranks for _, ranks in decoded])
+
+    def query(self, by=(), **filters):
+        """
+        Answer a slice and dice request.
+
+        Parameters:
+        - by: Dimensions to group the result by; none gives one total row.
+        - filters: Dimension name to a value, a list of values, or for day a
+          slice(start, end) of dates (both ends included).
+
+        Returns:
+        - DataFrame with the by columns, events, play_time_ms and users (estimated distinct users).
+        """
+        by = list(by)
+        mask = np.ones(len(self.cells), dtype=bool)
+        for name, value in filters.items():
+            col = self.cells[name]
+            if isinstance(value, slice):
+                if value.start is not None:
+                    mask &= (col >= pd.Timestamp(value.start)).to_numpy()
+                if value.stop is not None:
+                    mask &= (col <= pd.Timestamp(value.stop)).to_numpy()
+            elif isinstance(value, (list, tuple, set)):
+                mask &= col.isin(list(value)).to_numpy()
+            else:
+                mask &= (col == (pd.Timestamp(value) if name == 'day' else value)).to_numpy()
+
+        cells = self.cells[mask]
+        if by:
+            grouped = cells.groupby(by, dropna=False, sort=True)
+            result = grouped[['events', 'play_time_ms']].sum().reset_index()
+            group = grouped.ngroup().to_numpy()
+        else:
+            result = pd.DataFrame({'events': [cells['events'].sum()], 'play_time_ms': [cells['play_time_ms'].sum()]})
+            group = np.zeros(len(cells), dtype=np.int64)
+
+        # Group of every selected cell, then the merged registers of every group
+        cell_group = np.full(len(self.cells), -1, dtype=np.int64)
+        cell_group[np.flatnonzero(mask)] = group
+        entry_group = cell_group[self.entry_cells]
+        selected = entry_group >= 0
+        groups, _, ranks = _max_ranks(entry_group[selected], self.registers[selected], self.ranks[selected])
+        result['users'] = np.round(estimate_counts(groups, ranks, len(result))).astype('int64')
+        return result
+
+
+def load_cube(db_params, table='usb3_cube'):
+    """
+    Read a cube table into an EventCube.
+
+    Parameters:
+    - db_params: Parameters of the sink the ETL loads into (see sinks.open_sink).
+    - table: Cube table.
+    """
+    with open_sink(db_params) as sink:
+        return EventCube(sink.read_table(table))
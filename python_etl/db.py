@@ -0,0 +1,157 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import extensions, pool
+
+from metrics import record_db_time
+
+# Connection pools keyed by connection parameters, one set per process, with a semaphore
+# of maxconn slots each: getconn raises PoolError when the pool is exhausted, so
+# borrowers take a slot first and wait there for a connection to be given back
+_pools = {}
+_slots = {}
+_stats = {}
+_lock = threading.Lock()
+
+
+class TimedCursor(extensions.cursor):
+    """
+    Cursor that reports the time spent in statements and COPY to the active metrics stages.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_db_time(time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_db_time(time.perf_counter() - start)
+
+
+class TimedConnection(extensions.connection):
+    """
+    Connection that reports the time spent committing to the active metrics stages.
+    """
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            record_db_time(time.perf_counter() - start)
+
+
+def _pool_key(db_params):
+    return (os.getpid(),) + tuple(sorted(db_params.items()))
+
+
+def get_pool(db_params, minconn=1, maxconn=8):
+    """
+    Return the connection pool for db_params, creating it on first use.
+    Pools are per process, so a forked worker never reuses its parent's sockets.
+    """
+    key = _pool_key(db_params)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = pool.ThreadedConnectionPool(
+                minconn, maxconn, connection_factory=TimedConnection, cursor_factory=TimedCursor, **db_params
+            )
+            _slots[key] = threading.BoundedSemaphore(maxconn)
+            _stats[key] = {'checkouts': 0, 'in_use': 0, 'peak_in_use': 0, 'wait_seconds': 0.0}
+        return _pools[key]
+
+
+@contextmanager
+def pooled_connection(db_params):
+    """
+    Borrow a warm connection from the pool and give it back on exit. When every
+    connection is in use, wait until one is given back.
+    Uncommitted work is rolled back and temporary tables are dropped before
+    the connection is returned, so the next borrower starts clean.
+    """
+    connection_pool = get_pool(db_params)
+    key = _pool_key(db_params)
+    slots, stats = _slots[key], _stats[key]
+
+    start = time.perf_counter()
+    slots.acquire()
+    try:
+        conn = connection_pool.getconn()
+    except Exception:
+        slots.release()
+        raise
+    with _lock:
+        stats['checkouts'] += 1
+        stats['in_use'] += 1
+        stats['peak_in_use'] = max(stats['peak_in_use'], stats['in_use'])
+        stats['wait_seconds'] += time.perf_counter() - start
+
+    try:
+        yield conn
+    finally:
+        broken = bool(conn.closed)
+        if not broken:
+            try:
+                conn.rollback()
+                with conn.cursor() as cur:
+                    cur.execute("DISCARD TEMP;")
+                conn.commit()
+            except Exception:
+                broken = True
+        connection_pool.putconn(conn, close=broken)
+        with _lock:
+            stats['in_use'] -= 1
+        slots.release()
+
+
+@contextmanager
+def transaction(conn):
+    """
+    Run a block as one transaction: commit on success, roll back on error.
+    Yields a cursor that is closed when the block ends.
+    """
+    try:
+        with conn.cursor() as cur:
+            yield cur
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def pool_stats(db_params):
+    """
+    Return usage statistics of the pool for db_params: size limits, open idle
+    connections, connections in use and at peak, checkouts and time spent waiting
+    for a free connection.
+    """
+    key = _pool_key(db_params)
+    if key not in _pools:
+        return {}
+    connection_pool = _pools[key]
+    with _lock:
+        return {
+            'minconn': connection_pool.minconn,
+            'maxconn': connection_pool.maxconn,
+            'idle': len(connection_pool._pool),
+            **_stats[key],
+        }
+
+
+def close_pools():
+    """
+    Close every connection pool opened by this process.
+    """
+    with _lock:
+        for key in [key for key in _pools if key[0] == os.getpid()]:
+            _pools.pop(key).closeall()
+            _slots.pop(key)
+            _stats.pop(key)
@@ -0,0 +1,49 @@
+import numpy as np
+import pandas as pd
+
+from incremental import DEDUP_KEY
+from metrics import dropped, instrumented
+
+
+@instrumented('dedup')
+def dedup_frame(data, time_column, keep='latest', key=DEDUP_KEY):
+    """
+    Keep one row per dedup key, choosing the same winner as the SQL dedup:
+    ROW_NUMBER() OVER (PARTITION BY key ORDER BY event_time [DESC]) = 1.
+
+    Parameters:
+    - data: DataFrame to deduplicate.
+    - time_column: Column holding the event time.
+    - keep: 'latest' matches ORDER BY event_time DESC, 'first' matches ORDER BY event_time.
+    - key: Columns identifying a duplicate. NULL keys form one group, as in PARTITION BY.
+
+    Returns:
+    - DataFrame with the winning rows, in their original order.
+    """
+    if data.empty:
+        return data
+
+    # PostgreSQL sorts NULL event times as the largest value: they win under DESC and lose under ASC
+    times = pd.to_datetime(data[time_column])
+    ranks = pd.Series(
+        np.where(times.isna(), np.iinfo(np.int64).max, times.to_numpy('datetime64[ns]').view('int64')),
+        index=data.index
+    )
+
+    # One hash aggregation finds the winning time per key; ties keep the first row seen
+    groups = ranks.groupby([data[k] for k in key], dropna=False, sort=False)
+    best = groups.transform('max' if keep == 'latest' else 'min')
+    winners = data[ranks == best].drop_duplicates(subset=key, keep='first')
+    dropped('duplicate_key', len(data) - len(winners))
+    return winners
+
+
+def dedup_rows(data, time_column, keep='latest'):
+    """
+    Deduplicate a DataFrame, or lazily each chunk of an iterable of DataFrames.
+    Chunks are only deduplicated within themselves; the SQL dedup still
+    resolves duplicates that span chunks.
+    """
+    if isinstance(data, pd.DataFrame):
+        return dedup_frame(data, time_column, keep)
+    return (dedup_frame(chunk, time_column, keep) for chunk in data)
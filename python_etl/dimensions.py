@@ -0,0 +1,139 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from db import transaction
+from metrics import stage
+
+# Low-cardinality columns of the event rows. Each value is stored once in dim_<name>
+# and the event rows hold its integer surrogate key in <name>_id
+DIMENSIONS = ['content_type', 'device_type', 'province', 'city', 'location']
+
+# Keys already known to this process, per database, so repeated values never go to the database
+_caches = {}
+
+
+def key_column(dimension):
+    return f"{dimension}_id"
+
+
+def ensure_dimension_tables(cur):
+    """
+    Create the dimension tables. They are kept across full reloads, so keys stay stable.
+    """
+    for dimension in DIMENSIONS:
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS dim_{dimension} (
+            {dimension}_id SERIAL PRIMARY KEY,
+            {dimension} VARCHAR(255) NOT NULL UNIQUE
+        );
+        """)
+
+
+def _known_keys(conn):
+    return _caches.setdefault((os.getpid(), conn.dsn), {dimension: {} for dimension in DIMENSIONS})
+
+
+def lookup_keys(cur, known, dimension, values):
+    """
+    Return the key of every value, adding values the dimension table does not hold yet.
+    Only values missing from the in-process cache are sent to the database.
+
+    Parameters:
+    - cur: Open psycopg2 cursor.
+    - known: Cache of value to key for this dimension; updated in place.
+    - dimension: Dimension name (see DIMENSIONS).
+    - values: Distinct text values.
+
+    Returns:
+    - List of keys, in the order of values.
+    """
+    # Sorted, so concurrent loaders adding the same new values lock them in the same order and never deadlock
+    missing = sorted(value for value in values if value not in known)
+    if missing:
+        # ON CONFLICT keeps concurrent loaders (e.g. parallel ingest workers) from failing on the same new value
+        cur.execute(f"""
+        INSERT INTO dim_{dimension} ({dimension})
+        SELECT unnest(%s::varchar[])
+        ON CONFLICT ({dimension}) DO NOTHING;
+        """, (missing,))
+        cur.execute(f"SELECT {dimension}, {dimension}_id FROM dim_{dimension} WHERE {dimension} = ANY(%s::varchar[])", (missing,))
+        known.update(cur.fetchall())
+    return [known[value] for value in values]
+
+
+def _encode_column(cur, known, dimension, col):
+    # Categorical columns already hold their distinct values and codes; other columns are factorized
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes, values = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, values = pd.factorize(col)
+    keys = np.asarray(lookup_keys(cur, known, dimension, [str(value) for value in values]), dtype=np.int32)
+
+    missing = codes < 0
+    encoded = keys[np.where(missing, 0, codes)] if len(keys) else np.zeros(len(col), dtype=np.int32)
+    return pd.Series(pd.arrays.IntegerArray(encoded, missing), index=col.index)
+
+
+def encode_frame(conn, data):
+    """
+    Replace the dimension columns of a DataFrame with their integer keys.
+    New values are added to the dimension tables in a short transaction of their own.
+
+    Parameters:
+    - conn: Open psycopg2 connection with no transaction in progress.
+    - data: Cleaned DataFrame with text dimension columns.
+
+    Returns:
+    - DataFrame with <name>_id columns (nullable Int32; missing values get NULL keys)
+      in place of the dimension columns. The other columns are shared, not copied.
+    """
+    # Keys found here join the cache only once the transaction has committed
+    known = _known_keys(conn)
+    pending = {dimension: dict(keys) for dimension, keys in known.items()}
+    columns = {}
+    with stage('encode_dimensions', len(data)), transaction(conn) as cur:
+        for name in data.columns:
+            if name in DIMENSIONS:
+                columns[key_column(name)] = _encode_column(cur, pending[name], name, data[name])
+            else:
+                columns[name] = data[name]
+    known.update(pending)
+    return pd.DataFrame(columns, copy=False)
+
+
+def encode_rows(conn, data):
+    """
+    Encode a DataFrame, or lazily each chunk of an iterable of DataFrames.
+    """
+    if isinstance(data, pd.DataFrame):
+        return encode_frame(conn, data)
+    return (encode_frame(conn, chunk) for chunk in data)
+
+
+def create_wide_view(cur, fact_table):
+    """
+    Create the view {fact_table}_wide, which shows the fact rows with the text of every
+    dimension in place of its key, in the column layout the table had before encoding.
+    """
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema() ORDER BY ordinal_position",
+        (fact_table,)
+    )
+    select = []
+    joins = []
+    for name, in cur.fetchall():
+        dimension = name[:-len('_id')] if name.endswith('_id') else None
+        if dimension in DIMENSIONS:
+            select.append(f"dim_{dimension}.{dimension}")
+            joins.append(f"LEFT JOIN dim_{dimension} ON dim_{dimension}.{name} = f.{name}")
+        else:
+            select.append(f"f.{name}")
+    cur.execute(f"DROP VIEW IF EXISTS {fact_table}_wide;")
+    cur.execute(f"""
+    CREATE VIEW {fact_table}_wide AS
+    SELECT {', '.join(select)}
+    FROM {fact_table} f
+    {' '.join(joins)};
+    """)
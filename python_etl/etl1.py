@@ -1,5 +1,15 @@
 import pandas as pd
-import psycopg2
+
+from bulk_load import copy_chunks, read_csv_chunks
+from db import pool_stats, pooled_connection, transaction
+from dedup import dedup_rows
+from incremental import (
+    ensure_dedup_key, ensure_watermark_table, file_fingerprint, get_watermark, merge_sql, set_watermark
+)
+from metrics import dropped, instrumented, stage
+from quarantine import Quarantine, quarantine_path, record_counts, reject_rows
+from schema import USER_ID_RANGE, csv_read_options
+from timestamps import parse_timestamps
 
 # Define the paths and database parameters
 csv_file_path = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/dataset_user_behavior_for_test.csv'
@@ -11,6 +21,17 @@ db_params = {
     "port": "5432"
 }
 
+# Set streaming to True to read, check and load the CSV in fixed-size chunks so memory stays bounded
+streaming = False
+chunk_size = 50000
+
+# Set incremental to True to keep the main table between runs and merge in only new dedup keys or newer events of loaded ones
+incremental = False
+
+# Rows failing the data quality checks are written with their reason code to a quarantine file of
+# the run in quarantine/ ('parquet' or 'csv'); None only counts them in the quarantine_counts table
+quarantine_format = 'parquet'
+
 # Define initial column names in the CSV file
 original_columns = {
     'Iduser': 'user_id',          # User ID
@@ -19,136 +40,178 @@ original_columns = {
     'Content Name': 'event_type'   # Event type/content name
 }
 
-# Load the CSV file and rename columns
-data = pd.read_csv(csv_file_path)
-data.rename(columns=original_columns, inplace=True)
-
 # Define data quality checks function
-def data_quality_checks(data):
+@instrumented('data_quality_checks')
+def data_quality_checks(data, quarantine=None):
     """
     Perform data quality checks and validation on the CSV data.
-    Returns the cleaned DataFrame if all checks pass, else raises an error.
+    Rows failing a check are sent to the quarantine (see quarantine.reject_rows) with
+    their reason code; returns the DataFrame of the rows passing every check.
     """
     # Check 1: Ensure the data is not empty
     if data.empty:
         raise ValueError("DataFrame is empty. The CSV file may be missing data.")
-    
+
     # Check 2: Check for duplicates and remove them
     initial_row_count = len(data)
     data.drop_duplicates(inplace=True)
     if len(data) < initial_row_count:
         print(f"Removed {initial_row_count - len(data)} duplicate rows.")
-    
-    # Check 3: Check for missing values and fill/drop as necessary
-    missing_values = data.isnull().sum().sum()
-    if missing_values > 0:
-        print(f"Found {missing_values} missing values. Filling or dropping as per rules.")
-        data.fillna(0, inplace=True)  # Example: Replace missing values with 0
-    
-    # Check 4: Validate data types (e.g., dates, numbers)
+        dropped('duplicates', initial_row_count - len(data))
+
+    # Parse the event times once per distinct value; missing and unparsable ones stay NaT for Check 4
     if 'event_time' in data.columns:
-        data['event_time'] = pd.to_datetime(data['event_time'], errors='coerce')
-        invalid_dates = data['event_time'].isnull().sum()
-        if invalid_dates > 0:
-            print(f"Found {invalid_dates} invalid dates. Dropping these rows.")
-            data = data.dropna(subset=['event_time'])
-    
-    # Check 5: Check for data ranges/values within expected thresholds
+        event_time, _ = parse_timestamps(data['event_time'])
+
+    # Checks 3 to 5, one vectorized mask per rule: missing values (Check 3), dates that do not
+    # parse (Check 4) and user IDs outside the expected range (Check 5). A failing row goes to
+    # the quarantine as read, with the first rule it fails, instead of being filled or clipped
+    masks = {f"missing_{name}": data[name].isna() for name in data.columns}
+    if 'event_time' in data.columns:
+        masks['invalid_event_time'] = event_time.isna()
     if 'user_id' in data.columns:
-        if not data['user_id'].between(0, 1200000000).all():  # Assuming user_id range for simplicity
-            print("Found user IDs outside of expected range. Adjusting data.")
-            data['user_id'] = data['user_id'].clip(lower=0, upper=1200000000)
-    
+        masks['invalid_user_id'] = ~data['user_id'].between(*USER_ID_RANGE).fillna(True)
+    data = reject_rows(data, masks, quarantine)
+
     # All checks passed, return cleaned data
+    if 'event_time' in data.columns:
+        data = data.assign(event_time=event_time[data.index])
     return data
 
 # Define ETL function to load cleaned data into PostgreSQL
-def etl(data, db_params):
+@instrumented('etl')
+def etl(data, db_params, incremental=False, source=None, quarantine=None):
     """
     ETL function to load cleaned data into PostgreSQL database.
+    With incremental=True the main table is kept and a changed source file is merged
+    on the dedup key, which inserts only new keys and newer events of loaded keys;
+    a file unchanged since its last load is skipped.
+    The rows a Quarantine received during the checks are counted by reason in the
+    quarantine_counts table once the load is done.
     """
     try:
-        # Step 3: Connect to PostgreSQL database using psycopg2
-        conn = psycopg2.connect(**db_params)
-        cur = conn.cursor()
-        
-        # Step 4: Define SQL queries
-        drop_table_sql = "DROP TABLE IF EXISTS usb1;"
-        create_table_sql = """
-        CREATE TABLE usb1 (
-            id SERIAL PRIMARY KEY,
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP
-        );
-        """
-        
-        # Step 5: Drop table if exists and create a new one
-        cur.execute(drop_table_sql)
-        cur.execute(create_table_sql)
-        conn.commit()
-        
-        # Step 6: Insert cleaned data into a temporary table in PostgreSQL
-        temp_table = 'user_behavior_temp'
-        
-        # Create the temporary table (ensure it matches the columns in the DataFrame)
-        create_temp_table_sql = """
-        CREATE TEMPORARY TABLE user_behavior_temp (
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP
-        );
-        """
-        cur.execute(create_temp_table_sql)
-        
-        # Insert the CSV data into the temp table
-        for index, row in data.iterrows():
-            cur.execute(
-                "INSERT INTO user_behavior_temp (user_id, session_id, event_type, event_time) VALUES (%s, %s, %s, %s)",
-                (row['user_id'], row['session_id'], row['event_type'], row['event_time'])
-            )
-        conn.commit()
-
-        # Step 7: Use CTE and ROW_NUMBER() to insert only unique rows into the main table
-        dedup_insert_sql = """
-        WITH ranked_data AS (
-            SELECT *,
-                   ROW_NUMBER() OVER (PARTITION BY user_id, session_id, event_type ORDER BY event_time) AS row_num
-            FROM user_behavior_temp
-        )
-        INSERT INTO usb1 (user_id, session_id, event_type, event_time)
-        SELECT user_id, session_id, event_type, event_time
-        FROM ranked_data
-        WHERE row_num = 1;
-        """
-        
-        # Execute deduplication insertion
-        cur.execute(dedup_insert_sql)
-        conn.commit()
-        
-        # Step 8: Data Quality Checks in PostgreSQL
-        # Confirm number of rows inserted
-        cur.execute("SELECT COUNT(*) FROM usb1")
-        row_count = cur.fetchone()[0]
-        
-        # Ensure all rows are unique after deduplication
-        print(f"Number of unique records after deduplication: {row_count}")
-        return row_count
+        # Step 3: Borrow a warm connection to PostgreSQL from the pool
+        with pooled_connection(db_params) as conn:
+            # Step 4: Define SQL queries
+            drop_table_sql = "DROP TABLE IF EXISTS usb1 CASCADE;"
+            create_table_sql = """
+            CREATE TABLE IF NOT EXISTS usb1 (
+                id SERIAL PRIMARY KEY,
+                user_id INT,
+                session_id VARCHAR(255),
+                event_type VARCHAR(255),
+                event_time TIMESTAMP
+            );
+            """
+
+            # Step 5: Drop table if exists and create a new one
+            with stage('etl.setup'), transaction(conn) as cur:
+                if not incremental:
+                    cur.execute(drop_table_sql)
+                cur.execute(create_table_sql)
+
+                if incremental:
+                    ensure_dedup_key(cur, 'usb1')
+                    ensure_watermark_table(cur)
+                    _, last_fingerprint = get_watermark(cur, source)
+                    fingerprint = file_fingerprint(source)
+                    # An unchanged file is skipped; a changed one is sent whole, as extracts are not ordered
+                    # by time: the merge on the dedup key, not an event-time cutoff, decides which rows are new
+                    if fingerprint == last_fingerprint:
+                        print(f"Source {source} is unchanged since the last load. Nothing new to insert.")
+                        data = []
+
+            # Keep only the winning row per dedup key in-process, so duplicates never go over the wire.
+            # A fully read DataFrame is then unique, and on a full reload it is copied straight into
+            # the main table; streamed chunks and incremental batches still pass through the
+            # temporary table for the cross-chunk dedup or the merge
+            direct_load = isinstance(data, pd.DataFrame) and not incremental
+            data = dedup_rows(data, 'event_time', keep='first')
+            with stage('etl.load') as record, conn.cursor() as cur:
+                if direct_load:
+                    record['rows_out'] = copy_chunks(conn, cur, data, 'usb1', ['user_id', 'session_id', 'event_type', 'event_time'])
+                else:
+                    # Step 6: Insert cleaned data into a temporary table in PostgreSQL
+                    temp_table = 'user_behavior_temp'
+
+                    # Create the temporary table (ensure it matches the columns in the DataFrame)
+                    create_temp_table_sql = """
+                    CREATE TEMPORARY TABLE user_behavior_temp (
+                        user_id INT,
+                        session_id VARCHAR(255),
+                        event_type VARCHAR(255),
+                        event_time TIMESTAMP
+                    );
+                    """
+                    cur.execute(create_temp_table_sql)
+
+                    # Bulk load the CSV data (or each streamed chunk) into the temp table with COPY
+                    record['rows_out'] = copy_chunks(conn, cur, data, temp_table, ['user_id', 'session_id', 'event_type', 'event_time'])
+
+            if not direct_load:
+                # Step 7: Use CTE and ROW_NUMBER() to insert only unique rows into the main table
+                dedup_insert_sql = """
+                WITH ranked_data AS (
+                    SELECT *,
+                           ROW_NUMBER() OVER (PARTITION BY user_id, session_id, event_type ORDER BY event_time) AS row_num
+                    FROM user_behavior_temp
+                )
+                INSERT INTO usb1 (user_id, session_id, event_type, event_time)
+                SELECT user_id, session_id, event_type, event_time
+                FROM ranked_data
+                WHERE row_num = 1;
+                """
+
+                # Execute deduplication insertion
+                if incremental:
+                    # Merge the new batch into the existing table and advance the watermark in the same transaction
+                    dedup_insert_sql = merge_sql('usb1', 'user_behavior_temp', ['user_id', 'session_id', 'event_type', 'event_time'], keep='first')
+                with stage('etl.merge') as record, transaction(conn) as cur:
+                    cur.execute(dedup_insert_sql)
+                    record['rows_out'] = cur.rowcount
+                    if incremental:
+                        cur.execute("SELECT MAX(event_time) FROM user_behavior_temp")
+                        set_watermark(cur, source, 'usb1', cur.fetchone()[0], fingerprint)
+
+            # Step 8: Data Quality Checks in PostgreSQL
+            # Count the quarantined rows of the run by reason, and confirm number of rows inserted
+            with transaction(conn) as cur:
+                if quarantine is not None:
+                    quarantine.close()
+                    record_counts(cur, quarantine.count_rows(source, 'usb1'))
+                cur.execute("SELECT COUNT(*) FROM usb1")
+                row_count = cur.fetchone()[0]
+
+            # Ensure all rows are unique after deduplication
+            print(f"Number of unique records after deduplication: {row_count}")
+            return row_count
 
     except Exception as e:
         print(f"Error during ETL process: {e}")
-    finally:
-        # Clean up
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-
-# Apply data quality checks to the cleaned data
-cleaned_data = data_quality_checks(data)
-
-# Run the ETL process
-unique_rows = etl(cleaned_data, db_params)
-print(f"Number of unique records inserted: {unique_rows}")
+
+# Run the ETL process when executed as a script; other modules import data_quality_checks and etl
+if __name__ == '__main__':
+    # Rows failing the data quality checks are collected here for this run
+    quarantine = Quarantine(quarantine_path('usb1', quarantine_format) if quarantine_format else None)
+
+    if streaming:
+        # Rename and check each chunk as it is read; etl() loads the chunks one at a time
+        cleaned_data = read_csv_chunks(
+            csv_file_path,
+            lambda chunk: data_quality_checks(chunk.rename(columns=original_columns), quarantine),
+            chunk_size,
+            **csv_read_options(usecols=list(original_columns))
+        )
+    else:
+        # Load only the needed columns of the CSV file with the declared schema and rename them
+        with stage('read') as record:
+            data = pd.read_csv(csv_file_path, **csv_read_options(usecols=list(original_columns)))
+            record['rows_out'] = len(data)
+        data.rename(columns=original_columns, inplace=True)
+
+        # Apply data quality checks to the cleaned data
+        cleaned_data = data_quality_checks(data, quarantine)
+
+    unique_rows = etl(cleaned_data, db_params, incremental=incremental, source=csv_file_path, quarantine=quarantine)
+    print(f"Number of unique records inserted: {unique_rows}")
+    print(f"Connection pool usage: {pool_stats(db_params)}")
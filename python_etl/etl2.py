@@ -1,6 +1,15 @@
 import pandas as pd
-import numpy as np
-import psycopg2
+
+from bulk_load import read_csv_chunks
+from cleaning import clean_frame
+from db import pool_stats
+from dedup import dedup_rows
+from incremental import file_fingerprint
+from metrics import instrumented, stage
+from schema import csv_read_options
+from seen_index import SeenIndex, index_path
+from sinks import open_sink
+from staging_cache import cached_prepare
 
 # Define the paths and database parameters
 csv_file_path = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/dataset_user_behavior_for_test.csv'
@@ -12,6 +21,25 @@ db_params = {
     "port": "5432"
 }
 
+# Set streaming to True to read, clean and load the CSV in fixed-size chunks so memory stays bounded
+streaming = False
+chunk_size = 50000
+
+# Set incremental to True to keep the main table between runs and merge in only new dedup keys or newer events of loaded ones
+incremental = False
+
+# Set use_staging_cache to True to reuse a Parquet copy of the cleaned data while the CSV and the cleaning are unchanged
+use_staging_cache = False
+
+# Set local_sink to 'duckdb' or 'sqlite' to load into an embedded database file instead of
+# PostgreSQL, for quick runs while changing the cleaning and for offline analysis
+local_sink = None
+local_database = 'user_behavior_dev.db'
+
+# Set use_seen_index to True to keep an on-disk index of the loaded events, so the rows of
+# re-delivered extracts are dropped in memory instead of being sent to the database again
+use_seen_index = False
+
 # Define initial column mapping
 column_mapping = {
     'Iduser': 'user_id',
@@ -25,10 +53,8 @@ column_mapping = {
     'Device Type': 'device_type'
 }
 
-# Load the CSV file
-data = pd.read_csv(csv_file_path)
-
 # Define a function to prepare and clean data
+@instrumented('process_data')
 def process_data(data, column_mapping):
     """
     Renames columns, performs data quality checks, and transforms data.
@@ -40,119 +66,119 @@ def process_data(data, column_mapping):
     Returns:
     - Processed DataFrame with necessary transformations applied.
     """
-    # Rename columns based on the provided mapping
-    data = data.rename(columns=column_mapping)
-
-    # Fill missing values based on column type
-    data = data.apply(lambda col: col.fillna('unknown') if col.dtype == 'object' else col)
-    data = data.apply(lambda col: col.fillna(0) if np.issubdtype(col.dtype, np.number) else col)
-    data = data.apply(lambda col: col.fillna(pd.Timestamp('1970-01-01')) if np.issubdtype(col.dtype, np.datetime64) else col)
-
-    # Validate and format datetime in 'start_watching' column
-    if 'start_watching' in data.columns:
-        data['start_watching'] = pd.to_datetime(data['start_watching'], errors='coerce')
-        if data['start_watching'].isnull().any():
-            print("Warning: Invalid date formats detected in 'start_watching' column. Proceeding with NaT values.")
-
-    # Combine 'province' and 'city' columns into 'location', capitalizing each word
-    if 'province' in data.columns and 'city' in data.columns:
-        data['location'] = data['province'].str.title() + ", " + data['city'].str.title()
-
-    # Ensure 'user_id' and 'play_time_ms' values are non-negative
-    if 'user_id' in data.columns:
-        data['user_id'] = data['user_id'].clip(lower=0)
-    if 'play_time_ms' in data.columns:
-        data['play_time_ms'] = data['play_time_ms'].clip(lower=0)
-
-    # Replace remaining NaN values with None for database compatibility
-    return data.where(pd.notnull(data), None)
-
-# Apply data preparation function
-cleaned_data = process_data(data, column_mapping)
-
-# Define ETL function to load cleaned data into PostgreSQL
-def etl(data, db_params):
+    # Rename, fill missing values by column type, parse 'start_watching', combine the
+    # title-cased 'province' and 'city' into 'location' and make 'user_id' and
+    # 'play_time_ms' non-negative, in one pass over the columns
+    return clean_frame(
+        data, column_mapping,
+        datetime_columns=['start_watching'],
+        location=('province', 'city'),
+        clip_columns=['user_id', 'play_time_ms']
+    )
+
+# Columns of the cleaned DataFrame and of the main table; the PostgreSQL sink stores the
+# dimension columns as integer keys, an embedded sink as text
+frame_columns = ['user_id', 'session_id', 'event_type', 'start_watching', 'content_type', 'device_type', 'location', 'play_time_ms']
+table_columns = ['user_id', 'session_id', 'event_type', 'event_time', 'content_type', 'device_type', 'location', 'play_time_ms']
+
+# Define ETL function to load cleaned data into the database
+@instrumented('etl')
+def etl(data, db_params, incremental=False, source=None, seen_index=False):
     """
-    ETL function to load cleaned data into PostgreSQL database.
+    ETL function to load cleaned data into PostgreSQL database, or into an embedded
+    DuckDB/SQLite file when db_params is {'engine': ..., 'database': ...} (see sinks.open_sink).
+    With incremental=True the main table is kept and a changed source file is merged
+    on the dedup key, which inserts only new keys and newer events of loaded keys;
+    a file unchanged since its last load is skipped.
+    In PostgreSQL the main table is partitioned by event_time; a full reload replaces
+    only the partitions of the periods it loads and keeps the others; a dedup key found
+    in both keeps its latest row.
+    With seen_index=True events loaded by earlier runs are dropped before the load
+    (see seen_index.SeenIndex); a full reload rebuilds the index from the rows it
+    loads and the rows it keeps.
     """
     try:
-        # Connect to PostgreSQL database
-        conn = psycopg2.connect(**db_params)
-        cur = conn.cursor()
-        
-        # Drop table if exists and create new one
-        drop_table_sql = "DROP TABLE IF EXISTS usb1;"
-        create_table_sql = """
-        CREATE TABLE usb1 (
-            id SERIAL PRIMARY KEY,
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        
-        cur.execute(drop_table_sql)
-        cur.execute(create_table_sql)
-        conn.commit()
-        
-        # Insert data into temporary table
-        create_temp_table_sql = """
-        CREATE TEMPORARY TABLE user_behavior_temp (
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        cur.execute(create_temp_table_sql)
-        
-        for index, row in data.iterrows():
-            cur.execute(
-                "INSERT INTO user_behavior_temp (user_id, session_id, event_type, event_time, content_type, device_type, location, play_time_ms) VALUES (%s, %s, %s, %s, %s, %s, %s, %s)",
-                (row['user_id'], row['session_id'], row['event_type'], row['start_watching'], row['content_type'], row['device_type'], row['location'], row['play_time_ms'])
-            )
-        conn.commit()
-
-        # Insert only unique rows into the main table using CTE and ROW_NUMBER
-        dedup_insert_sql = """
-        WITH ranked_data AS (
-            SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id, session_id, event_type ORDER BY event_time DESC) AS row_num
-            FROM user_behavior_temp
-        )
-        INSERT INTO usb1 (user_id, session_id, event_type, event_time, content_type, device_type, location, play_time_ms)
-        SELECT user_id, session_id, event_type, event_time, content_type, device_type, location, play_time_ms
-        FROM ranked_data
-        WHERE row_num = 1;
-        """
-        
-        cur.execute(dedup_insert_sql)
-        conn.commit()
-        
-        # Confirm number of rows inserted
-        cur.execute("SELECT COUNT(*) FROM usb1")
-        row_count = cur.fetchone()[0]
-        
-        print(f"Number of unique records inserted: {row_count}")
-        return row_count
+        # Open the sink: a warm pooled PostgreSQL connection, or the embedded database file
+        with open_sink(db_params) as sink:
+            watermark = None
+            with stage('etl.setup'):
+                sink.prepare('usb1', table_columns, incremental)
+
+                if incremental:
+                    _, last_fingerprint = sink.watermark(source)
+                    fingerprint = file_fingerprint(source)
+                    watermark = (source, fingerprint)
+                    # An unchanged file is skipped; a changed one is sent whole, as extracts are not ordered
+                    # by time: the merge on the dedup key, not an event-time cutoff, decides which rows are new
+                    if fingerprint == last_fingerprint:
+                        print(f"Source {source} is unchanged since the last load. Nothing new to insert.")
+                        data = []
+
+            # Keep only the winning row per dedup key in-process, so duplicates never go over the wire.
+            # A fully read DataFrame is then unique, and on a full reload it is copied straight into
+            # the main table; streamed chunks and incremental batches still pass through the
+            # temporary table for the cross-chunk dedup or the merge
+            direct_load = isinstance(data, pd.DataFrame) and not incremental
+            data = dedup_rows(data, 'start_watching', keep='latest')
+
+            # Drop the events earlier runs already loaded, so they never go over the wire. The index
+            # starts over when the table is rewritten (full reload) or was emptied outside this script
+            seen = SeenIndex(index_path(db_params, 'usb1')) if seen_index else None
+            if seen is not None:
+                if not incremental or sink.is_empty('usb1'):
+                    seen.reset()
+                data = seen.filter_rows(data, 'start_watching')
+
+            data = sink.encode(data)
+            with stage('etl.load') as record:
+                record['rows_out'] = sink.load(data, 'usb1', frame_columns, table_columns, direct=direct_load)
+
+            if not direct_load:
+                # Insert only the latest row per dedup key into the main table; an incremental batch is
+                # merged into the existing rows and advances the watermark in the same transaction
+                with stage('etl.merge') as record:
+                    record['rows_out'] = sink.merge('usb1', table_columns, keep='latest', watermark=watermark)
+
+            if not incremental:
+                # A full reload rewrote only the partitions it loads; a key it shares with a kept
+                # partition keeps its latest row
+                with stage('etl.resolve'):
+                    sink.resolve_reload('usb1', keep='latest')
+
+            # Remember the loaded events only now that they are committed. A full reload forgot every
+            # event before the load; the events of the partitions it kept are added back
+            if seen is not None:
+                if not incremental:
+                    seen.add(sink.kept_events('usb1'), 'start_watching')
+                seen.commit()
+
+            # Confirm number of rows inserted
+            row_count = sink.count('usb1')
+
+            print(f"Number of unique records inserted: {row_count}")
+            return row_count
 
     except Exception as e:
         print(f"Error during ETL process: {e}")
-    finally:
-        # Clean up
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-
-# Run the ETL process
-unique_rows = etl(cleaned_data, db_params)
-print(f"Number of unique records inserted: {unique_rows}")
+
+# Run the ETL process when executed as a script; other modules import process_data and etl
+if __name__ == '__main__':
+    if streaming:
+        # Clean each chunk as it is read; etl() loads the chunks one at a time
+        cleaned_data = read_csv_chunks(csv_file_path, lambda chunk: process_data(chunk, column_mapping), chunk_size, **csv_read_options())
+    elif use_staging_cache:
+        # Reuse the cached cleaned data, or read, clean and cache the CSV file
+        cleaned_data = cached_prepare(csv_file_path, process_data, column_mapping, **csv_read_options())
+    else:
+        # Load the CSV file
+        with stage('read') as record:
+            data = pd.read_csv(csv_file_path, **csv_read_options())
+            record['rows_out'] = len(data)
+
+        # Apply data preparation function
+        cleaned_data = process_data(data, column_mapping)
+
+    target_params = {'engine': local_sink, 'database': local_database} if local_sink else db_params
+    unique_rows = etl(cleaned_data, target_params, incremental=incremental, source=csv_file_path, seen_index=use_seen_index)
+    print(f"Number of unique records inserted: {unique_rows}")
+    print(f"Connection pool usage: {pool_stats(db_params)}")
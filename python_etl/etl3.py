@@ -1,6 +1,18 @@
 import pandas as pd
-import numpy as np
-import psycopg2
+
+from bulk_load import read_csv_chunks
+from checkpoints import ChunkCheckpoint
+from cleaning import clean_frame
+from db import pool_stats
+from dedup import dedup_rows
+from event_store import store_rows
+from incremental import file_fingerprint
+from metrics import instrumented, stage
+from schema import csv_read_options
+from seen_index import SeenIndex, index_path
+from sessions import collect_days, engagement_rollups
+from sinks import open_sink
+from staging_cache import cached_prepare
 
 # Define the path to the uploaded CSV file and database parameters
 csv_file_path = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/dataset_user_behavior_for_test.csv'
@@ -12,6 +24,35 @@ db_params = {
     "port": "5432"
 }
 
+# Set streaming to True to read, clean and load the CSV in fixed-size chunks so memory stays bounded
+streaming = False
+chunk_size = 50000
+
+# Set resumable to True to read the CSV in byte ranges of about chunk_bytes and commit every chunk
+# together with a checkpoint, so a load that fails restarts from the first chunk it did not commit
+resumable = False
+chunk_bytes = 64 * 1024 * 1024
+
+# Set incremental to True to keep the main table between runs and merge in only new dedup keys or newer events of loaded ones
+incremental = False
+
+# Set use_staging_cache to True to reuse a Parquet copy of the cleaned data while the CSV and the cleaning are unchanged
+use_staging_cache = False
+
+# Set local_sink to 'duckdb' or 'sqlite' to load into an embedded database file instead of
+# PostgreSQL, for quick runs while changing the cleaning and for offline analysis
+local_sink = None
+local_database = 'user_behavior_dev.db'
+
+# Set use_seen_index to True to keep an on-disk index of the loaded events, so the rows of
+# re-delivered extracts are dropped in memory instead of being sent to the database again
+use_seen_index = False
+
+# Set event_store_path to a file path to also write the cleaned events to a memory-mapped
+# binary event store (see event_store.EventStore), which analyses open without pandas or the CSV.
+# It cannot be combined with resumable, as a resumed load reads only the chunks not yet committed
+event_store_path = None
+
 # Define initial column mapping
 column_mapping = {
     'Iduser': 'user_id',
@@ -25,180 +66,197 @@ column_mapping = {
     'Device Type': 'device_type'
 }
 
-# Load the CSV file
-data = pd.read_csv(csv_file_path)
-
 # Define a function to prepare and clean data
+@instrumented('prepare_data')
 def prepare_data(data, column_mapping):
     """
     Renames columns, performs data quality checks, and transforms data.
     """
-    # Rename columns based on the provided mapping
-    data = data.rename(columns=column_mapping)
-
-    # Fill missing values based on column type
-    data = data.apply(lambda col: col.fillna('unknown') if col.dtype == 'object' else col)
-    data = data.apply(lambda col: col.fillna(0) if np.issubdtype(col.dtype, np.number) else col)
-    data = data.apply(lambda col: col.fillna(pd.Timestamp('1970-01-01')) if np.issubdtype(col.dtype, np.datetime64) else col)
-
-    # Validate and format datetime in 'start_watching' column
-    if 'start_watching' in data.columns:
-        data['start_watching'] = pd.to_datetime(data['start_watching'], errors='coerce')
-        if data['start_watching'].isnull().any():
-            print("Warning: Invalid date formats detected in 'start_watching' column. Proceeding with NaT values.")
-
-    # Combine 'province' and 'city' columns into 'location', capitalizing each word
-    if 'province' in data.columns and 'city' in data.columns:
-        data['location'] = data['province'].str.title() + ", " + data['city'].str.title()
-        data['province'] = data['province'].str.title()
-        data['city'] = data['city'].str.title()
-
-    # Ensure 'user_id' and 'play_time_ms' values are non-negative
-    if 'user_id' in data.columns:
-        data['user_id'] = data['user_id'].clip(lower=0)
-    if 'play_time_ms' in data.columns:
-        data['play_time_ms'] = data['play_time_ms'].clip(lower=0)
-
-    # Replace remaining NaN values with None for database compatibility
-    return data.where(pd.notnull(data), None)
-
-# Apply data preparation function
-cleaned_data = prepare_data(data, column_mapping)
-
-# Define ETL function to load cleaned data into PostgreSQL
-def etl(data, db_params):
+    # Rename, fill missing values by column type, parse 'start_watching', title-case
+    # 'province' and 'city', combine them into 'location' and make 'user_id' and
+    # 'play_time_ms' non-negative, in one pass over the columns
+    return clean_frame(
+        data, column_mapping,
+        datetime_columns=['start_watching'],
+        title_columns=['province', 'city'],
+        location=('province', 'city'),
+        clip_columns=['user_id', 'play_time_ms']
+    )
+
+# Columns of the cleaned DataFrame and of the main table; the PostgreSQL sink stores the
+# dimension columns as integer keys, an embedded sink as text
+frame_columns = ['user_id', 'session_id', 'event_type', 'start_watching', 'content_type', 'device_type', 'province', 'city', 'location', 'play_time_ms']
+table_columns = ['user_id', 'session_id', 'event_type', 'event_time', 'content_type', 'device_type', 'province', 'city', 'location', 'play_time_ms']
+
+# Define ETL function to load cleaned data into the database
+@instrumented('etl')
+def etl(data, db_params, incremental=False, source=None, seen_index=False, checkpoint=None):
     """
-    ETL function to load cleaned data into PostgreSQL database.
-    Creates additional summary tables for users by province and content type.
+    ETL function to load cleaned data into PostgreSQL database, or into an embedded
+    DuckDB/SQLite file when db_params is {'engine': ..., 'database': ...} (see sinks.open_sink).
+    With incremental=True the main table is kept and a changed source file is merged
+    on the dedup key, which inserts only new keys and newer events of loaded keys;
+    a file unchanged since its last load is skipped.
+    In PostgreSQL the main table is partitioned by event_time; a full reload replaces
+    only the partitions of the periods it loads and keeps the others; a dedup key found
+    in both keeps its latest row.
+    With seen_index=True events loaded by earlier runs are dropped before the load
+    (see seen_index.SeenIndex); a full reload rebuilds the index from the rows it
+    loads and the rows it keeps.
+    With a checkpoint (see checkpoints.ChunkCheckpoint) as data, every chunk is committed
+    with its checkpoint, and a load of the same file that failed before the merge resumes
+    after the last chunk it committed.
+    Creates additional summary tables for users by province and content type, and
+    daily engagement rollups per user and per content (see sessions.engagement_rollups)
+    for the days the run changed.
     """
     try:
-        # Connect to PostgreSQL database
-        conn = psycopg2.connect(**db_params)
-        cur = conn.cursor()
-        
-        # Drop main table if exists and create new one with province and city columns
-        drop_main_table_sql = "DROP TABLE IF EXISTS usb1;"
-        create_main_table_sql = """
-        CREATE TABLE usb1 (
-            id SERIAL PRIMARY KEY,
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            province VARCHAR(255),
-            city VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        
-        cur.execute(drop_main_table_sql)
-        cur.execute(create_main_table_sql)
-        conn.commit()
-        
-        # Insert data into temporary table
-        create_temp_table_sql = """
-        CREATE TEMPORARY TABLE user_behavior_temp (
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            province VARCHAR(255),
-            city VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        cur.execute(create_temp_table_sql)
-        
-        # Populate temporary table with the cleaned data
-        for _, row in data.iterrows():
-            cur.execute(
-                """
-                INSERT INTO user_behavior_temp (user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (row['user_id'], row['session_id'], row['event_type'], row['start_watching'], row['content_type'], row['device_type'], row['province'], row['city'], row['location'], row['play_time_ms'])
-            )
-        conn.commit()
-
-        # Insert only unique rows into the main table using CTE and ROW_NUMBER
-        dedup_insert_sql = """
-        WITH ranked_data AS (
-            SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id, session_id, event_type ORDER BY event_time DESC) AS row_num
-            FROM user_behavior_temp
-        )
-        INSERT INTO usb1 (user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms)
-        SELECT user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms
-        FROM ranked_data
-        WHERE row_num = 1;
-        """
-        
-        cur.execute(dedup_insert_sql)
-        conn.commit()
-        
-        # Confirm number of rows inserted
-        cur.execute("SELECT COUNT(*) FROM usb1")
-        row_count = cur.fetchone()[0]
-        
-        print(f"Number of unique records inserted: {row_count}")
-        
-        # Create summary tables
-        # Table for the count of users from each province
-        drop_province_count_table = "DROP TABLE IF EXISTS users_by_province;"
-        create_province_count_table = """
-        CREATE TABLE users_by_province AS
-        SELECT province, COUNT(DISTINCT user_id) AS user_count
-        FROM usb1
-        GROUP BY province;
-        """
-        cur.execute(drop_province_count_table)
-        cur.execute(create_province_count_table)
-        conn.commit()
-        print("Created table 'users_by_province'.")
-
-        # Table for the count of users by content type
-        drop_content_type_count_table = "DROP TABLE IF EXISTS users_by_content_type;"
-        create_content_type_count_table = """
-        CREATE TABLE users_by_content_type AS
-        SELECT content_type, COUNT(DISTINCT user_id) AS user_count
-        FROM usb1
-        GROUP BY content_type;
-        """
-        cur.execute(drop_content_type_count_table)
-        cur.execute(create_content_type_count_table)
-        conn.commit()
-        print("Created table 'users_by_content_type'.")
-
-        # Retrieve results for display
-        print("\nResults:")
-        cur.execute("SELECT * FROM users_by_province")
-        province_results = cur.fetchall()
-        print("\nUsers by Province:")
-        for row in province_results:
-            print(row)
-
-        cur.execute("SELECT * FROM users_by_content_type")
-        content_type_results = cur.fetchall()
-        print("\nUsers by Content Type:")
-        for row in content_type_results:
-            print(row)
-
-        return row_count
+        # Open the sink: a warm pooled PostgreSQL connection, or the embedded database file
+        with open_sink(db_params) as sink:
+            watermark = None
+            with stage('etl.setup'):
+                sink.prepare('usb1', table_columns, incremental)
+
+                if incremental:
+                    _, last_fingerprint = sink.watermark(source)
+                    fingerprint = file_fingerprint(source)
+                    watermark = (source, fingerprint)
+                    # An unchanged file is skipped; a changed one is sent whole, as extracts are not ordered
+                    # by time: the merge on the dedup key, not an event-time cutoff, decides which rows are new
+                    if fingerprint == last_fingerprint:
+                        print(f"Source {source} is unchanged since the last load. Nothing new to insert.")
+                        data = []
+
+            # Keep only the winning row per dedup key in-process, so duplicates never go over the wire.
+            # A fully read DataFrame is then unique, and on a full reload it is copied straight into
+            # the main table; streamed chunks and incremental batches still pass through the
+            # temporary table for the cross-chunk dedup or the merge
+            direct_load = isinstance(data, pd.DataFrame) and not incremental
+            data = dedup_rows(data, 'start_watching', keep='latest')
+
+            # Drop the events earlier runs already loaded, so they never go over the wire. The index
+            # starts over when the table is rewritten (full reload) or was emptied outside this script
+            seen = SeenIndex(index_path(db_params, 'usb1')) if seen_index else None
+            if seen is not None:
+                if not incremental or sink.is_empty('usb1'):
+                    seen.reset()
+                data = seen.filter_rows(data, 'start_watching')
+
+            # Note the days the rows fall on, for the engagement rollups. A fully read DataFrame of a
+            # full reload is the new content of those days, so it is sessionized in memory
+            days = set()
+            data = collect_days(data, 'start_watching', days)
+            events = data if direct_load and isinstance(data, pd.DataFrame) else None
+
+            data = sink.encode(data)
+            with stage('etl.load') as record:
+                record['rows_out'] = sink.load(data, 'usb1', frame_columns, table_columns, direct=direct_load, checkpoint=checkpoint)
+
+            if incremental or checkpoint is not None:
+                # The merge may also replace rows of other days with the batch's newer events, and a
+                # resumed load also merges the chunks staged by the failed run
+                days |= sink.batch_days('usb1')
+
+            if not direct_load:
+                # Insert only the latest row per dedup key into the main table; an incremental batch is
+                # merged into the existing rows, added to the summary tables and advances the watermark in the
+                # same transaction
+                with stage('etl.merge') as record:
+                    record['rows_out'] = sink.merge('usb1', table_columns, keep='latest', watermark=watermark, checkpoint=checkpoint, summaries=True)
+
+            if not incremental:
+                # A full reload rewrote only the partitions it loads; a key it shares with a kept
+                # partition keeps one row, and the days of the deleted rows are sessionized again
+                with stage('etl.resolve'):
+                    resolved = sink.resolve_reload('usb1', keep='latest')
+                if resolved:
+                    days |= resolved
+                    events = None
+
+            # Remember the loaded events only now that they are committed. A full reload forgot every
+            # event before the load; the events of the partitions it kept are added back
+            if seen is not None:
+                if not incremental:
+                    seen.add(sink.kept_events('usb1'), 'start_watching')
+                seen.commit()
+
+            # Update summary tables
+            # Counts of distinct users by province and by content type: the merge of an incremental
+            # batch already added its users, in the transaction that advanced the watermark, so a
+            # failed update is retried with the batch; a full reload rebuilds them from the whole main table
+            with stage('etl.summaries'):
+                # Confirm number of rows inserted
+                row_count = sink.count('usb1')
+                print(f"Number of unique records inserted: {row_count}")
+                if not incremental:
+                    sink.update_summaries('usb1')
+            print("Updated tables 'users_by_province' and 'users_by_content_type'.")
+
+            # Sessionize the events of the changed days and replace their engagement rollups;
+            # streamed and incremental loads read those days back from the main table
+            with stage('etl.engagement'):
+                if days:
+                    if events is None:
+                        events = sink.read_days('usb1', days)
+                    sink.replace_rollups(engagement_rollups(events, days), days, full=not incremental)
+            print("Updated tables 'daily_user_engagement' and 'daily_content_engagement'.")
+
+            # The batch is merged and summarized; a resumable load no longer needs its staged chunks
+            if checkpoint is not None:
+                sink.drop_staging()
+
+            # Retrieve results for display
+            print("\nResults:")
+            province_results = sink.summary_rows('users_by_province')
+            print("\nUsers by Province:")
+            for row in province_results:
+                print(row)
+
+            content_type_results = sink.summary_rows('users_by_content_type')
+            print("\nUsers by Content Type:")
+            for row in content_type_results:
+                print(row)
+
+            return row_count
 
     except Exception as e:
         print(f"Error during ETL process: {e}")
-    finally:
-        # Clean up
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-
-# Run the ETL process
-unique_rows = etl(cleaned_data, db_params)
-print(f"Number of unique records inserted: {unique_rows}")
\ No newline at end of file
+        if checkpoint is not None and checkpoint.committed is not None:
+            print(f"Chunks committed up to byte {checkpoint.committed} of {checkpoint.source} are kept; run again to resume the load.")
+
+# Run the ETL process when executed as a script; other modules import prepare_data and etl
+if __name__ == '__main__':
+    if resumable and event_store_path:
+        # A resumed load reads only the chunks the failed run did not commit
+        raise ValueError("event_store_path cannot be used with resumable: the store would hold only the resumed chunks")
+
+    checkpoint = None
+    if resumable:
+        # Read and clean the CSV in byte ranges; etl() skips the chunks an earlier failed run committed
+        cleaned_data = checkpoint = ChunkCheckpoint(
+            csv_file_path, lambda chunk: prepare_data(chunk, column_mapping), chunk_bytes,
+            **csv_read_options()
+        )
+    elif streaming:
+        # Clean each chunk as it is read; etl() loads the chunks one at a time
+        cleaned_data = read_csv_chunks(csv_file_path, lambda chunk: prepare_data(chunk, column_mapping), chunk_size, **csv_read_options())
+    elif use_staging_cache:
+        # Reuse the cached cleaned data, or read, clean and cache the CSV file
+        cleaned_data = cached_prepare(csv_file_path, prepare_data, column_mapping, **csv_read_options())
+    else:
+        # Load the CSV file
+        with stage('read') as record:
+            data = pd.read_csv(csv_file_path, **csv_read_options())
+            record['rows_out'] = len(data)
+
+        # Apply data preparation function
+        cleaned_data = prepare_data(data, column_mapping)
+
+    if event_store_path:
+        # Write the cleaned events to the store as they go to etl(); streamed chunks are written one at a time
+        cleaned_data = store_rows(cleaned_data, event_store_path, frame_columns)
+
+    target_params = {'engine': local_sink, 'database': local_database} if local_sink else db_params
+    unique_rows = etl(cleaned_data, target_params, incremental=incremental, source=csv_file_path, seen_index=use_seen_index, checkpoint=checkpoint)
+    print(f"Number of unique records inserted: {unique_rows}")
+    print(f"Connection pool usage: {pool_stats(db_params)}")
@@ -1,7 +1,22 @@
 import pandas as pd
 import numpy as np
 import re
-import psycopg2
+
+from bulk_load import read_csv_chunks
+from checkpoints import ChunkCheckpoint
+from cube import CUBE_COLUMNS, build_cube
+from db import pool_stats
+from dedup import dedup_rows
+from event_store import store_rows
+from incremental import file_fingerprint
+from metrics import instrumented, stage
+from quarantine import Quarantine, quarantine_path, reject_rows
+from schema import USER_ID_RANGE, csv_read_options
+from seen_index import SeenIndex, index_path
+from sessions import collect_days, engagement_rollups
+from sinks import open_sink
+from staging_cache import cached_prepare
+from timestamps import parse_timestamps
 
 # Define the path to the uploaded CSV file and database parameters
 csv_file_path = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/dataset_user_behavior_for_test_3.csv'
@@ -13,6 +28,39 @@ db_params = {
     "port": "5432"
 }
 
+# Set streaming to True to read, clean and load the CSV in fixed-size chunks so memory stays bounded
+streaming = False
+chunk_size = 50000
+
+# Set resumable to True to read the CSV in byte ranges of about chunk_bytes and commit every chunk
+# together with a checkpoint, so a load that fails restarts from the first chunk it did not commit
+resumable = False
+chunk_bytes = 64 * 1024 * 1024
+
+# Set incremental to True to keep the main table between runs and merge in only new dedup keys or newer events of loaded ones
+incremental = False
+
+# Set use_staging_cache to True to reuse a Parquet copy of the cleaned data while the CSV and the cleaning are unchanged
+use_staging_cache = False
+
+# Set local_sink to 'duckdb' or 'sqlite' to load into an embedded database file instead of
+# PostgreSQL, for quick runs while changing the cleaning and for offline analysis
+local_sink = None
+local_database = 'user_behavior_dev.db'
+
+# Set use_seen_index to True to keep an on-disk index of the loaded events, so the rows of
+# re-delivered extracts are dropped in memory instead of being sent to the database again
+use_seen_index = False
+
+# Rows failing validation are written with their reason code to a quarantine file of the run
+# in quarantine/ ('parquet' or 'csv'); None only counts them in the quarantine_counts table
+quarantine_format = 'parquet'
+
+# Set event_store_path to a file path to also write the cleaned events to a memory-mapped
+# binary event store (see event_store.EventStore), which analyses open without pandas or the CSV.
+# It cannot be combined with resumable, as a resumed load reads only the chunks not yet committed
+event_store_path = None
+
 # Define initial column mapping
 column_mapping = {
     'Iduser': 'user_id',
@@ -26,114 +74,129 @@ column_mapping = {
     'Device Type': 'device_type'
 }
 
-# Load the CSV file
-data = pd.read_csv(csv_file_path, quotechar='"', escapechar='\\')
-print(data.dtypes)
+# Regular expression to match the fields of a malformed row, compiled once
+# - Match quoted content (which may contain commas), like "LHEGANGSTER,THECOP,THEDEVI"
+# - Match any sequence of non-comma characters ([^,]+)
+split_row_pattern = re.compile(r'"([^"]*)"|([^",]+)')
+
+# Fields of a malformed row, in the column order of the CSV file
+split_row_fields = [
+    'user_id', 'start_watching', 'session_id', 'province', 'city',
+    'event_type', 'play_time_ms', 'device_type', 'content_type'
+]
+
+# Define a function to repair rows whose fields were read as a single quoted value
+def split_malformed_rows(raw):
+    """
+    Splits malformed rows (a whole CSV line quoted into the first column) into their fields.
+    Only values containing a comma are parsed; clean rows are left alone.
+
+    Parameters:
+    - raw: Series holding the raw first-column values.
+
+    Returns:
+    - DataFrame indexed like the repaired rows, with one column per field in split_row_fields.
+    """
+    candidates = raw[raw.str.contains(',', na=False)]
+    if candidates.empty:
+        return pd.DataFrame(index=raw.index[:0])
+
+    # One row per regex match; quoted content loses its quotes, as when pandas reads a quoted field
+    matches = candidates.str.extractall(split_row_pattern)
+    parts = matches[0].where(matches[0].notna(), matches[1])
+
+    # Number the parts within each row and pivot them into columns by position
+    row_index = parts.index.get_level_values(0)
+    parts.index = pd.MultiIndex.from_arrays([row_index, parts.groupby(level=0).cumcount()])
+    split = parts.unstack()
+
+    # Ensure we have the expected number of parts (9, one per field)
+    if split.shape[1] < len(split_row_fields):
+        incomplete = split.index
+    else:
+        incomplete = split.index[split[len(split_row_fields) - 1].isna()]
+    # Rows that still lack fields are left alone; prepare_data quarantines them
+    split = split.drop(index=incomplete)
+    if split.empty:
+        return pd.DataFrame(index=raw.index[:0])
+
+    split = split.iloc[:, :len(split_row_fields)]
+    split.columns = split_row_fields
+    return split
+
+# Define a function to put the fields of repaired rows back in their columns
+def merge_repaired_rows(data, repaired):
+    """
+    Put the fields of the repaired rows in place of the line held in their first column.
+
+    Parameters:
+    - data: Renamed DataFrame as read.
+    - repaired: DataFrame returned by split_malformed_rows.
+
+    Returns:
+    - DataFrame with the repaired rows filled in and the same columns and dtypes.
+    """
+    if repaired.empty:
+        return data
+    columns = {}
+    for name, values in repaired.items():
+        col = data[name].copy()
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            col = col.cat.add_categories(pd.Index(values.dropna().unique()).difference(col.cat.categories))
+        elif pd.api.types.is_numeric_dtype(col.dtype):
+            values = pd.to_numeric(values, errors='coerce')
+        col.loc[values.index] = values
+        columns[name] = col
+    return data.assign(**columns)
 
 # Define a function to prepare and clean data
-def prepare_data(data, column_mapping):
+@instrumented('prepare_data')
+def prepare_data(data, column_mapping, quarantine=None):
     """
     Renames columns, performs data quality checks, and transforms data.
+    Rows failing a check are sent to the quarantine (see quarantine.reject_rows) with their
+    reason code instead of being filled in; only clean rows are returned.
     """
     # Rename columns based on the provided mapping
     data = data.rename(columns=column_mapping)
-    print(data['start_watching'].head())
-    print(data.isnull().sum())
-    print(data[data.isnull().any(axis=1)])
-    contains_quotes_event_type = data['user_id'].str.contains('"', na=False)
-    print(data[contains_quotes_event_type])
 
     # Fill missing start_watching values based on column type
     # data = data.apply(lambda col: col.fillna('unknown') if col.dtype == 'object' else col)
     # data = data.apply(lambda col: col.fillna(0) if np.issubdtype(col.dtype, np.number) else col)
 
-    # Ensure 'user_id' is a string for proper processing
-    data['user_id'] = data['user_id'].astype(str)
-
-    def split_row(row):
-        try:
-        # Regular expression to match fields
-        # - Match any sequence of non-comma characters ([^,]+)
-        # - Match quoted content (which may contain commas), like "LHEGANGSTER,THECOP,THEDEVI"
-           pattern = r'"([^"]*)"|([^",]+)'
-
-        # Find all matches using the regex pattern
-           parts = []
-           for match in re.finditer(pattern, row):
-            # If we have a quoted field, use it
-             if match.group(1):
-                parts.append(f'"{match.group(1)}"')  # Content inside quotes
-             elif match.group(2):
-                parts.append(match.group(2))  # Non-quoted content
-        
-        # Ensure we have the expected number of parts (8 expected, based on the example you gave)
-           if len(parts) < 9:
-             raise ValueError(f"Unexpected row format: {row}")
-
-        # Assign values based on the expected positions of the split data
-           return {
-            'user_id': parts[0],  # First part is user_id
-            'start_watching': parts[1],  # Second part is start_watching
-            'session_id': parts[2],  # Third part is session_id
-            'province': parts[3],  # Fourth part is province
-            'city': parts[4],  # Fifth part is city
-            'event_type': parts[5],  # Sixth part is event_type
-            'content_name': parts[6],  # Seventh part is content_name (may contain commas)
-            'content_type': parts[7],  # Eighth part is content_type
-            'device_type': parts[8],  # Ninth part is device_type
-           }
-        except Exception as e:
-           print(f"Error processing row: {row}")
-           print(f"Error message: {str(e)}")
-           return None  # Return None or some other fallback in case of error
-
-# Step 1: Rename the columns to avoid overlap
-    data = data.rename(columns={
-    'user_id': 'user_id_old',
-    'start_watching': 'start_watching_old',
-    'session_id': 'session_id_old',
-    'province': 'province_old',
-    'city': 'city_old',
-    'event_type': 'event_type_old',
-    'device_type': 'device_type_old',
-    'content_type': 'content_type_old',
-    })
-
-# Step 2: Apply the split_row function to 'user_id_old' (or whatever column contains raw data)
-    data['split_data'] = data['user_id_old'].apply(split_row)
-
-# Step 3: Expand the resulting dictionary into separate columns
-    split_columns = data['split_data'].apply(pd.Series)
-
-# Step 4: Add suffix to the new columns to avoid conflict with old column names
-    split_columns = split_columns.add_suffix('_new')
-
-# Step 5: Join the new columns with the original dataframe
-    data = data.join(split_columns)
-
-# Optionally, drop the 'split_data' column if it's no longer needed
-    data.drop('split_data', axis=1, inplace=True)
-
-# Step 6: Optionally, you can rename back the '_old' columns to the original column names if necessary
-    data = data.rename(columns={
-    'user_id_old': 'user_id',
-    'start_watching_old': 'start_watching',
-    'session_id_old': 'session_id',
-    'province_old': 'province',
-    'city_old': 'city',
-    'event_type_old': 'event_type',
-    'device_type_old': 'device_type',
-    'content_type_old': 'content_type',
-    })
-    print(data)
-
-
-    data['user_id'] = pd.to_numeric(data['user_id'], errors='coerce').fillna(0).astype(int)
-    data['play_time_ms'] = pd.to_numeric(data['play_time_ms'], errors='coerce').fillna(0).astype(int)
-
-    data = data.apply(
-        lambda col: pd.to_datetime(col, format="%m/%d/%Y %H:%M", errors='coerce').fillna(pd.Timestamp('1970-01-01 00:00:00')) 
-        if col.name == 'start_watching' else col
+    # Ensure 'user_id' is a string for proper processing; missing ids stay missing for the checks
+    data['user_id'] = data['user_id'].astype(str).where(data['user_id'].notna())
+
+    # Split the malformed rows, whose whole line was read into 'user_id', and put their fields in
+    # place; rows that cannot be repaired keep the line and are quarantined as malformed_row
+    with stage('prepare_data.split_malformed_rows', len(data)) as record:
+        repaired = split_malformed_rows(data['user_id'])
+        data = merge_repaired_rows(data, repaired)
+        record['rows_out'] = len(repaired)
+
+    # Parse the typed columns; missing and unparsable values stay missing for the checks
+    user_id = pd.to_numeric(data['user_id'], errors='coerce')
+    play_time_ms = pd.to_numeric(data['play_time_ms'], errors='coerce')
+    with stage('prepare_data.dates', len(data)):
+        start_watching, _ = parse_timestamps(data['start_watching'])
+
+    # Check every row with one vectorized mask per rule. A row failing any goes to the
+    # quarantine as read, with the first rule it fails, and never reaches the aggregates
+    with stage('prepare_data.validate', len(data)) as record:
+        data = reject_rows(data, {
+            'malformed_row': data['user_id'].str.contains(',', na=False),
+            'missing_user_id': data['user_id'].isna(),
+            'invalid_user_id': user_id.isna() | ~user_id.between(*USER_ID_RANGE) | (user_id % 1 != 0),
+            'missing_start_watching': data['start_watching'].isna(),
+            'invalid_start_watching': start_watching.isna(),
+            'missing_play_time': data['play_time_ms'].isna(),
+            'invalid_play_time': play_time_ms.isna() | (play_time_ms < 0),
+        }, quarantine)
+        record['rows_out'] = len(data)
+    data = data.assign(
+        user_id=user_id[data.index].astype('int64'),
+        play_time_ms=play_time_ms[data.index].astype('int64'),
+        start_watching=start_watching[data.index],
     )
 
     # Validate and format datetime in 'start_watching' column
@@ -185,146 +248,217 @@ def prepare_data(data, column_mapping):
     # return data.where(pd.notnull(data), None)
     return data
 
-# Apply data preparation function
-cleaned_data = prepare_data(data, column_mapping)
-print(f"Number of rows in cleaned data: {cleaned_data.shape[0]}")
-print(cleaned_data[cleaned_data.isna().any(axis=1)])
-print(cleaned_data.iloc[3821])
+# Columns of the cleaned DataFrame and of the main table; the PostgreSQL sink stores the
+# dimension columns as integer keys, an embedded sink as text
+frame_columns = ['user_id', 'session_id', 'event_type', 'start_watching', 'content_type', 'device_type', 'province', 'city', 'location', 'play_time_ms']
+table_columns = ['user_id', 'session_id', 'event_type', 'event_time', 'content_type', 'device_type', 'province', 'city', 'location', 'play_time_ms']
 
-# Define ETL function to load cleaned data into PostgreSQL
-def etl(data, db_params):
+# Define ETL function to load cleaned data into the database
+@instrumented('etl')
+def etl(data, db_params, incremental=False, source=None, seen_index=False, checkpoint=None, quarantine=None):
     """
-    ETL function to load cleaned data into PostgreSQL database.
-    Creates additional summary tables for users by province and content type.
+    ETL function to load cleaned data into PostgreSQL database, or into an embedded
+    DuckDB/SQLite file when db_params is {'engine': ..., 'database': ...} (see sinks.open_sink).
+    With incremental=True the main table is kept and a changed source file is merged
+    on the dedup key, which inserts only new keys and newer events of loaded keys;
+    a file unchanged since its last load is skipped.
+    In PostgreSQL the main table is partitioned by event_time; a full reload replaces
+    only the partitions of the periods it loads and keeps the others, less the rows of
+    the dedup keys it loads again.
+    With seen_index=True events loaded by earlier runs are dropped before the load
+    (see seen_index.SeenIndex); a full reload rebuilds the index from the rows it
+    loads and the rows it keeps.
+    With a checkpoint (see checkpoints.ChunkCheckpoint) as data, every chunk is committed
+    with its checkpoint, and a load of the same file that failed before the merge resumes
+    after the last chunk it committed.
+    The rows a Quarantine received while the data was cleaned are counted by reason
+    in the quarantine_counts table once the load is done; a checkpoint given the
+    quarantine records the counts of every chunk with it instead.
+    Creates additional summary tables for users by province and content type, and
+    daily engagement rollups per user and per content (see sessions.engagement_rollups)
+    and the province x city x content type x device type x day cube usb3_cube (see cube)
+    for the days the run changed.
     """
     try:
-        # Connect to PostgreSQL database
-        conn = psycopg2.connect(**db_params)
-        cur = conn.cursor()
-        
-        # Drop main table if exists and create new one with province and city columns
-        drop_main_table_sql = "DROP TABLE IF EXISTS usb3;"
-        create_main_table_sql = """
-        CREATE TABLE usb3 (
-            id SERIAL PRIMARY KEY,
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            province VARCHAR(255),
-            city VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        
-        cur.execute(drop_main_table_sql)
-        cur.execute(create_main_table_sql)
-        conn.commit()
-        
-        # Insert data into temporary table
-        create_temp_table_sql = """
-        CREATE TEMPORARY TABLE user_behavior_temp (
-            user_id INT,
-            session_id VARCHAR(255),
-            event_type VARCHAR(255),
-            event_time TIMESTAMP,
-            content_type VARCHAR(255),
-            device_type VARCHAR(255),
-            province VARCHAR(255),
-            city VARCHAR(255),
-            location VARCHAR(255),
-            play_time_ms INT
-        );
-        """
-        cur.execute(create_temp_table_sql)
-        
-        # Populate temporary table with the cleaned data
-        for _, row in data.iterrows():
-            cur.execute(
-                """
-                INSERT INTO user_behavior_temp (user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """,
-                (row['user_id'], row['session_id'], row['event_type'], row['start_watching'], row['content_type'], row['device_type'], row['province'], row['city'], row['location'], row['play_time_ms'])
-            )
-        conn.commit()
-
-        # Insert only unique rows into the main table using CTE and ROW_NUMBER
-        dedup_insert_sql = """
-        WITH ranked_data AS (
-            SELECT *, ROW_NUMBER() OVER (PARTITION BY user_id, session_id, event_type ORDER BY event_time DESC) AS row_num
-            FROM user_behavior_temp
-        )
-        INSERT INTO usb3 (user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms)
-        SELECT user_id, session_id, event_type, event_time, content_type, device_type, province, city, location, play_time_ms
-        FROM ranked_data
-        WHERE row_num >= 1;
-        """
-        
-        cur.execute(dedup_insert_sql)
-        conn.commit()
-        
-        # Confirm number of rows inserted
-        cur.execute("SELECT COUNT(*) FROM usb3")
-        row_count = cur.fetchone()[0]
-        
-        print(f"Number of unique records inserted: {row_count}")
-        
-        # Create summary tables
-        # Table for the count of users from each province
-        drop_province_count_table = "DROP TABLE IF EXISTS users_by_province;"
-        create_province_count_table = """
-        CREATE TABLE users_by_province AS
-        SELECT province, COUNT(DISTINCT user_id) AS user_count
-        FROM usb3
-        GROUP BY province;
-        """
-        cur.execute(drop_province_count_table)
-        cur.execute(create_province_count_table)
-        conn.commit()
-        print("Created table 'users_by_province'.")
-
-        # Table for the count of users by content type
-        drop_content_type_count_table = "DROP TABLE IF EXISTS users_by_content_type;"
-        create_content_type_count_table = """
-        CREATE TABLE users_by_content_type AS
-        SELECT content_type, COUNT(DISTINCT user_id) AS user_count
-        FROM usb3
-        GROUP BY content_type;
-        """
-        cur.execute(drop_content_type_count_table)
-        cur.execute(create_content_type_count_table)
-        conn.commit()
-        print("Created table 'users_by_content_type'.")
-
-        # Retrieve results for display
-        print("\nResults:")
-        cur.execute("SELECT * FROM users_by_province")
-        province_results = cur.fetchall()
-        print("\nUsers by Province:")
-        for row in province_results:
-            print(row)
-
-        cur.execute("SELECT * FROM users_by_content_type")
-        content_type_results = cur.fetchall()
-        print("\nUsers by Content Type:")
-        for row in content_type_results:
-            print(row)
-
-        return row_count
+        # Open the sink: a warm pooled PostgreSQL connection, or the embedded database file
+        with open_sink(db_params) as sink:
+            watermark = None
+            with stage('etl.setup'):
+                sink.prepare('usb3', table_columns, incremental)
+
+                if incremental:
+                    _, last_fingerprint = sink.watermark(source)
+                    fingerprint = file_fingerprint(source)
+                    watermark = (source, fingerprint)
+                    # An unchanged file is skipped; a changed one is sent whole, as extracts are not ordered
+                    # by time: the merge on the dedup key, not an event-time cutoff, decides which rows are new
+                    if fingerprint == last_fingerprint:
+                        print(f"Source {source} is unchanged since the last load. Nothing new to insert.")
+                        data = []
+
+            # Every row is kept on a full reload, so the cleaned data is copied straight into
+            # the main table; incremental batches keep only the latest row per dedup key in-process
+            # and pass through the temporary table for the merge. A resumable load stages its
+            # chunks too, as the main table's partitions are emptied only when the merge runs
+            direct_load = not incremental and checkpoint is None
+            if incremental:
+                data = dedup_rows(data, 'start_watching', keep='latest')
+
+            # Drop the events earlier runs already loaded, so they never go over the wire. The index
+            # starts over when the table is rewritten (full reload) or was emptied outside this script
+            seen = SeenIndex(index_path(db_params, 'usb3')) if seen_index else None
+            if seen is not None:
+                if not incremental or sink.is_empty('usb3'):
+                    seen.reset()
+                data = seen.filter_rows(data, 'start_watching')
+
+            # Note the days the rows fall on, for the engagement rollups. A fully read DataFrame of a
+            # full reload is the new content of those days, so it is sessionized in memory
+            days = set()
+            data = collect_days(data, 'start_watching', days)
+            events = data if direct_load and isinstance(data, pd.DataFrame) else None
+
+            data = sink.encode(data)
+            with stage('etl.load') as record:
+                record['rows_out'] = sink.load(data, 'usb3', frame_columns, table_columns, direct=direct_load, checkpoint=checkpoint)
+
+            if incremental or checkpoint is not None:
+                # The merge may also replace rows of other days with the batch's newer events, and a
+                # resumed load also merges the chunks staged by the failed run
+                days |= sink.batch_days('usb3')
+
+            if not direct_load:
+                # Insert only the latest row per dedup key into the main table (every staged row on a
+                # full reload); an incremental batch is merged into the existing rows, added to the
+                # summary tables and advances the watermark in the same transaction
+                with stage('etl.merge') as record:
+                    record['rows_out'] = sink.merge('usb3', table_columns, keep='latest' if incremental else None, watermark=watermark, checkpoint=checkpoint, summaries=True)
+
+            if not incremental:
+                # A full reload rewrote only the partitions it loads; the rows of kept partitions whose
+                # dedup key it loaded again are removed, and the days they were on are sessionized again
+                with stage('etl.resolve'):
+                    resolved = sink.resolve_reload('usb3', keep=None)
+                if resolved:
+                    days |= resolved
+                    events = None
+
+            # Remember the loaded events only now that they are committed. A full reload forgot every
+            # event before the load; the events of the partitions it kept are added back
+            if seen is not None:
+                if not incremental:
+                    seen.add(sink.kept_events('usb3'), 'start_watching')
+                seen.commit()
+
+            # The cleaned data is consumed, so the quarantine holds every rejected row of the run;
+            # only the counts not yet recorded with a chunk checkpoint are added
+            if quarantine is not None:
+                quarantine.close()
+                sink.record_quarantine(quarantine.count_rows(source, 'usb3'))
+
+            # Update summary tables
+            # Counts of distinct users by province and by content type: the merge of an incremental
+            # batch already added its users, in the transaction that advanced the watermark, so a
+            # failed update is retried with the batch; a full reload rebuilds them from the whole main table
+            with stage('etl.summaries'):
+                # Confirm number of rows inserted
+                row_count = sink.count('usb3')
+                print(f"Number of unique records inserted: {row_count}")
+                if not incremental:
+                    sink.update_summaries('usb3')
+            print("Updated tables 'users_by_province' and 'users_by_content_type'.")
+
+            # Sessionize the events of the changed days and replace their engagement rollups;
+            # streamed and incremental loads read those days back from the main table
+            with stage('etl.engagement'):
+                if days:
+                    if events is None:
+                        events = sink.read_days('usb3', days)
+                    sink.replace_rollups(engagement_rollups(events, days), days, full=not incremental)
+            print("Updated tables 'daily_user_engagement' and 'daily_content_engagement'.")
+
+            # Rebuild the cube cells of the changed days, so slice and dice queries (see
+            # cube.EventCube) are answered without scanning the fact table
+            with stage('etl.cube'):
+                if days:
+                    sink.replace_rollups({'usb3_cube': build_cube(events)}, days, full=not incremental, definitions={'usb3_cube': CUBE_COLUMNS})
+            print("Updated table 'usb3_cube'.")
+
+            # The batch is merged and summarized; a resumable load no longer needs its staged chunks
+            if checkpoint is not None:
+                sink.drop_staging()
+
+            # Retrieve results for display
+            print("\nResults:")
+            province_results = sink.summary_rows('users_by_province')
+            print("\nUsers by Province:")
+            for row in province_results:
+                print(row)
+
+            content_type_results = sink.summary_rows('users_by_content_type')
+            print("\nUsers by Content Type:")
+            for row in content_type_results:
+                print(row)
+
+            return row_count
 
     except Exception as e:
         print(f"Error during ETL process: {e}")
-    finally:
-        # Clean up
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
-
-# Run the ETL process
-unique_rows = etl(cleaned_data, db_params)
-print(f"Number of unique records inserted: {unique_rows}")
+        # Finish the quarantine file; the counts of the chunks committed so far are recorded
+        if quarantine is not None:
+            quarantine.close()
+        if checkpoint is not None and checkpoint.committed is not None:
+            print(f"Chunks committed up to byte {checkpoint.committed} of {checkpoint.source} are kept; run again to resume the load.")
+
+# Run the ETL process when executed as a script; other modules import prepare_data and etl
+if __name__ == '__main__':
+    if resumable and event_store_path:
+        # A resumed load reads only the chunks the failed run did not commit
+        raise ValueError("event_store_path cannot be used with resumable: the store would hold only the resumed chunks")
+
+    # Rows failing the checks of prepare_data are collected here for this run
+    quarantine = Quarantine(quarantine_path('usb3', quarantine_format) if quarantine_format else None)
+
+    checkpoint = None
+    if resumable:
+        # Read and clean the CSV in byte ranges; etl() skips the chunks an earlier failed run committed,
+        # whose quarantined rows are in that run's quarantine file and counts
+        cleaned_data = checkpoint = ChunkCheckpoint(
+            csv_file_path, lambda chunk: prepare_data(chunk, column_mapping, quarantine), chunk_bytes, quarantine,
+            **csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\')
+        )
+    elif streaming:
+        # Clean each chunk as it is read; etl() loads the chunks one at a time.
+        # Iduser is read as text: malformed rows hold the whole quoted line in it.
+        cleaned_data = read_csv_chunks(
+            csv_file_path,
+            lambda chunk: prepare_data(chunk, column_mapping, quarantine),
+            chunk_size,
+            **csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\')
+        )
+    elif use_staging_cache:
+        # Reuse the cached cleaned data, or read, clean and cache the CSV file.
+        # The cache holds only clean rows; rows were quarantined by the run that filled it
+        cleaned_data = cached_prepare(
+            csv_file_path, lambda data, column_mapping: prepare_data(data, column_mapping, quarantine), column_mapping,
+            **csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\')
+        )
+    else:
+        # Load the CSV file
+        # Iduser is read as text: malformed rows hold the whole quoted line in it
+        with stage('read') as record:
+            data = pd.read_csv(csv_file_path, **csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\'))
+            record['rows_out'] = len(data)
+
+        # Apply data preparation function
+        cleaned_data = prepare_data(data, column_mapping, quarantine)
+        print(f"Number of rows in cleaned data: {cleaned_data.shape[0]}")
+
+    if event_store_path:
+        # Write the cleaned events to the store as they go to etl(); streamed chunks are written one at a time
+        cleaned_data = store_rows(cleaned_data, event_store_path, frame_columns)
+
+    target_params = {'engine': local_sink, 'database': local_database} if local_sink else db_params
+    unique_rows = etl(cleaned_data, target_params, incremental=incremental, source=csv_file_path, seen_index=use_seen_index, checkpoint=checkpoint, quarantine=quarantine)
+    print(f"Number of unique records inserted: {unique_rows}")
+    print(f"Connection pool usage: {pool_stats(db_params)}")
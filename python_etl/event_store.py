@@ -0,0 +1,278 @@
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+# Fixed-width types of the numeric columns of cleaned events. Timestamps are stored as
+# int32 minutes since 1970-01-01, text columns as codes into a dictionary of their values;
+# other numeric columns are stored as int64 or float64
+NUMERIC_TYPES = {
+    'user_id': np.int64,
+    'play_time_ms': np.int32,
+}
+
+# Stored in place of missing values: -1 in integer columns and codes (user_id and
+# play_time_ms are never negative after cleaning), the smallest int32 in timestamps
+MISSING = -1
+MISSING_MINUTE = np.iinfo(np.int32).min
+
+# Columns start on multiples of this many bytes, so every view is aligned for vectorized reads
+ALIGNMENT = 64
+
+_NS_PER_MINUTE = 60 * 10**9
+
+
+def _code_type(size):
+    # Narrowest signed type holding every code of a dictionary and MISSING
+    for dtype in (np.int8, np.int16, np.int32):
+        if size <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+
+
+def _minutes(col):
+    times = pd.to_datetime(col).to_numpy('datetime64[ns]').view(np.int64)
+    missing = times == np.iinfo(np.int64).min
+    if (times[~missing] % _NS_PER_MINUTE).any():
+        raise ValueError(f"Column '{col.name}' has timestamps that are not whole minutes.")
+    minutes = np.where(missing, MISSING_MINUTE, times // _NS_PER_MINUTE)
+    return minutes.astype(np.int32)
+
+
+class EventStoreWriter:
+    """
+    Write cleaned events chunk by chunk into an event store (see EventStore). Columns
+    are spilled to temporary files as the chunks arrive and laid out in the store file
+    by close(), once the size of every dictionary is known.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.selected = columns
+        self.columns = None
+        self.rows = 0
+        self.dictionaries = {}
+        self.spill_dir = tempfile.mkdtemp(prefix='event_store_', dir=os.path.dirname(os.path.abspath(path)))
+        self.spills = {}
+
+    def _layout(self, chunk):
+        columns = []
+        for name in chunk.columns:
+            col = chunk[name]
+            if pd.api.types.is_datetime64_any_dtype(col):
+                columns.append((name, 'minutes', np.int32))
+            elif name in NUMERIC_TYPES:
+                columns.append((name, 'int', NUMERIC_TYPES[name]))
+            elif isinstance(col.dtype, pd.CategoricalDtype) or not pd.api.types.is_numeric_dtype(col):
+                columns.append((name, 'dictionary', np.int32))
+                self.dictionaries[name] = pd.Index([], dtype=object)
+            elif pd.api.types.is_integer_dtype(col):
+                columns.append((name, 'int', np.int64))
+            else:
+                columns.append((name, 'float', np.float64))
+        return columns
+
+    def _encode(self, col, kind, dtype):
+        if kind == 'minutes':
+            return _minutes(col)
+        if kind == 'float':
+            return col.to_numpy(np.float64, na_value=np.nan)
+        if kind == 'int':
+            values = pd.to_numeric(col)
+            if (values.dropna() % 1 != 0).any():
+                raise ValueError(f"Column '{col.name}' has values that are not whole numbers.")
+            return values.fillna(MISSING).to_numpy().astype(dtype)
+
+        # Codes into the dictionary of the whole store: the distinct values of the chunk are
+        # looked up once, and values not seen before are appended to the dictionary
+        codes, uniques = pd.factorize(col)
+        uniques = pd.Index([str(value) for value in uniques], dtype=object)
+        dictionary = self.dictionaries[col.name]
+        new = uniques[~uniques.isin(dictionary)]
+        if len(new):
+            dictionary = self.dictionaries[col.name] = dictionary.append(new)
+        mapping = dictionary.get_indexer(uniques).astype(np.int32)
+        return np.where(codes >= 0, mapping[np.maximum(codes, 0)] if len(mapping) else MISSING, MISSING).astype(np.int32)
+
+    def append(self, chunk):
+        """
+        Add the rows of a cleaned DataFrame; every chunk must have the columns of the first,
+        or the columns the writer was created with.
+        """
+        if self.selected is not None:
+            chunk = chunk[self.selected]
+        if self.columns is None:
+            self.columns = self._layout(chunk)
+        elif list(chunk.columns) != [name for name, _, _ in self.columns]:
+            raise ValueError("Every chunk written to an event store must have the same columns.")
+        for name, kind, dtype in self.columns:
+            spill = self.spills.get(name)
+            if spill is None:
+                spill = self.spills[name] = open(os.path.join(self.spill_dir, f"{len(self.spills)}.bin"), 'wb')
+            self._encode(chunk[name], kind, dtype).tofile(spill)
+        self.rows += len(chunk)
+
+    def close(self):
+        """
+        Lay the columns out in the store file and write its layout and dictionaries to
+        {path}.json. Both are written under temporary names and replaced, and the layout
+        last, so a reader never pairs a layout with a file it does not describe.
+
+        Returns:
+        - Number of rows written.
+        """
+        layout = []
+        offset = 0
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                for name, kind, dtype in self.columns or []:
+                    self.spills[name].close()
+                    values = np.fromfile(self.spills[name].name, dtype=np.int32 if kind == 'dictionary' else dtype)
+                    if kind == 'dictionary':
+                        dtype = _code_type(len(self.dictionaries[name]))
+                        values = values.astype(dtype)
+                    f.write(b'\0' * (-offset % ALIGNMENT))
+                    offset += -offset % ALIGNMENT
+                    layout.append({'name': name, 'kind': kind, 'dtype': np.dtype(dtype).str, 'offset': offset})
+                    values.tofile(f)
+                    offset += values.nbytes
+            os.replace(self.path + '.tmp', self.path)
+
+            header = {
+                'rows': self.rows,
+                'columns': layout,
+                'dictionaries': {name: list(values) for name, values in self.dictionaries.items()},
+            }
+            with open(self.path + '.json.tmp', 'w') as f:
+                json.dump(header, f)
+            os.replace(self.path + '.json.tmp', self.path + '.json')
+        finally:
+            self.discard()
+        print(f"Wrote {self.rows} events to the event store {self.path}")
+        return self.rows
+
+    def discard(self):
+        """
+        Remove the spilled columns, e.g. when the rows stop arriving before the last chunk.
+        """
+        for spill in self.spills.values():
+            spill.close()
+            os.remove(spill.name)
+        self.spills = {}
+        if os.path.isdir(self.spill_dir):
+            os.rmdir(self.spill_dir)
+
+
+def write_events(data, path, columns=None):
+    """
+    Write a cleaned DataFrame, or an iterable of DataFrames, to an event store.
+
+    Parameters:
+    - data: Cleaned DataFrame or iterable of DataFrames.
+    - path: Store file; its layout and dictionaries go to {path}.json.
+    - columns: Columns to store; None stores every column of the first chunk.
+
+    Returns:
+    - Number of rows written.
+    """
+    writer = EventStoreWriter(path, columns)
+    try:
+        for chunk in [data] if isinstance(data, pd.DataFrame) else data:
+            writer.append(chunk)
+    except BaseException:
+        writer.discard()
+        raise
+    return writer.close()
+
+
+def store_rows(data, path, columns=None):
+    """
+    Write a DataFrame to an event store and return it, or lazily write each chunk of
+    an iterable of DataFrames as it passes; the store is complete after the last chunk.
+    """
+    if isinstance(data, pd.DataFrame):
+        write_events(data, path, columns)
+        return data
+    return _store_chunks(data, path, columns)
+
+
+def _store_chunks(chunks, path, columns):
+    writer = EventStoreWriter(path, columns)
+    try:
+        for chunk in chunks:
+            writer.append(chunk)
+            yield chunk
+    except BaseException:
+        # A load that fails or stops early leaves the previous store in place
+        writer.discard()
+        raise
+    writer.close()
+
+
+class EventStore:
+    """
+    Cleaned events in an event store file, opened as memory-mapped NumPy arrays.
+    Opening reads only the layout and the dictionaries; the columns are views of the
+    file, so a column is read from disk (or the page cache) only when it is used.
+
+    Aggregate the raw columns directly, e.g. the play time by content type:
+        store = EventStore(path)
+        np.bincount(store['content_type'], weights=store['play_time_ms'])
+    (codes are -1 for missing values; see MISSING and MISSING_MINUTE)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.json') as f:
+            header = json.load(f)
+        self.rows = header['rows']
+        self.kinds = {column['name']: column['kind'] for column in header['columns']}
+        self.dictionaries = {name: np.array(values, dtype=object) for name, values in header['dictionaries'].items()}
+        self.columns = {}
+        if self.rows:
+            data = np.memmap(path, dtype=np.uint8, mode='r')
+            for column in header['columns']:
+                dtype = np.dtype(column['dtype'])
+                self.columns[column['name']] = np.frombuffer(data, dtype=dtype, count=self.rows, offset=column['offset'])
+        else:
+            for column in header['columns']:
+                self.columns[column['name']] = np.empty(0, dtype=column['dtype'])
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name):
+        """
+        Raw column: int32 minutes for timestamps, codes for text columns, values otherwise.
+        """
+        return self.columns[name]
+
+    def column(self, name):
+        """
+        Column as a Series: timestamps as datetime64[ns], text as categorical,
+        integer columns as nullable integers when they hold missing values.
+        """
+        values = self.columns[name]
+        kind = self.kinds[name]
+        if kind == 'minutes':
+            missing = values == MISSING_MINUTE
+            times = values.astype(np.int64) * _NS_PER_MINUTE
+            times[missing] = np.iinfo(np.int64).min
+            return pd.Series(times.view('datetime64[ns]'), name=name)
+        if kind == 'dictionary':
+            categories = pd.Index(self.dictionaries[name], dtype=object)
+            return pd.Series(pd.Categorical.from_codes(values, categories=categories), name=name)
+        if kind == 'int':
+            missing = values == MISSING
+            if missing.any():
+                return pd.Series(pd.arrays.IntegerArray(values.astype(np.int64), missing), name=name)
+        return pd.Series(values, name=name, copy=False)
+
+    def to_frame(self, columns=None):
+        """
+        Return the events as a cleaned DataFrame, e.g. to load them again with etl()
+        without reading and cleaning the CSV.
+        """
+        return pd.DataFrame({name: self.column(name) for name in (columns or self.columns)})
@@ -0,0 +1,175 @@
+import hashlib
+
+# Table keeping, per source file, the last loaded event_time and the file fingerprint
+WATERMARK_TABLE = 'etl_watermarks'
+
+# Key used by the ROW_NUMBER() dedup CTE, and the key the merge matches existing rows on
+DEDUP_KEY = ['user_id', 'session_id', 'event_type']
+
+
+def file_fingerprint(csv_file_path, block_size=1024 * 1024):
+    """
+    Return the SHA-256 hex digest of a file's contents, read in blocks.
+    """
+    digest = hashlib.sha256()
+    with open(csv_file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ensure_watermark_table(cur):
+    """
+    Create the watermark table if it does not exist yet.
+    """
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+        source VARCHAR(1024) PRIMARY KEY,
+        target_table VARCHAR(255),
+        last_event_time TIMESTAMP,
+        file_fingerprint VARCHAR(64),
+        loaded_at TIMESTAMP DEFAULT now()
+    );
+    """)
+
+
+def get_watermark(cur, source):
+    """
+    Return (last_event_time, file_fingerprint) for a source, or (None, None) if it was never loaded.
+    """
+    cur.execute(
+        f"SELECT last_event_time, file_fingerprint FROM {WATERMARK_TABLE} WHERE source = %s",
+        (source,)
+    )
+    row = cur.fetchone()
+    return row if row else (None, None)
+
+
+def set_watermark(cur, source, target_table, last_event_time, fingerprint):
+    """
+    Record the watermark for a source. Call it in the same transaction as the merge.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO {WATERMARK_TABLE} (source, target_table, last_event_time, file_fingerprint, loaded_at)
+        VALUES (%s, %s, %s, %s, now())
+        ON CONFLICT (source) DO UPDATE
+        SET target_table = EXCLUDED.target_table,
+            last_event_time = GREATEST({WATERMARK_TABLE}.last_event_time, EXCLUDED.last_event_time),
+            file_fingerprint = EXCLUDED.file_fingerprint,
+            loaded_at = EXCLUDED.loaded_at
+        """,
+        (source, target_table, last_event_time, fingerprint)
+    )
+
+
+def ensure_dedup_key(cur, table):
+    """
+    Index the dedup key the merge looks rows up by. On a plain table the index is unique;
+    a partitioned table cannot hold a unique index without its partition column, so
+    there each partition gets a plain index and the merge keeps one row per key.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    unique = '' if cur.fetchone()[0] == 'p' else 'UNIQUE '
+    cur.execute(
+        f"CREATE {unique}INDEX IF NOT EXISTS {table}_dedup_key ON {table} ({', '.join(DEDUP_KEY)});"
+    )
+
+
+def merge_sql(target_table, temp_table, columns, keep='latest'):
+    """
+    Build the dedup + merge statement from the temp table into the main table.
+
+    Rows of the main table that a newly loaded row supersedes are deleted and the
+    winners inserted in the same statement, as INSERT ... ON CONFLICT would update
+    them; ON CONFLICT needs a unique index, which a partitioned table cannot have on
+    the dedup key. Only rows older (keep='latest') or newer (keep='first') than the
+    batch can be superseded, so the other partitions are pruned.
+
+    Parameters:
+    - target_table: Main table with an index on DEDUP_KEY (see ensure_dedup_key).
+    - temp_table: Temp table holding the newly loaded batch.
+    - columns: Columns to copy, including DEDUP_KEY and event_time.
+    - keep: 'latest' keeps the newest event_time per key (ORDER BY event_time DESC),
+      'first' keeps the oldest one (ORDER BY event_time).
+
+    Returns:
+    - SQL string; the row count of the statement is the number of rows inserted or replaced.
+    """
+    order = 'DESC' if keep == 'latest' else 'ASC'
+    newer = '>' if keep == 'latest' else '<'
+    bound = 'MAX' if keep == 'latest' else 'MIN'
+    keys = ', '.join(DEDUP_KEY)
+    column_list = ', '.join(columns)
+    same_key = ' AND '.join(f"t.{c} = w.{c}" for c in DEDUP_KEY)
+    return f"""
+    WITH ranked_data AS (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY event_time {order}) AS row_num
+        FROM {temp_table}
+    ),
+    winners AS (
+        SELECT {column_list}
+        FROM ranked_data
+        WHERE row_num = 1
+    ),
+    superseded AS (
+        DELETE FROM {target_table} t
+        USING winners w
+        WHERE {same_key}
+            AND w.event_time {newer} t.event_time
+            AND (SELECT {bound}(event_time) FROM {temp_table}) {newer} t.event_time
+        RETURNING {', '.join(f"t.{c}" for c in DEDUP_KEY)}
+    )
+    INSERT INTO {target_table} ({column_list})
+    SELECT {column_list}
+    FROM winners w
+    WHERE NOT EXISTS (SELECT 1 FROM {target_table} t WHERE {same_key})
+        OR ({keys}) IN (SELECT {keys} FROM superseded);
+    """
+
+
+def resolve_reload_sql(target_table, keep='latest'):
+    """
+    Build the statement removing the rows a full reload duplicated. A full reload empties
+    and rewrites only the partitions it loads, and a partitioned table has no unique index
+    on the dedup key, so a key whose earlier row sits in a kept partition is there twice.
+
+    Parameters:
+    - target_table: Partitioned main table.
+    - keep: 'latest' keeps the newest event_time per key over the reloaded and the kept rows,
+      'first' the oldest one, as merge_sql would; None keeps every reloaded row and removes
+      the kept rows of the keys the reload holds.
+
+    Returns:
+    - SQL string taking the names of the reloaded partitions as the parameter 'partitions'
+      (a list); it returns the event_time of every deleted row.
+    """
+    keys = ', '.join(DEDUP_KEY)
+    same_key = ' AND '.join(f"t.{c} = r.{c}" for c in DEDUP_KEY)
+    if keep is None:
+        return f"""
+    DELETE FROM {target_table} t
+    USING (SELECT DISTINCT {keys} FROM {target_table} WHERE tableoid = ANY(%(partitions)s::regclass[])) r
+    WHERE {same_key}
+        AND t.tableoid <> ALL(%(partitions)s::regclass[])
+    RETURNING t.event_time;
+    """
+    # Equal event times are broken by the id, in favour of the row loaded last
+    order = 'DESC NULLS FIRST' if keep == 'latest' else 'ASC NULLS LAST'
+    return f"""
+    WITH reloaded AS (
+        SELECT DISTINCT {keys} FROM {target_table} WHERE tableoid = ANY(%(partitions)s::regclass[])
+    ),
+    ranked AS (
+        SELECT t.id, {', '.join(f"t.{c}" for c in DEDUP_KEY)},
+            ROW_NUMBER() OVER (PARTITION BY {', '.join(f"t.{c}" for c in DEDUP_KEY)} ORDER BY t.event_time {order}, t.id DESC) AS row_num
+        FROM {target_table} t
+        JOIN reloaded USING ({keys})
+    )
+    DELETE FROM {target_table} t
+    USING ranked r
+    WHERE {same_key}
+        AND t.id = r.id
+        AND r.row_num > 1
+    RETURNING t.event_time;
+    """
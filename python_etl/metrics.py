@@ -0,0 +1,247 @@
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+try:
+    from airflow.operators.python import get_current_context
+except ImportError:
+    get_current_context = None
+
+# Metrics sinks. Every finished stage is appended to the JSON lines file; set
+# ETL_METRICS_JSONL to an empty string to turn it off. Set ETL_METRICS_PROM to a
+# node_exporter textfile path to also publish the latest value of every stage there.
+DEFAULT_METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics')
+JSONL_PATH = os.environ.get('ETL_METRICS_JSONL', os.path.join(DEFAULT_METRICS_DIR, 'etl_metrics.jsonl'))
+PROMETHEUS_PATH = os.environ.get('ETL_METRICS_PROM', '')
+
+# Id of the records of a process that runs outside any DAG run and sets no ETL_RUN_ID;
+# drawn on first use and inherited by forked worker processes
+_process_run_id = None
+
+_records = []
+_lock = threading.Lock()
+_local = threading.local()
+
+
+class PeakRssSampler:
+    """
+    Sample the resident set size of this process in a background thread and keep the peak.
+    Needs psutil; without it the peak is reported as None.
+    """
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if psutil is None:
+            return self
+        process = psutil.Process()
+        self.peak = process.memory_info().rss
+
+        def sample():
+            while not self._stop.wait(self.interval):
+                self.peak = max(self.peak, process.memory_info().rss)
+
+        self._thread = threading.Thread(target=sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self.peak = max(self.peak, psutil.Process().memory_info().rss)
+        return self.peak
+
+
+def run_id():
+    """
+    Identifier of the current run, resolved each time a record is made, as a long-lived
+    Airflow worker runs many DAG runs and the DAG file is imported before any of them:
+    the run id of the Airflow task being executed, else ETL_RUN_ID or the DAG run id
+    Airflow exports to the task environment, else an id drawn once per process.
+    """
+    global _process_run_id
+    if get_current_context is not None:
+        try:
+            return get_current_context()['run_id']
+        except Exception:
+            pass
+    explicit = os.environ.get('ETL_RUN_ID') or os.environ.get('AIRFLOW_CTX_DAG_RUN_ID')
+    if explicit:
+        return explicit
+    if _process_run_id is None:
+        _process_run_id = uuid.uuid4().hex[:12]
+    return _process_run_id
+
+
+def _active_stages():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+def _row_count(data):
+    if isinstance(data, int):
+        return data
+    if hasattr(data, 'columns'):
+        return len(data)
+    return None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Measure one stage: wall time, rows in and out, rows dropped per rule,
+    peak RSS and time spent waiting on PostgreSQL. Stages can be nested;
+    the record is written to the sinks when the block ends.
+
+    Parameters:
+    - name: Stage name, dotted for sub-stages (e.g. 'prepare_data.fill_missing').
+    - rows_in: Rows entering the stage, if known.
+
+    Yields:
+    - The stage record; the block sets record['rows_out'] (it defaults to rows_in).
+    """
+    record = {
+        'run_id': run_id(),
+        'stage': name,
+        'started_at': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+        'rows_in': rows_in,
+        'rows_out': rows_in,
+        'dropped': defaultdict(int),
+        'db_seconds': 0.0,
+    }
+    stages = _active_stages()
+    stages.append(record)
+    sampler = PeakRssSampler().start()
+    start = time.perf_counter()
+    try:
+        yield record
+    except BaseException as e:
+        record['error'] = repr(e)
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record['peak_rss_bytes'] = sampler.stop()
+        record['dropped'] = dict(record['dropped'])
+        rows = record['rows_in'] if record['rows_in'] is not None else record['rows_out']
+        record['rows_per_second'] = rows / record['seconds'] if rows and record['seconds'] > 0 else None
+        stages.pop()
+        _emit(record, flush_prometheus=not stages)
+
+
+def instrumented(name):
+    """
+    Decorator measuring a function as a stage. The first argument is the
+    input DataFrame; the rows out are taken from the returned DataFrame or count.
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(data, *args, **kwargs):
+            with stage(name, _row_count(data)) as record:
+                result = func(data, *args, **kwargs)
+                record['rows_out'] = _row_count(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def dropped(rule, count):
+    """
+    Count rows removed by a rule in the innermost active stage.
+    """
+    stages = _active_stages()
+    if stages and count:
+        stages[-1]['dropped'][rule] += int(count)
+
+
+def record_db_time(seconds):
+    """
+    Add time spent in PostgreSQL to every active stage of this thread.
+    """
+    for record in _active_stages():
+        record['db_seconds'] += seconds
+
+
+def records():
+    """
+    Return the stage records finished in this process, oldest first.
+    """
+    with _lock:
+        return list(_records)
+
+
+def _emit(record, flush_prometheus):
+    with _lock:
+        _records.append(record)
+        if JSONL_PATH:
+            os.makedirs(os.path.dirname(JSONL_PATH) or '.', exist_ok=True)
+            with open(JSONL_PATH, 'a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        if PROMETHEUS_PATH and flush_prometheus:
+            _write_prometheus(PROMETHEUS_PATH, _records)
+
+
+def _write_prometheus(path, stage_records):
+    # Gauges hold the latest value of every stage; written atomically so the collector never reads half a file
+    latest = {}
+    for record in stage_records:
+        latest[record['stage']] = record
+
+    gauges = {
+        'etl_stage_seconds': ('Wall time of the last run of the stage.', 'seconds'),
+        'etl_stage_db_seconds': ('Time the stage spent waiting on PostgreSQL.', 'db_seconds'),
+        'etl_stage_rows_in': ('Rows entering the stage.', 'rows_in'),
+        'etl_stage_rows_out': ('Rows leaving the stage.', 'rows_out'),
+        'etl_stage_peak_rss_bytes': ('Peak resident set size during the stage.', 'peak_rss_bytes'),
+    }
+    lines = []
+    for metric, (help_text, field) in gauges.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        for name, record in latest.items():
+            if record[field] is not None:
+                lines.append(f'{metric}{{stage="{name}"}} {record[field]}')
+    lines += ["# HELP etl_stage_rows_dropped Rows removed by each rule of the stage.", "# TYPE etl_stage_rows_dropped gauge"]
+    for name, record in latest.items():
+        for rule, count in record['dropped'].items():
+            lines.append(f'etl_stage_rows_dropped{{stage="{name}",rule="{rule}"}} {count}')
+
+    with open(path + '.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(path + '.tmp', path)
+
+
+def push_to_xcom(ti=None, key='etl_metrics'):
+    """
+    Push the stage records of this run to Airflow XCom. Without a task instance
+    the current Airflow context is used; outside Airflow nothing is pushed.
+
+    Returns:
+    - True when the records were pushed.
+    """
+    if ti is None:
+        if get_current_context is None:
+            return False
+        try:
+            ti = get_current_context()['ti']
+        except Exception:
+            return False
+    # Only the records of the task's own run; a worker process may have run earlier DAG runs
+    run_records = [record for record in records() if record['run_id'] == ti.run_id]
+    ti.xcom_push(key=key, value=json.loads(json.dumps(run_records, default=str)))
+    return True
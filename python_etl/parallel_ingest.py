@@ -0,0 +1,205 @@
+import glob
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from bulk_load import copy_chunks
+from db import pool_stats, pooled_connection, transaction
+from dedup import dedup_frame
+from dimensions import create_wide_view, encode_frame, ensure_dimension_tables
+from etl3 import column_mapping, db_params, prepare_data
+from etl_with_null_data_source import prepare_data as repair_and_prepare_data
+from incremental import ensure_dedup_key, merge_sql
+from metrics import stage
+from partitions import prepare_partitions, staged_periods
+from quarantine import Quarantine, quarantine_path, record_counts
+from schema import csv_read_options
+from sessions import engagement_rollups
+from sinks import PostgresSink
+from staging_cache import cached_prepare
+from summaries import batch_rows_sql, ensure_summary_tables, update_summaries
+
+# Directory or glob of the user-behavior extracts to ingest
+source_pattern = 'C:/Users/NDS/user_behavior_task/airflowtask2/airflow/sample_files/*.csv'
+
+# Files with malformed rows (a whole line quoted into the first column) are cleaned by the
+# prepare_data of etl_with_null_data_source, which repairs them; its rows failing validation are
+# written per file to quarantine/ ('parquet' or 'csv'), or with None only counted
+quarantine_format = 'parquet'
+
+# Shared staging table the workers COPY into; UNLOGGED because it is rebuilt every run
+staging_table = 'user_behavior_staging'
+
+# Column order of the cleaned DataFrame and of the main/staging tables
+frame_columns = ['user_id', 'session_id', 'event_type', 'start_watching', 'content_type_id', 'device_type_id', 'province_id', 'city_id', 'location_id', 'play_time_ms']
+table_columns = ['user_id', 'session_id', 'event_type', 'event_time', 'content_type_id', 'device_type_id', 'province_id', 'city_id', 'location_id', 'play_time_ms']
+
+
+def list_source_files(pattern):
+    """
+    Return the CSV files matching a glob, or every CSV file in a directory.
+    """
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, '*.csv')
+    return sorted(glob.glob(pattern))
+
+
+def has_malformed_rows(csv_file_path):
+    """
+    True when a line of the file starts with a quote: a row read whole into the
+    first column, which etl3.prepare_data cannot parse.
+    """
+    with open(csv_file_path, 'rb') as f:
+        return any(line.startswith(b'"') for line in f)
+
+
+def prepare_staging(cur, main_table, staging_table):
+    """
+    Create the main table (partitioned by event_time), its dedup key, the dimension
+    tables and the wide view if needed, and a fresh UNLOGGED staging table with the
+    main table's columns.
+    """
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {main_table} (
+        id SERIAL,
+        user_id INT,
+        session_id VARCHAR(255),
+        event_type VARCHAR(255),
+        event_time TIMESTAMP,
+        content_type_id INT,
+        device_type_id INT,
+        province_id INT,
+        city_id INT,
+        location_id INT,
+        play_time_ms INT
+    ) PARTITION BY RANGE (event_time);
+    """)
+    ensure_dedup_key(cur, main_table)
+    ensure_dimension_tables(cur)
+    create_wide_view(cur, main_table)
+    cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+    cur.execute(f"CREATE UNLOGGED TABLE {staging_table} AS SELECT {', '.join(table_columns)} FROM {main_table} WITH NO DATA;")
+
+
+def stage_frame(cleaned_data, db_params, staging_table):
+    """
+    Encode the dimensions of a cleaned DataFrame and COPY it into the staging
+    table over a pooled connection.
+
+    Returns:
+    - Number of rows loaded.
+    """
+    with pooled_connection(db_params) as conn:
+        cleaned_data = encode_frame(conn, cleaned_data)
+        with conn.cursor() as cur:
+            return copy_chunks(conn, cur, cleaned_data, staging_table, frame_columns, table_columns)
+
+
+def replace_staged_rollups(conn, main_table, days):
+    """
+    Rebuild the daily engagement rollups of the given days from the main table. Take the
+    days with PostgresSink.batch_days before the merge, which may replace rows of other days.
+    """
+    if days:
+        sink = PostgresSink(conn)
+        sink.replace_rollups(engagement_rollups(sink.read_days(main_table, days), days), days)
+
+
+def load_file(csv_file_path, db_params, staging_table, main_table='usb1'):
+    """
+    Worker: parse and clean one file (or reuse its cached cleaned copy), deduplicate
+    it in-process, encode its dimensions and COPY it into the staging table over the
+    worker's own pooled connection. A file with malformed rows is cleaned like
+    etl_with_null_data_source does: the rows are repaired and the rows failing
+    validation quarantined.
+
+    Returns:
+    - (csv_file_path, number of rows loaded, quarantine counts for quarantine.record_counts)
+    """
+    with stage('ingest.load_file') as record:
+        quarantine = None
+        if has_malformed_rows(csv_file_path):
+            name = os.path.splitext(os.path.basename(csv_file_path))[0]
+            quarantine = Quarantine(quarantine_path(f"{main_table}_{name}", quarantine_format) if quarantine_format else None)
+            cleaned_data = cached_prepare(
+                csv_file_path, lambda data, column_mapping: repair_and_prepare_data(data, column_mapping, quarantine), column_mapping,
+                **csv_read_options(dtype={'Iduser': str}, quotechar='"', escapechar='\\')
+            )
+            quarantine.close()
+        else:
+            cleaned_data = cached_prepare(csv_file_path, prepare_data, column_mapping, **csv_read_options())
+        cleaned_data = dedup_frame(cleaned_data, 'start_watching', keep='latest')
+        row_count = stage_frame(cleaned_data, db_params, staging_table)
+        record['rows_out'] = row_count
+    return csv_file_path, row_count, quarantine.count_rows(csv_file_path, main_table) if quarantine is not None else []
+
+
+def ingest_files(pattern, db_params, main_table='usb1', max_workers=None):
+    """
+    Load many extracts in parallel, one worker process per core, then merge
+    the staged rows into the main table and update the summary tables and the
+    daily engagement rollups of the days the batch changed.
+
+    Parameters:
+    - pattern: Directory or glob of CSV files.
+    - db_params: Connection parameters, used by the coordinator and by every worker.
+    - main_table: Main event table; it is kept and merged into on the dedup key.
+    - max_workers: Number of worker processes (defaults to the number of cores).
+
+    Returns:
+    - Number of rows in the main table after the merge.
+    """
+    paths = list_source_files(pattern)
+    if not paths:
+        raise ValueError(f"No CSV files match {pattern}.")
+
+    with pooled_connection(db_params) as conn:
+        # Step 1: Create the main table if needed and a fresh staging table the workers can all see
+        with transaction(conn) as cur:
+            prepare_staging(cur, main_table, staging_table)
+
+        try:
+            # Step 2: Parse, clean and load every file in its own process
+            start = time.perf_counter()
+            staged_rows = 0
+            quarantine_counts = []
+            with stage('ingest.staging') as record, ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+                futures = [pool.submit(load_file, path, db_params, staging_table, main_table) for path in paths]
+                for future in as_completed(futures):
+                    path, row_count, counts = future.result()
+                    staged_rows += row_count
+                    quarantine_counts += counts
+                    print(f"Staged {row_count} rows from {path}")
+                record['rows_out'] = staged_rows
+            elapsed = time.perf_counter() - start
+            print(f"Staged {staged_rows} rows from {len(paths)} files in {elapsed:.2f}s ({staged_rows / elapsed:,.0f} rows/s)")
+
+            # Step 3: Deduplicate across files and merge into the main table, then update the summaries
+            # and count the quarantined rows with the merge. The days the batch changes are taken
+            # first, as the merge replaces the rows of its keys
+            days = PostgresSink(conn, staging_table).batch_days(main_table)
+            with stage('ingest.merge', staged_rows) as record, transaction(conn) as cur:
+                prepare_partitions(cur, main_table, staged_periods(cur, staging_table))
+                cur.execute(merge_sql(main_table, staging_table, table_columns, keep='latest'))
+                record['rows_out'] = cur.rowcount
+                ensure_summary_tables(cur)
+                update_summaries(cur, batch_rows_sql(main_table, staging_table))
+                record_counts(cur, quarantine_counts)
+
+            # Step 4: Sessionize the changed days again and replace their engagement rollups
+            with stage('ingest.engagement'):
+                replace_staged_rollups(conn, main_table, days)
+        finally:
+            # The staging table is rebuilt by every run; never leave it behind, even when a worker fails
+            with transaction(conn) as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {staging_table};")
+
+        with transaction(conn) as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {main_table}")
+            row_count = cur.fetchone()[0]
+        print(f"Number of unique records in {main_table}: {row_count}")
+        return row_count
+
+if __name__ == '__main__':
+    ingest_files(source_pattern, db_params)
+    print(f"Connection pool usage: {pool_stats(db_params)}")
@@ -0,0 +1,178 @@
+import re
+
+import pandas as pd
+
+# Size of the event-table partitions: 'month' or 'day'. Partitions of another size
+# already in a table would overlap, so changing it needs the table to be rebuilt
+PARTITION_GRANULARITY = 'month'
+
+_PERIOD_FREQUENCIES = {'month': 'M', 'day': 'D'}
+_NAME_FORMATS = {'month': '%Y%m', 'day': '%Y%m%d'}
+
+
+def partition_name(table, start, granularity=PARTITION_GRANULARITY):
+    """
+    Name of the partition starting at start; rows without event_time go to {table}_undated.
+    """
+    if start is None:
+        return f"{table}_undated"
+    return f"{table}_{start.strftime(_NAME_FORMATS[granularity])}"
+
+
+def _period_end(start, granularity):
+    return start + (pd.DateOffset(months=1) if granularity == 'month' else pd.DateOffset(days=1))
+
+
+def frame_periods(times, granularity=PARTITION_GRANULARITY):
+    """
+    Return the start of every period holding one of the timestamps, plus None when some are missing.
+    """
+    times = pd.to_datetime(pd.Series(times))
+    periods = [period.start_time for period in times.dropna().dt.to_period(_PERIOD_FREQUENCIES[granularity]).unique()]
+    if times.isna().any():
+        periods.append(None)
+    return periods
+
+
+def staged_periods(cur, staging_table, granularity=PARTITION_GRANULARITY):
+    """
+    Return the start of every period holding rows of a staging table, plus None for rows without event_time.
+    """
+    cur.execute(f"SELECT DISTINCT date_trunc(%s, event_time) FROM {staging_table};", (granularity,))
+    return [pd.Timestamp(start) if start is not None else None for start, in cur.fetchall()]
+
+
+def has_partitioned_layout(cur, table, columns):
+    """
+    True when the table exists, is partitioned and has exactly these columns besides id.
+    A full reload keeps such a table and replaces only the periods it loads.
+    """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (table,))
+    row = cur.fetchone()
+    if row is None or row[0] != 'p':
+        return False
+    cur.execute(
+        "SELECT column_name FROM information_schema.columns WHERE table_name = %s AND table_schema = current_schema() AND column_name <> 'id'",
+        (table,)
+    )
+    return sorted(name for name, in cur.fetchall()) == sorted(columns)
+
+
+def ensure_partitions(cur, table, periods, granularity=PARTITION_GRANULARITY):
+    """
+    Create the partitions of the given periods that do not exist yet, and the
+    default partition for rows without event_time.
+
+    The default partition is limited to NULL event times by a CHECK constraint,
+    so PostgreSQL does not scan it when a new partition is attached.
+    """
+    undated = partition_name(table, None)
+    cur.execute(f"CREATE TABLE IF NOT EXISTS {undated} PARTITION OF {table} DEFAULT;")
+    cur.execute(
+        "SELECT 1 FROM pg_constraint WHERE conrelid = to_regclass(%s) AND conname = %s;",
+        (undated, f"{undated}_null_time")
+    )
+    if cur.fetchone() is None:
+        cur.execute(f"ALTER TABLE {undated} ADD CONSTRAINT {undated}_null_time CHECK (event_time IS NULL);")
+
+    for start in periods:
+        if start is None:
+            continue
+        cur.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(table, start, granularity)} PARTITION OF {table} FOR VALUES FROM (%s) TO (%s);",
+            (start.to_pydatetime(), _period_end(start, granularity).to_pydatetime())
+        )
+
+
+def prepare_partitions(cur, table, periods, replace=False, granularity=PARTITION_GRANULARITY):
+    """
+    Make sure the partitions of a batch exist before it is written.
+
+    Parameters:
+    - cur: Open psycopg2 cursor; the caller commits.
+    - table: Partitioned event table.
+    - periods: Period starts from frame_periods or staged_periods.
+    - replace: Empty these partitions with TRUNCATE, so a reload rewrites only the periods it covers.
+    """
+    ensure_partitions(cur, table, periods, granularity)
+    if replace and periods:
+        names = ', '.join(partition_name(table, start, granularity) for start in periods)
+        cur.execute(f"TRUNCATE {names};")
+
+
+def partitioned_chunks(conn, table, chunks, time_column, replace=False, granularity=PARTITION_GRANULARITY, prepared=None):
+    """
+    Yield a DataFrame, or each chunk of an iterable of DataFrames, after creating
+    the partitions it needs, for a COPY straight into the partitioned table.
+    The partitions are created in the open transaction, so they commit with the chunk.
+
+    Parameters:
+    - conn: Open psycopg2 connection the chunks are copied over.
+    - table: Partitioned event table.
+    - chunks: DataFrame or iterable of DataFrames.
+    - time_column: Column of the chunks holding event_time.
+    - replace: Empty each partition (TRUNCATE) the first time a chunk reaches it.
+    - prepared: Set the periods of the chunks are added to, e.g. to know which partitions
+      a full reload emptied.
+    """
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    seen = prepared if prepared is not None else set()
+    for chunk in chunks:
+        periods = [start for start in frame_periods(chunk[time_column], granularity) if start not in seen]
+        with conn.cursor() as cur:
+            prepare_partitions(cur, table, periods, replace, granularity)
+        seen.update(periods)
+        yield chunk
+
+
+def list_partitions(cur, table):
+    """
+    Return (partition name, start, end) for every partition of a table, oldest first;
+    the default partition has no bounds.
+    """
+    cur.execute("""
+    SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+    FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = to_regclass(%s);
+    """, (table,))
+    partitions = []
+    for name, bound in cur.fetchall():
+        match = re.search(r"FROM \('([^']+)'\) TO \('([^']+)'\)", bound)
+        start, end = (pd.Timestamp(match.group(1)), pd.Timestamp(match.group(2))) if match else (None, None)
+        partitions.append((name, start, end))
+    return sorted(partitions, key=lambda partition: (partition[1] is None, partition[1]))
+
+
+def detach_partitions(cur, table, before, drop=False):
+    """
+    Detach every partition that ends on or before a date. Detaching only changes the
+    catalog, so old events leave the table without a row-by-row DELETE; the detached
+    tables can be archived or dropped.
+
+    The summary tables still count the users of detached rows until the next full reload.
+
+    Parameters:
+    - cur: Open psycopg2 cursor; the caller commits.
+    - table: Partitioned event table.
+    - before: Date or timestamp; partitions ending after it are kept.
+    - drop: Drop the detached tables instead of keeping them.
+
+    Returns:
+    - Names of the detached tables ({partition}_detached_{time}); with drop=True, of the dropped partitions.
+    """
+    before = pd.Timestamp(before)
+    suffix = pd.Timestamp.now().strftime('%Y%m%d%H%M%S')
+    detached = []
+    for name, start, end in list_partitions(cur, table):
+        if end is not None and end <= before:
+            cur.execute(f"ALTER TABLE {table} DETACH PARTITION {name};")
+            if drop:
+                cur.execute(f"DROP TABLE {name};")
+            else:
+                # Free the partition name, so a later load of the period can create it again
+                cur.execute(f"ALTER TABLE {name} RENAME TO {name}_detached_{suffix};")
+                name = f"{name}_detached_{suffix}"
+            detached.append(name)
+    return detached
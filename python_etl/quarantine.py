@@ -0,0 +1,154 @@
+import os
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from metrics import dropped, run_id
+
+# Directory holding the quarantine files, one per run and target table
+DEFAULT_QUARANTINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'quarantine')
+
+# Table counting the rows every run quarantined, by reason
+COUNTS_TABLE = 'quarantine_counts'
+
+
+def quarantine_path(table, format='parquet', quarantine_dir=DEFAULT_QUARANTINE_DIR):
+    """
+    Path of the quarantine file of this run for one target table ('parquet' or 'csv').
+    """
+    return os.path.join(quarantine_dir, f"{table}_{run_id()}.{format}")
+
+
+def failure_reasons(masks, index):
+    """
+    Reason code of every row: the first rule in masks the row fails, or None.
+
+    Parameters:
+    - masks: Dictionary of reason code to boolean mask (Series or array) of the rows failing
+      the rule, in priority order.
+    - index: Index of the rows.
+
+    Returns:
+    - numpy object array of reason codes.
+    """
+    if not masks:
+        return np.full(len(index), None, dtype=object)
+    conditions = [np.asarray(mask, dtype=bool) for mask in masks.values()]
+    return np.select(conditions, np.array(list(masks), dtype=object), default=None)
+
+
+def reject_rows(data, masks, quarantine=None):
+    """
+    Split off the rows failing a validation rule. They go to the quarantine (when given)
+    with their reason code, are counted per reason in the metrics, and never reach the loader.
+
+    Parameters:
+    - data: DataFrame to validate.
+    - masks: Dictionary of reason code to mask of the failing rows (see failure_reasons).
+    - quarantine: Optional Quarantine receiving the failing rows.
+
+    Returns:
+    - DataFrame of the rows passing every rule.
+    """
+    reasons = failure_reasons(masks, data.index)
+    failed = pd.notna(reasons)
+    if not failed.any():
+        return data
+
+    counts = pd.Series(reasons[failed]).value_counts()
+    for reason, count in counts.items():
+        dropped(reason, count)
+    print(f"Quarantined {int(failed.sum())} rows: " + ', '.join(f"{reason}={count}" for reason, count in counts.items()))
+    if quarantine is not None:
+        quarantine.add(data[failed], reasons[failed])
+    return data[~failed]
+
+
+class Quarantine:
+    """
+    File of the rows rejected by validation, with their reason code and their row number
+    in the source, for inspection and reprocessing: Parquet, or CSV when the path ends in
+    .csv. Values are stored as text, so rows whose values failed to parse are kept as read.
+    The file is created with the first rejected row; chunks are appended as they come.
+    With path=None the rows are only counted.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self.counts = Counter()
+        # Counts already returned by count_rows
+        self.recorded = Counter()
+        self.written = False
+        self._parquet = None
+
+    def add(self, rows, reasons):
+        """
+        Append rejected rows with their reason codes.
+        """
+        self.counts.update(reasons.tolist())
+        if self.columns is None:
+            self.columns = list(rows.columns)
+        if self.path is None:
+            return
+
+        frame = pd.DataFrame({
+            'row_number': rows.index.to_numpy(np.int64),
+            'reason': pd.array(reasons, dtype='string'),
+            **{name: rows[name].astype('string').array if name in rows.columns else pd.array([None] * len(rows), dtype='string')
+               for name in self.columns},
+        })
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        if self.path.endswith('.csv'):
+            frame.to_csv(self.path, mode='a' if self.written else 'w', header=not self.written, index=False)
+        else:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table)
+        self.written = True
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+        if self.written:
+            print(f"Wrote {sum(self.counts.values())} quarantined rows to {self.path}")
+
+    def count_rows(self, source, table):
+        """
+        Rows for COUNTS_TABLE: one per reason code of the rows rejected since the last call,
+        so a load that records the counts of every chunk it commits never counts a row twice.
+        """
+        recorded_at = pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')
+        path = self.path if self.written else None
+        counts = self.counts - self.recorded
+        self.recorded.update(counts)
+        return [(run_id(), source, table, reason, count, path, recorded_at) for reason, count in sorted(counts.items())]
+
+
+def record_counts(cur, rows, placeholder='%s'):
+    """
+    Add the quarantine counts of a run to COUNTS_TABLE, creating it if needed.
+
+    Parameters:
+    - cur: Open cursor; the caller commits.
+    - rows: Rows from Quarantine.count_rows.
+    - placeholder: Parameter marker of the driver ('%s' for psycopg2, '?' for sqlite3 and DuckDB).
+    """
+    cur.execute(f"""
+    CREATE TABLE IF NOT EXISTS {COUNTS_TABLE} (
+        run_id VARCHAR(64),
+        source VARCHAR(1024),
+        target_table VARCHAR(255),
+        reason VARCHAR(64),
+        row_count BIGINT,
+        quarantine_file VARCHAR(1024),
+        recorded_at TIMESTAMP
+    );
+    """)
+    if rows:
+        cur.executemany(f"INSERT INTO {COUNTS_TABLE} VALUES ({', '.join([placeholder] * 7)})", rows)
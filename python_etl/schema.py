@@ -0,0 +1,97 @@
+import sys
+
+import pandas as pd
+
+# Declared dtypes of the user-behavior CSV, so pd.read_csv does not infer every column.
+# Low-cardinality text is categorical; IDs and play time fit the INT columns of the main table.
+# 'start watching' stays object: nearly every value is distinct, so categories would only add codes.
+CSV_DTYPES = {
+    'Iduser': 'Int32',
+    'Device Id': 'object',
+    'Province': 'category',
+    'City': 'category',
+    'Content Name': 'object',
+    'Playing Time Millisecond': 'Int32',
+    'Device Type': 'category',
+    'Content Type': 'category',
+    'start watching': 'object',
+}
+
+# Timestamp columns and their layout (e.g. 5/15/2023 19:47). They are read as text and
+# parsed after reading once per distinct value with timestamps.parse_timestamps
+TIMESTAMP_COLUMNS = ['start watching']
+TIMESTAMP_FORMAT = '%m/%d/%Y %H:%M'
+
+# Valid user ids; validation quarantines rows with ids outside this range
+USER_ID_RANGE = (0, 1200000000)
+
+
+def csv_read_options(usecols=None, dtype=None, **read_csv_kwargs):
+    """
+    Return pd.read_csv keyword arguments for the declared schema.
+
+    Parameters:
+    - usecols: Optional subset of CSV columns to read.
+    - dtype: Optional per-column overrides of CSV_DTYPES.
+    - read_csv_kwargs: Any other pd.read_csv arguments, passed through.
+    """
+    columns = usecols or list(CSV_DTYPES)
+    dtypes = {**CSV_DTYPES, **(dtype or {})}
+    options = {
+        'dtype': {name: dtypes[name] for name in columns if name in dtypes},
+        **read_csv_kwargs,
+    }
+    if usecols:
+        options['usecols'] = usecols
+    return options
+
+
+def fill_missing(col, value):
+    """
+    fillna that also works on categorical columns, adding the fill value as a category if needed.
+    """
+    if isinstance(col.dtype, pd.CategoricalDtype) and value not in col.cat.categories:
+        col = col.cat.add_categories([value])
+    return col.fillna(value)
+
+
+def is_text(col):
+    """
+    True for text columns, whether read as object or as categorical.
+    """
+    return col.dtype == 'object' or isinstance(col.dtype, pd.CategoricalDtype)
+
+
+def memory_report(csv_file_path, dtype=None, **read_csv_kwargs):
+    """
+    Print the memory of every column read with inferred dtypes and with the declared schema.
+
+    Parameters:
+    - csv_file_path: CSV file to read.
+    - dtype: Optional per-column overrides of CSV_DTYPES (e.g. {'Iduser': str} for files with malformed rows).
+    - read_csv_kwargs: Any other pd.read_csv arguments, used for both reads.
+
+    Returns:
+    - DataFrame with the dtype and bytes of each column before and after.
+    """
+    inferred = pd.read_csv(csv_file_path, **read_csv_kwargs)
+    declared = pd.read_csv(csv_file_path, **csv_read_options(dtype=dtype, **read_csv_kwargs))
+
+    report = pd.DataFrame({
+        'dtype_before': inferred.dtypes.astype(str),
+        'bytes_before': inferred.memory_usage(deep=True, index=False),
+        'dtype_after': declared.dtypes.astype(str),
+        'bytes_after': declared.memory_usage(deep=True, index=False),
+    })
+    print(report.to_string())
+    print(f"Total: {report['bytes_before'].sum():,} bytes before, {report['bytes_after'].sum():,} bytes after")
+    return report
+
+
+if __name__ == '__main__':
+    # Usage: python schema.py <csv file> [column=dtype ...], e.g. Iduser=str for files with malformed rows
+    try:
+        memory_report(sys.argv[1], dtype=dict(arg.split('=', 1) for arg in sys.argv[2:]))
+    except ValueError as e:
+        print(f"Could not read {sys.argv[1]} with the declared schema: {e}")
+        print("Override the dtype of the failing column, e.g. python schema.py <csv file> Iduser=str")
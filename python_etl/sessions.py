@@ -0,0 +1,130 @@
+import numpy as np
+import pandas as pd
+
+# A device's next event starts a new viewing session when it begins more than this
+# long after the end (start + play time) of the device's earlier events
+SESSION_GAP = pd.Timedelta(minutes=30)
+
+# Daily engagement tables, rebuilt for the days every load touches, and their columns
+ROLLUP_TABLES = {
+    'daily_user_engagement': {
+        'day': 'DATE',
+        'user_id': 'INT',
+        'sessions': 'INT',
+        'events': 'INT',
+        'total_play_time_ms': 'BIGINT',
+        'median_play_time_ms': 'DOUBLE PRECISION',
+    },
+    'daily_content_engagement': {
+        'day': 'DATE',
+        'event_type': 'VARCHAR(255)',
+        'users': 'INT',
+        'sessions': 'INT',
+        'events': 'INT',
+        'total_play_time_ms': 'BIGINT',
+        'median_play_time_ms': 'DOUBLE PRECISION',
+    },
+}
+
+
+def sessionize(data, gap=SESSION_GAP, session_column='session_id', time_column='start_watching'):
+    """
+    Split the events of every device into viewing sessions. The rows are sorted once
+    by (session_id, start_watching); an event opens a new session when its device
+    differs from the previous row's or when it starts more than gap after the latest
+    end of the device's earlier events.
+
+    Parameters:
+    - data: Cleaned DataFrame with session_id, start_watching and play_time_ms.
+    - gap: Inactivity gap (Timedelta) that closes a session.
+
+    Returns:
+    - DataFrame sorted by device and time, with the session number in 'watch_session'.
+    """
+    data = data.sort_values([session_column, time_column], kind='stable', ignore_index=True)
+    starts = pd.to_datetime(data[time_column])
+    ends = starts + pd.to_timedelta(data['play_time_ms'].fillna(0).astype('int64'), unit='ms')
+
+    # Rows without a device are one group, as in the groupby rollups
+    device = data[session_column]
+    previous = device.shift()
+    new_device = device.ne(previous) & ~(device.isna() & previous.isna())
+    new_device.iloc[:1] = True
+    # Latest end among the device's earlier events; the shift only crosses devices where new_device is set
+    latest_end = ends.groupby(new_device.cumsum()).cummax().shift()
+    new_session = new_device | (starts - latest_end > gap)
+
+    data['watch_session'] = new_session.cumsum().to_numpy(np.int64)
+    return data
+
+
+def daily_rollups(sessions, time_column='start_watching'):
+    """
+    Roll sessionized events up by day: per user and per content (event_type), the
+    sessions with events that day, the events, and their total and median play time.
+
+    Returns:
+    - Dictionary of rollup table name (see ROLLUP_TABLES) to DataFrame.
+    """
+    events = pd.DataFrame({
+        'day': pd.to_datetime(sessions[time_column]).dt.date,
+        'user_id': sessions['user_id'],
+        'event_type': sessions['event_type'].astype(object),
+        'watch_session': sessions['watch_session'],
+        'play_time_ms': sessions['play_time_ms'].astype('float64'),
+    })
+    measures = {
+        'sessions': ('watch_session', 'nunique'),
+        'events': ('play_time_ms', 'size'),
+        'total_play_time_ms': ('play_time_ms', 'sum'),
+        'median_play_time_ms': ('play_time_ms', 'median'),
+    }
+    by_user = events.groupby(['day', 'user_id'], dropna=False).agg(**measures).reset_index()
+    by_content = events.groupby(['day', 'event_type'], dropna=False).agg(users=('user_id', 'nunique'), **measures).reset_index()
+
+    rollups = {}
+    for table, frame in (('daily_user_engagement', by_user), ('daily_content_engagement', by_content)):
+        frame['total_play_time_ms'] = frame['total_play_time_ms'].astype('int64')
+        rollups[table] = frame[list(ROLLUP_TABLES[table])]
+    return rollups
+
+
+def collect_days(data, time_column, days):
+    """
+    Add the days of a DataFrame, or lazily of each chunk of an iterable of DataFrames,
+    to the set days as the rows pass, so a streamed load knows which rollup days it touched.
+    """
+    if isinstance(data, pd.DataFrame):
+        days.update(pd.to_datetime(data[time_column]).dt.normalize().dropna().unique())
+        return data
+    return (collect_days(chunk, time_column, days) for chunk in data)
+
+
+def day_ranges(days):
+    """
+    Merge days into [start, end) ranges of consecutive days, so reading them back from a
+    table partitioned by event_time touches only their partitions.
+    """
+    ranges = []
+    for day in sorted(pd.Timestamp(day) for day in days):
+        if ranges and ranges[-1][1] == day:
+            ranges[-1][1] = day + pd.Timedelta(days=1)
+        else:
+            ranges.append([day, day + pd.Timedelta(days=1)])
+    return [tuple(day_range) for day_range in ranges]
+
+
+def engagement_rollups(events, days, gap=SESSION_GAP):
+    """
+    Sessionize the events of the given days and roll them up by day.
+
+    Parameters:
+    - events: Cleaned events; rows of other days are ignored.
+    - days: Days to build.
+
+    Returns:
+    - Dictionary of rollup table name to DataFrame.
+    """
+    times = pd.to_datetime(events['start_watching'])
+    events = events[times.dt.normalize().isin(list(days))]
+    return daily_rollups(sessionize(events, gap))
@@ -0,0 +1,674 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+from bulk_load import copy_chunks, copy_dataframe
+from db import pooled_connection, transaction
+from dimensions import DIMENSIONS, create_wide_view, encode_rows, ensure_dimension_tables, key_column
+from incremental import (
+    DEDUP_KEY, WATERMARK_TABLE, ensure_dedup_key, ensure_watermark_table, get_watermark, merge_sql, resolve_reload_sql,
+    set_watermark
+)
+from partitions import (
+    PARTITION_GRANULARITY, has_partitioned_layout, partition_name, partitioned_chunks, prepare_partitions, staged_periods
+)
+from quarantine import record_counts
+from sessions import ROLLUP_TABLES, day_ranges
+from summaries import SUMMARY_TABLES, batch_rows_sql, ensure_summary_tables, summary_rows_sql, update_summaries
+
+# SQL types of the event-table columns. Dimension columns (see dimensions.DIMENSIONS)
+# hold text, or their integer key in PostgreSQL
+COLUMN_TYPES = {
+    'user_id': 'INT',
+    'session_id': 'VARCHAR(255)',
+    'event_type': 'VARCHAR(255)',
+    'event_time': 'TIMESTAMP',
+    'play_time_ms': 'INT',
+}
+TEXT_TYPE = 'VARCHAR(255)'
+
+# Temporary table a batch is staged in before the dedup and merge
+STAGING_TABLE = 'user_behavior_temp'
+
+# Columns of the wide view the engagement rollups and the cube are built from, and their names in the cleaned DataFrame
+EVENT_COLUMNS = {
+    'user_id': 'user_id',
+    'session_id': 'session_id',
+    'event_type': 'event_type',
+    'event_time': 'start_watching',
+    'content_type': 'content_type',
+    'device_type': 'device_type',
+    'province': 'province',
+    'city': 'city',
+    'play_time_ms': 'play_time_ms',
+}
+
+
+@contextmanager
+def open_sink(db_params):
+    """
+    Open the sink the ETL loads into.
+
+    Parameters:
+    - db_params: PostgreSQL connection parameters, or {'engine': 'duckdb' | 'sqlite',
+      'database': path} for an embedded database file (':memory:' for none).
+
+    Yields:
+    - PostgresSink over a pooled connection, or LocalSink.
+    """
+    engine = db_params.get('engine', 'postgres')
+    if engine == 'postgres':
+        with pooled_connection({k: v for k, v in db_params.items() if k != 'engine'}) as conn:
+            yield PostgresSink(conn)
+        return
+
+    sink = LocalSink(engine, db_params.get('database', ':memory:'))
+    try:
+        yield sink
+    finally:
+        sink.close()
+
+
+def _events_frame(rows):
+    # Rows read back for the rollups and the cube, in the layout of the cleaned DataFrame
+    events = pd.DataFrame(rows, columns=list(EVENT_COLUMNS.values()))
+    events['start_watching'] = pd.to_datetime(events['start_watching'])
+    events['play_time_ms'] = pd.to_numeric(events['play_time_ms'])
+    return events
+
+
+def _key_frame(rows):
+    # Dedup key and event time of rows read back, in the layout of the cleaned DataFrame
+    keys = pd.DataFrame(rows, columns=DEDUP_KEY + [EVENT_COLUMNS['event_time']])
+    keys[EVENT_COLUMNS['event_time']] = pd.to_datetime(keys[EVENT_COLUMNS['event_time']])
+    return keys
+
+
+def _rollup_definitions(columns):
+    return ', '.join(f"{name} {sql_type}" for name, sql_type in columns.items())
+
+
+def winners_sql(temp_table, columns, keep='latest'):
+    """
+    SELECT returning one row per dedup key of a staged batch, ranked with ROW_NUMBER():
+    the newest event_time (keep='latest') or the oldest one (keep='first').
+    NULL event times sort as the largest value, as PostgreSQL does by default.
+    keep=None returns every staged row, for loads that keep duplicates.
+    """
+    order = 'DESC NULLS FIRST' if keep == 'latest' else 'ASC NULLS LAST'
+    column_list = ', '.join(columns)
+    if keep is None:
+        return f"SELECT {column_list} FROM {temp_table}"
+    return f"""
+    SELECT {column_list}
+    FROM (
+        SELECT *, ROW_NUMBER() OVER (PARTITION BY {', '.join(DEDUP_KEY)} ORDER BY event_time {order}) AS row_num
+        FROM {temp_table}
+    ) AS ranked_data
+    WHERE row_num = 1
+    """
+
+
+class PostgresSink:
+    """
+    Load into PostgreSQL: tables partitioned by event_time with the dimension columns
+    stored as integer keys, COPY, and the dedup, merge and summaries run in the database.
+    """
+
+    def __init__(self, conn, staging=STAGING_TABLE):
+        self.conn = conn
+        # Table holding the batch for merge() and batch_days()
+        self.staging = staging
+        # Periods whose partitions a full reload emptied and rewrote
+        self.replaced = set()
+
+    @staticmethod
+    def _columns(columns):
+        return [key_column(name) if name in DIMENSIONS else name for name in columns]
+
+    def _column_definitions(self, columns):
+        return ',\n    '.join(f"{name} {COLUMN_TYPES.get(name, 'INT')}" for name in self._columns(columns))
+
+    def prepare(self, table, columns, incremental=False):
+        """
+        Create the main table, the dimension tables and the wide view; for an
+        incremental load also the dedup key and the watermark table.
+        """
+        with transaction(self.conn) as cur:
+            # A full reload keeps a partitioned table of this layout and replaces only the
+            # periods it loads; a table of another layout is rebuilt
+            if not incremental and not has_partitioned_layout(cur, table, self._columns(columns)):
+                cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+            cur.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id SERIAL,
+                {self._column_definitions(columns)}
+            ) PARTITION BY RANGE (event_time);
+            """)
+            ensure_dimension_tables(cur)
+            create_wide_view(cur, table)
+            if incremental:
+                ensure_dedup_key(cur, table)
+                ensure_watermark_table(cur)
+
+    def drop(self, table):
+        """
+        Drop a main table with its partitions and wide view, e.g. the scratch table of benchmark.py.
+        """
+        with transaction(self.conn) as cur:
+            cur.execute(f"DROP TABLE IF EXISTS {table} CASCADE;")
+
+    def watermark(self, source):
+        with transaction(self.conn) as cur:
+            return get_watermark(cur, source)
+
+    def encode(self, data):
+        # Swap the dimension text for integer keys before the rows go over the wire
+        return encode_rows(self.conn, data)
+
+    def load(self, data, table, frame_columns, table_columns, direct=False, checkpoint=None):
+        """
+        COPY a DataFrame or iterable of chunks straight into the main table (direct=True,
+        for a full reload of unique rows) or into the staging table for merge().
+        With a checkpoint (see checkpoints.ChunkCheckpoint) the chunks go to a staging
+        table of the source file that outlives the run, each committed with its checkpoint
+        row, and a load of the same file that failed before merge() resumes after its last
+        committed chunk.
+
+        Returns:
+        - Number of rows loaded.
+        """
+        frame_columns, table_columns = self._columns(frame_columns), self._columns(table_columns)
+        with self.conn.cursor() as cur:
+            if direct:
+                # Create the partitions of every chunk before it is copied; a full reload empties them first
+                time_column = frame_columns[table_columns.index('event_time')]
+                chunks = partitioned_chunks(self.conn, table, data, time_column, replace=True, prepared=self.replaced)
+                return copy_chunks(self.conn, cur, chunks, table, frame_columns, table_columns)
+
+            if checkpoint is not None:
+                # Keep the staged chunks of a failed load of this file, or start its staging table over
+                self.staging = checkpoint.staging_table(table)
+                with transaction(self.conn) as setup:
+                    setup.execute("SELECT to_regclass(%s) IS NOT NULL;", (self.staging,))
+                    if not checkpoint.resume(setup, table, staged=setup.fetchone()[0]):
+                        setup.execute(f"DROP TABLE IF EXISTS {self.staging};")
+                        setup.execute(f"CREATE TABLE {self.staging} ({self._column_definitions(table_columns)});")
+                return copy_chunks(self.conn, cur, data, self.staging, frame_columns, table_columns, checkpoint)
+
+            cur.execute(f"CREATE TEMPORARY TABLE {STAGING_TABLE} ({self._column_definitions(table_columns)});")
+            return copy_chunks(self.conn, cur, data, STAGING_TABLE, frame_columns, table_columns)
+
+    def merge(self, table, columns, keep='latest', watermark=None, checkpoint=None, summaries=False):
+        """
+        Insert the winning staged row of every dedup key into the main table.
+
+        Parameters:
+        - watermark: (source, fingerprint) of an incremental batch. The batch is then merged
+          into the existing rows and the watermark advanced in the same transaction; without
+          it the partitions of the batch are emptied first (full reload).
+        - checkpoint: ChunkCheckpoint of a resumable load, whose checkpoints are removed in
+          the transaction of the merge, so its staged chunks are never merged twice.
+        - summaries: Add the users of an incremental batch to the summary tables in the
+          transaction of the merge, so the watermark never gets ahead of the summaries.
+
+        Returns:
+        - Number of rows inserted or replaced.
+        """
+        columns = self._columns(columns)
+        with transaction(self.conn) as cur:
+            periods = staged_periods(cur, self.staging)
+            prepare_partitions(cur, table, periods, replace=watermark is None)
+            if watermark is None:
+                self.replaced.update(periods)
+                cur.execute(f"INSERT INTO {table} ({', '.join(columns)}) {winners_sql(self.staging, columns, keep)};")
+            else:
+                cur.execute(merge_sql(table, self.staging, columns, keep=keep))
+            row_count = cur.rowcount
+            if watermark is not None and summaries:
+                ensure_summary_tables(cur)
+                update_summaries(cur, batch_rows_sql(table, self.staging))
+            if watermark is not None:
+                source, fingerprint = watermark
+                cur.execute(f"SELECT MAX(event_time) FROM {self.staging}")
+                set_watermark(cur, source, table, cur.fetchone()[0], fingerprint)
+            if checkpoint is not None:
+                checkpoint.clear(cur)
+        return row_count
+
+    def resolve_reload(self, table, keep='latest'):
+        """
+        Resolve the dedup keys a full reload shares with the partitions it kept: the winning
+        row of each key stays, or with keep=None every reloaded row (see incremental.resolve_reload_sql).
+
+        Returns:
+        - Days of the deleted rows, whose engagement rollups changed.
+        """
+        if not self.replaced:
+            return set()
+        with transaction(self.conn) as cur:
+            cur.execute(resolve_reload_sql(table, keep), {'partitions': [partition_name(table, start) for start in self.replaced]})
+            deleted = cur.fetchall()
+        if deleted:
+            print(f"Removed {len(deleted)} rows of {table} whose dedup key the reload loaded again.")
+        return {pd.Timestamp(event_time).normalize() for event_time, in deleted if event_time is not None}
+
+    def kept_events(self, table):
+        """
+        Return the dedup key and event time of the rows outside the partitions a full reload
+        emptied, as a DataFrame with the column names of the cleaned data, for seen_index.SeenIndex.
+        """
+        names = [partition_name(table, start) for start in self.replaced]
+        with transaction(self.conn) as cur:
+            cur.execute(
+                f"SELECT {', '.join(DEDUP_KEY)}, event_time FROM {table} WHERE tableoid <> ALL(%s::regclass[])",
+                (names,)
+            )
+            return _key_frame(cur.fetchall())
+
+    def drop_staging(self):
+        """
+        Drop the staging table of a resumable load once its batch is merged and summarized.
+        """
+        if self.staging != STAGING_TABLE:
+            with transaction(self.conn) as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {self.staging};")
+            self.staging = STAGING_TABLE
+
+    def count(self, table):
+        with transaction(self.conn) as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            return cur.fetchone()[0]
+
+    def is_empty(self, table):
+        with transaction(self.conn) as cur:
+            cur.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+            return cur.fetchone()[0]
+
+    def update_summaries(self, table, prefix=''):
+        """
+        Rebuild the summary tables from the whole main table, after a full reload.
+        An incremental batch is added to them by merge(summaries=True).
+        A prefix rebuilds another set of tables (see summaries.ensure_summary_tables).
+        """
+        with transaction(self.conn) as cur:
+            ensure_summary_tables(cur, reset=True, prefix=prefix)
+            update_summaries(cur, f"SELECT {', '.join(key_column(d) for d in SUMMARY_TABLES.values())}, user_id FROM {table}", prefix=prefix)
+
+    def summary_rows(self, summary_table, prefix=''):
+        with transaction(self.conn) as cur:
+            cur.execute(summary_rows_sql(summary_table, prefix))
+            return cur.fetchall()
+
+    def batch_days(self, table):
+        """
+        Return the days of the staged batch and of the main-table rows of its dedup keys,
+        which the merge may replace: the days whose engagement rollups the batch changes.
+        """
+        keys = ', '.join(DEDUP_KEY)
+        with transaction(self.conn) as cur:
+            cur.execute(f"""
+            SELECT date_trunc('day', event_time) FROM {self.staging} WHERE event_time IS NOT NULL
+            UNION
+            SELECT date_trunc('day', m.event_time) FROM {table} m
+            JOIN (SELECT DISTINCT {keys} FROM {self.staging}) b USING ({keys})
+            WHERE m.event_time IS NOT NULL;
+            """)
+            return {pd.Timestamp(day) for day, in cur.fetchall()}
+
+    def read_days(self, table, days):
+        """
+        Return the events of the given days from the main table, as a DataFrame with the
+        columns of the cleaned data and the text of the dimensions. Only the partitions of
+        those days are read.
+        """
+        ranges = day_ranges(days)
+        where = ' OR '.join(['(event_time >= %s AND event_time < %s)'] * len(ranges))
+        with transaction(self.conn) as cur:
+            cur.execute(
+                f"SELECT {', '.join(EVENT_COLUMNS)} FROM {table}_wide WHERE {where}",
+                [bound.to_pydatetime() for day_range in ranges for bound in day_range]
+            )
+            return _events_frame(cur.fetchall())
+
+    def replace_rollups(self, rollups, days, full=False, definitions=ROLLUP_TABLES):
+        """
+        Replace the rows of the given days in daily rollup tables, in one transaction.
+
+        Parameters:
+        - rollups: Dictionary of rollup table name to DataFrame (see sessions.daily_rollups).
+        - days: Days the rollups were built for.
+        - full: Full reload; the rows of every day in the periods it emptied are removed,
+          not only of the days loaded again.
+        - definitions: Dictionary of rollup table name to its columns and SQL types.
+        """
+        with transaction(self.conn) as cur:
+            for table, frame in rollups.items():
+                columns = definitions[table]
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({_rollup_definitions(columns)});")
+                periods = [start.to_pydatetime() for start in self.replaced if start is not None] if full else []
+                cur.execute(
+                    f"DELETE FROM {table} WHERE day = ANY(%s) OR date_trunc(%s, day) = ANY(%s)",
+                    ([day.date() for day in days], PARTITION_GRANULARITY, periods)
+                )
+                # COPY reads binary columns as hex text
+                binary = {name: ['\\x' + value.hex() for value in frame[name]] for name, sql_type in columns.items() if sql_type == 'BYTEA'}
+                copy_dataframe(cur, frame.assign(**binary), table, list(frame.columns))
+
+    def record_quarantine(self, rows):
+        """
+        Add the quarantine counts of a run (see quarantine.Quarantine.count_rows).
+        """
+        with transaction(self.conn) as cur:
+            record_counts(cur, rows)
+
+    def read_table(self, table):
+        """
+        Return a whole table as a DataFrame, e.g. a cube for cube.EventCube.
+        """
+        with transaction(self.conn) as cur:
+            cur.execute(f"SELECT * FROM {table}")
+            return pd.DataFrame(cur.fetchall(), columns=[column.name for column in cur.description])
+
+
+def _sqlite_values(col):
+    # sqlite3 binds only Python scalars: timestamps go in as ISO text, missing values as None
+    if pd.api.types.is_datetime64_any_dtype(col):
+        values = col.dt.strftime('%Y-%m-%d %H:%M:%S')
+    else:
+        values = col.astype(object)
+    return values.where(col.notna(), None).tolist()
+
+
+class LocalSink:
+    """
+    Load into an embedded database file, for quick runs while changing the cleaning and
+    for offline analysis: DuckDB, which scans the DataFrames in place, or SQLite from the
+    standard library. The dedup, merge and summaries are the same statements as in
+    PostgreSQL, or their equivalents, run in process. Dimension columns stay text and
+    the tables are not partitioned.
+    """
+
+    def __init__(self, engine, database):
+        if engine == 'duckdb':
+            if duckdb is None:
+                raise ImportError("The 'duckdb' sink needs the duckdb package.")
+            self.conn = duckdb.connect(database)
+            # A DuckDB cursor is a second connection, which would not see this one's temporary tables
+            self.cur = self.conn
+        elif engine == 'sqlite':
+            self.conn = sqlite3.connect(database)
+            self.cur = self.conn.cursor()
+        else:
+            raise ValueError(f"Unknown sink engine {engine!r}; use 'postgres', 'duckdb' or 'sqlite'.")
+        self.engine = engine
+        self.staging = STAGING_TABLE
+
+    def close(self):
+        self.conn.close()
+
+    @contextmanager
+    def _transaction(self):
+        if self.engine == 'duckdb':
+            self.conn.begin()
+        try:
+            yield self.cur
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def _row_count(self, cur):
+        # DuckDB returns the row count of an INSERT as a result row; sqlite3 sets rowcount
+        return cur.fetchone()[0] if self.engine == 'duckdb' else cur.rowcount
+
+    @staticmethod
+    def _column_definitions(columns):
+        return ', '.join(f"{name} {COLUMN_TYPES.get(name, TEXT_TYPE)}" for name in columns)
+
+    def prepare(self, table, columns, incremental=False):
+        with self._transaction() as cur:
+            if not incremental:
+                cur.execute(f"DROP VIEW IF EXISTS {table}_wide;")
+                cur.execute(f"DROP TABLE IF EXISTS {table};")
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({self._column_definitions(columns)});")
+            # The table already has the wide layout; the view keeps queries the same for every sink
+            cur.execute(f"CREATE VIEW IF NOT EXISTS {table}_wide AS SELECT * FROM {table};")
+            if incremental:
+                cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_dedup_key ON {table} ({', '.join(DEDUP_KEY)});")
+                cur.execute(f"""
+                CREATE TABLE IF NOT EXISTS {WATERMARK_TABLE} (
+                    source VARCHAR(1024) PRIMARY KEY,
+                    target_table VARCHAR(255),
+                    last_event_time TIMESTAMP,
+                    file_fingerprint VARCHAR(64),
+                    loaded_at TIMESTAMP
+                );
+                """)
+
+    def drop(self, table):
+        with self._transaction() as cur:
+            cur.execute(f"DROP VIEW IF EXISTS {table}_wide;")
+            cur.execute(f"DROP TABLE IF EXISTS {table};")
+
+    def watermark(self, source):
+        with self._transaction() as cur:
+            cur.execute(f"SELECT last_event_time, file_fingerprint FROM {WATERMARK_TABLE} WHERE source = ?", (source,))
+            row = cur.fetchone()
+        if row is None:
+            return None, None
+        last_event_time, fingerprint = row
+        return (pd.Timestamp(last_event_time) if last_event_time is not None else None), fingerprint
+
+    def encode(self, data):
+        # Dimension columns are stored as text
+        return data
+
+    def _insert(self, cur, chunk, table, frame_columns, table_columns):
+        insert = f"INSERT INTO {table} ({', '.join(table_columns)})"
+        if self.engine == 'duckdb':
+            # DuckDB reads the DataFrame's arrays in place; nothing is converted row by row
+            self.conn.register('batch', chunk)
+            try:
+                cur.execute(f"{insert} SELECT {', '.join(frame_columns)} FROM batch")
+            finally:
+                self.conn.unregister('batch')
+        else:
+            values = zip(*(_sqlite_values(chunk[name]) for name in frame_columns))
+            cur.executemany(f"{insert} VALUES ({', '.join('?' * len(table_columns))})", values)
+
+    def _table_exists(self, cur, table):
+        if self.engine == 'sqlite':
+            cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        else:
+            cur.execute("SELECT 1 FROM information_schema.tables WHERE table_name = ?", (table,))
+        return cur.fetchone() is not None
+
+    def load(self, data, table, frame_columns, table_columns, direct=False, checkpoint=None):
+        target = table
+        if checkpoint is not None:
+            self.staging = target = checkpoint.staging_table(table)
+            with self._transaction() as cur:
+                if not checkpoint.resume(cur, table, staged=self._table_exists(cur, self.staging), placeholder='?'):
+                    cur.execute(f"DROP TABLE IF EXISTS {self.staging};")
+                    cur.execute(f"CREATE TABLE {self.staging} ({self._column_definitions(table_columns)});")
+        elif not direct:
+            self.cur.execute(f"DROP TABLE IF EXISTS {STAGING_TABLE};")
+            self.cur.execute(f"CREATE TEMP TABLE {STAGING_TABLE} ({self._column_definitions(table_columns)});")
+            target = STAGING_TABLE
+        if isinstance(data, pd.DataFrame):
+            data = [data]
+
+        start = time.perf_counter()
+        row_count = 0
+        for chunk in data:
+            with self._transaction() as cur:
+                self._insert(cur, chunk, target, frame_columns, table_columns)
+                if checkpoint is not None:
+                    checkpoint.record(cur, len(chunk), placeholder='?')
+            row_count += len(chunk)
+
+        elapsed = time.perf_counter() - start
+        rate = row_count / elapsed if elapsed > 0 else float('inf')
+        print(f"Loaded {row_count} rows into {target} in {elapsed:.2f}s ({rate:,.0f} rows/s)")
+        return row_count
+
+    def merge(self, table, columns, keep='latest', watermark=None, checkpoint=None, summaries=False):
+        column_list = ', '.join(columns)
+        with self._transaction() as cur:
+            if checkpoint is not None:
+                checkpoint.clear(cur, placeholder='?')
+            if watermark is None:
+                cur.execute(f"INSERT INTO {table} ({column_list}) {winners_sql(self.staging, columns, keep)}")
+                return self._row_count(cur)
+
+            # merge_sql in three statements, as embedded engines have no data-modifying CTEs:
+            # delete the rows the batch supersedes, then insert the winners of new or freed keys
+            newer = '>' if keep == 'latest' else '<'
+            cur.execute("DROP TABLE IF EXISTS merge_winners;")
+            cur.execute(f"CREATE TEMP TABLE merge_winners AS {winners_sql(self.staging, columns, keep)};")
+            same_key = ' AND '.join(f"w.{c} = {table}.{c}" for c in DEDUP_KEY)
+            cur.execute(f"""
+            DELETE FROM {table}
+            WHERE EXISTS (SELECT 1 FROM merge_winners w WHERE {same_key} AND w.event_time {newer} {table}.event_time);
+            """)
+            same_key = ' AND '.join(f"w.{c} = t.{c}" for c in DEDUP_KEY)
+            cur.execute(f"""
+            INSERT INTO {table} ({column_list})
+            SELECT {column_list} FROM merge_winners w
+            WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {same_key});
+            """)
+            row_count = self._row_count(cur)
+            if summaries:
+                self._add_summaries(cur, batch_rows_sql(table, self.staging))
+
+            # Advance the watermark with the merge; it never moves back
+            source, fingerprint = watermark
+            cur.execute(f"SELECT MAX(event_time) FROM {self.staging}")
+            last_event_time = cur.fetchone()[0]
+            cur.execute(f"SELECT last_event_time FROM {WATERMARK_TABLE} WHERE source = ?", (source,))
+            previous = cur.fetchone()
+            if previous is not None and previous[0] is not None:
+                last_event_time = previous[0] if last_event_time is None else max(pd.Timestamp(previous[0]), pd.Timestamp(last_event_time))
+            cur.execute(f"DELETE FROM {WATERMARK_TABLE} WHERE source = ?", (source,))
+            cur.execute(
+                f"INSERT INTO {WATERMARK_TABLE} (source, target_table, last_event_time, file_fingerprint, loaded_at) VALUES (?, ?, ?, ?, ?)",
+                (source, table, None if last_event_time is None else str(pd.Timestamp(last_event_time)), fingerprint, str(pd.Timestamp.now()))
+            )
+        return row_count
+
+    def resolve_reload(self, table, keep='latest'):
+        # A full reload rewrote the whole table, so it shares no key with older rows
+        return set()
+
+    def kept_events(self, table):
+        # A full reload rewrote the whole table and kept no rows
+        return _key_frame([])
+
+    def drop_staging(self):
+        if self.staging != STAGING_TABLE:
+            with self._transaction() as cur:
+                cur.execute(f"DROP TABLE IF EXISTS {self.staging};")
+            self.staging = STAGING_TABLE
+
+    def count(self, table):
+        with self._transaction() as cur:
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            return cur.fetchone()[0]
+
+    def is_empty(self, table):
+        with self._transaction() as cur:
+            cur.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {table})")
+            return bool(cur.fetchone()[0])
+
+    def update_summaries(self, table, prefix=''):
+        with self._transaction() as cur:
+            self._add_summaries(cur, f"SELECT * FROM {table}", reset=True, prefix=prefix)
+
+    def _add_summaries(self, cur, batch_sql, reset=False, prefix=''):
+        """
+        Add the (dimension, user) memberships of a batch and recount the groups,
+        which gives the counts update_summaries keeps in PostgreSQL.
+        """
+        for summary_table, dimension in SUMMARY_TABLES.items():
+            summary_table = prefix + summary_table
+            if reset:
+                cur.execute(f"DROP TABLE IF EXISTS {summary_table};")
+                cur.execute(f"DROP TABLE IF EXISTS {summary_table}_members;")
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {summary_table}_members ({dimension} {TEXT_TYPE}, user_id INT);")
+            cur.execute(f"CREATE TABLE IF NOT EXISTS {summary_table} ({dimension} {TEXT_TYPE}, user_count BIGINT);")
+            # EXCEPT compares NULLs as equal, so the NULL group gets each user once
+            cur.execute(f"""
+            INSERT INTO {summary_table}_members ({dimension}, user_id)
+            SELECT {dimension}, user_id FROM ({batch_sql}) AS batch WHERE user_id IS NOT NULL
+            EXCEPT
+            SELECT {dimension}, user_id FROM {summary_table}_members;
+            """)
+            cur.execute(f"DELETE FROM {summary_table};")
+            cur.execute(f"""
+            INSERT INTO {summary_table} ({dimension}, user_count)
+            SELECT {dimension}, COUNT(*) FROM {summary_table}_members GROUP BY {dimension};
+            """)
+
+    def summary_rows(self, summary_table, prefix=''):
+        with self._transaction() as cur:
+            cur.execute(f"SELECT {SUMMARY_TABLES[summary_table]}, user_count FROM {prefix}{summary_table}")
+            return cur.fetchall()
+
+    def _day_sql(self, column):
+        # Day of a timestamp column, as text in SQLite
+        return f"date({column})" if self.engine == 'sqlite' else f"CAST({column} AS DATE)"
+
+    def batch_days(self, table):
+        keys = ', '.join(DEDUP_KEY)
+        with self._transaction() as cur:
+            cur.execute(f"""
+            SELECT {self._day_sql('event_time')} FROM {self.staging} WHERE event_time IS NOT NULL
+            UNION
+            SELECT {self._day_sql('m.event_time')} FROM {table} m
+            JOIN (SELECT DISTINCT {keys} FROM {self.staging}) b USING ({keys})
+            WHERE m.event_time IS NOT NULL;
+            """)
+            return {pd.Timestamp(day) for day, in cur.fetchall()}
+
+    def read_days(self, table, days):
+        ranges = day_ranges(days)
+        where = ' OR '.join(['(event_time >= ? AND event_time < ?)'] * len(ranges))
+        with self._transaction() as cur:
+            cur.execute(
+                f"SELECT {', '.join(EVENT_COLUMNS)} FROM {table}_wide WHERE {where}",
+                [str(bound) for day_range in ranges for bound in day_range]
+            )
+            return _events_frame(cur.fetchall())
+
+    def replace_rollups(self, rollups, days, full=False, definitions=ROLLUP_TABLES):
+        """
+        Replace the rows of the given days in daily rollup tables; a full reload
+        rewrote the whole main table, so it rewrites the whole rollups too.
+        """
+        with self._transaction() as cur:
+            for table, frame in rollups.items():
+                if full:
+                    cur.execute(f"DROP TABLE IF EXISTS {table};")
+                cur.execute(f"CREATE TABLE IF NOT EXISTS {table} ({_rollup_definitions(definitions[table])});")
+                dates = [day.strftime('%Y-%m-%d') for day in days]
+                cur.execute(f"DELETE FROM {table} WHERE day IN ({', '.join('?' * len(dates))})", dates)
+                if self.engine == 'sqlite':
+                    frame = frame.assign(day=[day.isoformat() for day in frame['day']])
+                self._insert(cur, frame, table, list(frame.columns), list(frame.columns))
+
+    def read_table(self, table):
+        with self._transaction() as cur:
+            cur.execute(f"SELECT * FROM {table}")
+            return pd.DataFrame(cur.fetchall(), columns=[column[0] for column in cur.description])
+
+    def record_quarantine(self, rows):
+        with self._transaction() as cur:
+            record_counts(cur, rows, placeholder='?')
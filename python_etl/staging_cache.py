@@ -0,0 +1,119 @@
+import hashlib
+import inspect
+import json
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from incremental import file_fingerprint
+
+# Directory holding the cached Parquet files of cleaned data
+DEFAULT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'staging_cache')
+
+# Explicit Arrow types of the cleaned columns; other columns keep their inferred types and
+# categorical columns stay dictionary-encoded, so a cache hit returns the dtypes of a miss
+CLEANED_SCHEMA = {
+    'user_id': pa.int64(),
+    'start_watching': pa.timestamp('us'),
+    'event_time': pa.timestamp('us'),
+    'session_id': pa.string(),
+    'event_type': pa.string(),
+    'province': pa.string(),
+    'city': pa.string(),
+    'location': pa.string(),
+    'content_type': pa.string(),
+    'device_type': pa.string(),
+    'play_time_ms': pa.int64(),
+}
+
+
+# Types of the module-level values and default arguments hashed into the cache key
+CONSTANT_TYPES = (type(None), bool, int, float, str, bytes, tuple, list, dict, set, frozenset, pd.Timestamp)
+
+
+def _update_with_code(digest, code, namespace, seen):
+    # Hash a code object with its nested lambdas and, recursively, the module-level functions
+    # it calls (e.g. cleaning.clean_frame), with the constants they read (e.g. USER_ID_RANGE, or
+    # TIMESTAMP_FORMAT as the default format of parse_timestamps). Nested code objects are hashed
+    # rather than repr'd, as their repr holds a memory address that changes from run to run
+    if code in seen:
+        return
+    seen.add(code)
+    digest.update(code.co_code)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            _update_with_code(digest, const, namespace, seen)
+        else:
+            digest.update(repr(const).encode())
+    for name in code.co_names:
+        value = namespace.get(name)
+        if inspect.isfunction(value):
+            # Look through decorators such as metrics.instrumented to the code itself
+            value = inspect.unwrap(value)
+            defaults = list(value.__defaults__ or ()) + sorted((value.__kwdefaults__ or {}).items())
+            digest.update(repr([d for d in defaults if isinstance(d, CONSTANT_TYPES)]).encode())
+            _update_with_code(digest, value.__code__, value.__globals__, seen)
+        elif isinstance(value, CONSTANT_TYPES):
+            digest.update(f"{name}={value!r}".encode())
+
+
+def cache_key(csv_file_path, prepare, column_mapping, read_csv_kwargs=None):
+    """
+    Key a cache entry by the content hash of the source CSV, the column mapping, the
+    read options and the code of the cleaning function and the constants it reads, so a
+    change to any of them misses the cache.
+    """
+    digest = hashlib.sha256()
+    digest.update(file_fingerprint(csv_file_path).encode())
+    digest.update(json.dumps(column_mapping, sort_keys=True).encode())
+    prepare = inspect.unwrap(prepare)
+    _update_with_code(digest, prepare.__code__, prepare.__globals__, set())
+    digest.update(repr(sorted((read_csv_kwargs or {}).items())).encode())
+    return digest.hexdigest()
+
+
+def _arrow_schema(data):
+    inferred = pa.Schema.from_pandas(data, preserve_index=True)
+    return pa.schema([
+        pa.field(f.name, f.type if pa.types.is_dictionary(f.type) else CLEANED_SCHEMA.get(f.name, f.type))
+        for f in inferred
+    ])
+
+
+def cached_prepare(csv_file_path, prepare, column_mapping, cache_dir=DEFAULT_CACHE_DIR, **read_csv_kwargs):
+    """
+    Return prepare(pd.read_csv(csv_file_path), column_mapping), reusing a cached
+    Parquet copy of the cleaned data when the source and the cleaning are unchanged.
+
+    Parameters:
+    - csv_file_path: Path to the source CSV file.
+    - prepare: Cleaning function taking (data, column_mapping).
+    - column_mapping: Mapping of original to cleaned column names.
+    - cache_dir: Directory for the Parquet files.
+    - read_csv_kwargs: Extra arguments passed to pd.read_csv on a cache miss.
+
+    Returns:
+    - Cleaned DataFrame.
+    """
+    cache_path = os.path.join(cache_dir, cache_key(csv_file_path, prepare, column_mapping, read_csv_kwargs) + '.parquet')
+
+    if os.path.exists(cache_path):
+        # Read the cached columns instead of re-parsing and re-cleaning the CSV. Timestamps are
+        # stored in microseconds and come back in nanoseconds, like the cleaned data
+        print(f"Using cached cleaned data {cache_path}")
+        return pq.read_table(cache_path).to_pandas(coerce_temporal_nanoseconds=True)
+
+    data = prepare(pd.read_csv(csv_file_path, **read_csv_kwargs), column_mapping)
+
+    # Write to a temporary file first so a crashed run never leaves a truncated cache entry;
+    # it is named per process because parallel workers may clean identical files at once
+    os.makedirs(cache_dir, exist_ok=True)
+    # The index is kept, so the rows keep their numbers in the source file
+    table = pa.Table.from_pandas(data, schema=_arrow_schema(data), preserve_index=True)
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    pq.write_table(table, temp_path)
+    os.replace(temp_path, cache_path)
+    print(f"Cached cleaned data to {cache_path}")
+    return data
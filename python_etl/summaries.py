@@ -0,0 +1,96 @@
+from incremental import DEDUP_KEY
+
+# Summary tables and the dimension each one counts distinct users by.
+# They group on the integer key of the dimension (province_id, content_type_id)
+SUMMARY_TABLES = {
+    'users_by_province': 'province',
+    'users_by_content_type': 'content_type',
+}
+
+
+def ensure_summary_tables(cur, reset=False, prefix=''):
+    """
+    Create the summary tables and their (dimension, user_id) membership tables.
+    With reset=True they are dropped first, for a full reload. A prefix gives
+    another set of tables, e.g. the scratch tables of benchmark.py.
+
+    Each membership table holds one row per user seen in a group, so a batch
+    only needs to count the memberships it adds. NULLS NOT DISTINCT keeps a
+    single NULL group, as GROUP BY does (PostgreSQL 15+).
+    """
+    for summary_table, dimension in SUMMARY_TABLES.items():
+        summary_table = prefix + summary_table
+        if reset:
+            cur.execute(f"DROP TABLE IF EXISTS {summary_table};")
+            cur.execute(f"DROP TABLE IF EXISTS {summary_table}_members;")
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {summary_table}_members (
+            {dimension}_id INT,
+            user_id INT NOT NULL,
+            UNIQUE NULLS NOT DISTINCT ({dimension}_id, user_id)
+        );
+        """)
+        cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {summary_table} (
+            {dimension}_id INT,
+            user_count BIGINT NOT NULL,
+            UNIQUE NULLS NOT DISTINCT ({dimension}_id)
+        );
+        """)
+
+
+def batch_rows_sql(main_table, temp_table):
+    """
+    SELECT returning the main-table rows for the dedup keys loaded in this batch.
+    It looks rows up through the dedup-key index, so its cost follows the batch size.
+    Rows the batch wrote lie within its event_time range, so only the partitions of
+    that range (and the one for rows without event_time) are read.
+    """
+    keys = ', '.join(DEDUP_KEY)
+    return f"""
+    SELECT m.* FROM {main_table} m
+    JOIN (SELECT DISTINCT {keys} FROM {temp_table}) b USING ({keys})
+    WHERE m.event_time BETWEEN (SELECT MIN(event_time) FROM {temp_table}) AND (SELECT MAX(event_time) FROM {temp_table})
+        OR m.event_time IS NULL
+    """
+
+
+def update_summaries(cur, batch_sql, summary_tables=None, prefix=''):
+    """
+    Add the users of a batch to every summary table, or to the given ones.
+
+    Parameters:
+    - cur: Open psycopg2 cursor. The caller commits, so readers see the old
+      counts until the whole batch is applied.
+    - batch_sql: SELECT returning the batch rows (at least the dimension key columns and user_id).
+    - summary_tables: Optional subset of SUMMARY_TABLES to update.
+    - prefix: Prefix of the table names (see ensure_summary_tables).
+    """
+    for summary_table in summary_tables or SUMMARY_TABLES:
+        dimension = SUMMARY_TABLES[summary_table]
+        summary_table = prefix + summary_table
+        cur.execute(f"""
+        WITH new_members AS (
+            INSERT INTO {summary_table}_members ({dimension}_id, user_id)
+            SELECT DISTINCT {dimension}_id, user_id FROM ({batch_sql}) AS batch
+            WHERE user_id IS NOT NULL
+            ON CONFLICT DO NOTHING
+            RETURNING {dimension}_id
+        )
+        INSERT INTO {summary_table} ({dimension}_id, user_count)
+        SELECT {dimension}_id, COUNT(*) FROM new_members GROUP BY {dimension}_id
+        ON CONFLICT ({dimension}_id) DO UPDATE
+        SET user_count = {summary_table}.user_count + EXCLUDED.user_count;
+        """)
+
+
+def summary_rows_sql(summary_table, prefix=''):
+    """
+    SELECT returning the rows of a summary table with the dimension text in place of its key.
+    """
+    dimension = SUMMARY_TABLES[summary_table]
+    return f"""
+    SELECT d.{dimension}, s.user_count
+    FROM {prefix}{summary_table} s
+    LEFT JOIN dim_{dimension} d ON d.{dimension}_id = s.{dimension}_id
+    """
@@ -0,0 +1,69 @@
+import numpy as np
+import pandas as pd
+
+from schema import TIMESTAMP_FORMAT
+
+# Parsed values by layout, kept across calls so streamed chunks reuse the minutes already seen.
+# Watch starts fall on whole minutes, so a year of data holds about half a million distinct strings
+TIMESTAMP_CACHE_SIZE = 1_000_000
+
+_caches = {}
+
+
+def _parse_values(values, format):
+    # Parse the distinct strings missing from the cache with one vectorized call; NaT is kept as iNaT
+    cache = _caches.setdefault(format, {})
+    hits = [cache.get(value) for value in values]
+    unknown = [value for value, hit in zip(values, hits) if hit is None]
+    if unknown:
+        parsed = pd.to_datetime(pd.Index(unknown, dtype=object), format=format, errors='coerce').asi8
+        if len(cache) + len(unknown) > TIMESTAMP_CACHE_SIZE:
+            cache.clear()
+        cache.update(zip(unknown, parsed.tolist()))
+        parsed = iter(parsed.tolist())
+        hits = [next(parsed) if hit is None else hit for hit in hits]
+    return np.array(hits, dtype=np.int64).view('datetime64[ns]')
+
+
+def parse_timestamps(col, format=TIMESTAMP_FORMAT, fill=None):
+    """
+    Parse a text column of one fixed layout (e.g. 5/15/2023 19:47) into timestamps.
+    Each distinct string is parsed once: a categorical column already holds its distinct
+    values, other columns are factorized, and strings parsed by earlier calls come from a cache.
+
+    Parameters:
+    - col: Series of text, categorical or object. A datetime column is only filled.
+    - format: strptime layout of the text.
+    - fill: Timestamp put in place of missing and unparsable values (e.g. 1970-01-01); None keeps NaT.
+
+    Returns:
+    - (Series of datetime64[ns] with the index and name of col, number of non-missing values that could not be parsed)
+    """
+    invalid = 0
+    if pd.api.types.is_datetime64_any_dtype(col):
+        parsed = col
+    else:
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            codes, values = col.cat.codes.to_numpy(), col.cat.categories
+        else:
+            codes, values = pd.factorize(col)
+        times = _parse_values([str(value) for value in values], format)
+
+        present = codes >= 0
+        bad = np.isnat(times)
+        if bad.any():
+            invalid = int(np.bincount(codes[present], minlength=len(values))[bad].sum())
+        result = np.full(len(col), np.datetime64('NaT'), dtype='datetime64[ns]')
+        result[present] = times[codes[present]]
+        parsed = pd.Series(result, index=col.index, name=col.name)
+
+    if fill is not None and parsed.hasnans:
+        parsed = parsed.fillna(fill)
+    return parsed, invalid
+
+
+def clear_cache():
+    """
+    Forget the parsed strings of every layout.
+    """
+    _caches.clear()